@@ -361,6 +361,33 @@ static void status_short_disable(void)
 
 static void debug_ddr(void);
 
+#ifdef CSR_ENCODER_PROBE_BASE
+static void encoder_probe_print(const char *name, unsigned int valid,
+	unsigned int ready, unsigned int stall, unsigned int bytes,
+	int frames)
+{
+	wprintf("  %-9s %4d.%dMB/s  ",
+		name, bytes/1000000, (bytes/100000)%10);
+	/* Only the probes with a frame strobe count frames. */
+	if(frames >= 0)
+		wprintf("frames: %6d  ", frames);
+	else
+		wprintf("frames:      -  ");
+	wprintf("stall: %3d%%  valid: %6dk  ready: %6dk\n",
+		valid >= 100 ? stall/(valid/100) : 0,
+		valid/1000,
+		ready/1000);
+}
+
+#define ENCODER_PROBE_PRINT(name, frames) \
+	encoder_probe_print(#name ":", \
+		encoder_probe_##name##_valid_read(), \
+		encoder_probe_##name##_ready_read(), \
+		encoder_probe_##name##_stall_read(), \
+		encoder_probe_##name##_bytes_read(), \
+		frames)
+#endif
+
 static void status_short_print(void)
 {
 	wprintf("status1: ");
@@ -570,6 +597,20 @@ static void status_print(void)
 		wprintf("off");
 	wputchar('\n');
 #endif
+#ifdef CSR_ENCODER_STREAMER_BASE
+	if(encoder_enabled)
+		wprintf("  streamer fifo overflow: %d  underflow: %d\n",
+			encoder_streamer_overflow_read(),
+			encoder_streamer_underflow_read());
+#endif
+#ifdef CSR_ENCODER_PROBE_BASE
+	if(encoder_enabled) {
+		ENCODER_PROBE_PRINT(reader, encoder_probe_reader_frames_read());
+		ENCODER_PROBE_PRINT(buffer, -1);
+		ENCODER_PROBE_PRINT(encoder, -1);
+		ENCODER_PROBE_PRINT(streamer, -1);
+	}
+#endif
 #ifdef CSR_SDRAM_CONTROLLER_BANDWIDTH_UPDATE_ADDR
 	wprintf("ddr: ");
 	debug_ddr();
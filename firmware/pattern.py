@@ -1,7 +1,12 @@
+# Y, Cb and Cr as (R, G, B) coefficients and an offset.
+RGB2YCBCR = [
+    [ 0.299,   0.587,   0.114,    0],
+    [-0.1687, -0.3313,  0.5,    128],
+    [ 0.5,    -0.4187, -0.0813, 128],
+]
+
 def rgb2ycbcr(r, g, b):
-    y = int(0.299*r + 0.587*g + 0.114*b)
-    cb = int(-0.1687*r - 0.3313*g + 0.5*b + 128)
-    cr = int(0.5*r - 0.4187*g - 0.0813*b + 128)
+    y, cb, cr = (int(kr*r + kg*g + kb*b + o) for kr, kg, kb, o in RGB2YCBCR)
     return y, cb, cr
 
 def ycbcr_pack(y, cb, cr):
@@ -28,6 +33,7 @@ for color_bar_rgb in color_bars_rgb:
     y, cb, cr = rgb2ycbcr(r, g, b)
     color_bars_ycbcr.append([y, cb, cr])
 
-for color_bar_ycbcr in color_bars_ycbcr:
-    value = ycbcr_pack(*color_bar_ycbcr)
-    print("%08x" %value)
+if __name__ == "__main__":
+    for color_bar_ycbcr in color_bars_ycbcr:
+        value = ycbcr_pack(*color_bar_ycbcr)
+        print("%08x" %value)
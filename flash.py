@@ -2,23 +2,169 @@
 
 import os
 import argparse
+import hashlib
+import json
+import tempfile
 
 import make
 
 
+FLASH_STATE_DIR = os.path.join("build", "flash-state")
+
+# Value of erased flash bytes.
+ERASED = b"\xff"
+
+
+class FlashState:
+    """What was last flashed onto a board, kept per board serial.
+
+    A mirror of the flash contents is kept next to the hash of every
+    sector which is known to hold that content.
+    """
+
+    def __init__(self, serial, sector_size):
+        self.sector_size = sector_size
+        self.mirror = os.path.join(FLASH_STATE_DIR, "{}.bin".format(serial))
+        self.index = os.path.join(FLASH_STATE_DIR, "{}.json".format(serial))
+        self.hashes = {}
+        try:
+            index = json.load(open(self.index))
+            if index["sector_size"] == sector_size:
+                self.hashes = {int(s): h for s, h in index["sectors"].items()}
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def read_sector(self, sector):
+        """Contents of a sector, or None when it isn't known."""
+        if sector not in self.hashes:
+            return None
+        with open(self.mirror, "rb") as f:
+            f.seek(sector * self.sector_size)
+            data = f.read(self.sector_size)
+        if sector_hash(data) != self.hashes[sector]:
+            return None
+        return data
+
+    def update(self, sector, data):
+        os.makedirs(FLASH_STATE_DIR, exist_ok=True)
+        mode = "r+b" if os.path.exists(self.mirror) else "wb"
+        with open(self.mirror, mode) as f:
+            f.seek(sector * self.sector_size)
+            f.write(data)
+        self.hashes[sector] = sector_hash(data)
+
+    def save(self):
+        os.makedirs(FLASH_STATE_DIR, exist_ok=True)
+        with open(self.index, "w") as f:
+            json.dump({
+                "sector_size": self.sector_size,
+                "sectors": {str(s): h for s, h in sorted(self.hashes.items())},
+            }, f, indent=1)
+
+
+def sector_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def plan_sectors(read_sector, hashes, sector_size, address, data):
+    """Work out what writing data at address does to each sector.
+
+    Returns (sector, contents, changed) for every sector touched. The
+    programmers erase every sector they write to, so the new data is
+    merged into the previous contents of a sector when they are known, and
+    padded with the erased value (0xff) when they aren't. Either way the
+    whole sector is written and its contents are known afterwards.
+
+    >>> known = {0: b"abcd"}
+    >>> hashes = {0: sector_hash(b"abcd")}
+    >>> for p in plan_sectors(known.get, hashes, 4, 2, b"cd12345"):
+    ...     print(*p)
+    0 b'abcd' False
+    1 b'1234' True
+    2 b'5\\xff\\xff\\xff' True
+    """
+    end = address + len(data)
+    plan = []
+    for sector in range(address // sector_size, (end - 1) // sector_size + 1):
+        sector_start = sector * sector_size
+        lo = max(address, sector_start)
+        hi = min(end, sector_start + sector_size)
+        new = data[lo - address:hi - address]
+
+        old = read_sector(sector)
+        if old is None:
+            old = ERASED * sector_size
+        contents = old[:lo - sector_start] + new + old[hi - sector_start:]
+        plan.append((sector, contents, sector_hash(contents) != hashes.get(sector)))
+    return plan
+
+
+def plan_write(plan, sector_size):
+    """The single write covering every changed sector of a plan.
+
+    Unchanged sectors between changed ones are written again rather than
+    splitting the write, as each write is a programmer session of its own
+    (loading the flash proxy bitstream again).
+
+    >>> plan_write([
+    ...     (0, b"a", False),
+    ...     (1, b"b", True),
+    ...     (2, b"c", False),
+    ...     (3, b"d", True),
+    ...     (4, b"e", False),
+    ... ], 1)
+    (1, b'bcd')
+    >>> plan_write([(0, b"a", False)], 1) is None
+    True
+    """
+    changed = [n for n, p in enumerate(plan) if p[2]]
+    if not changed:
+        return None
+    first, last = changed[0], changed[-1]
+    return (plan[first][0] * sector_size,
+            b"".join(p[1] for p in plan[first:last + 1]))
+
+
+def flash_incremental(prog, state, address, filepath):
+    """Only erase and program the sectors whose contents changed."""
+    data = open(filepath, "rb").read()
+    plan = plan_sectors(state.read_sector, state.hashes, state.sector_size, address, data)
+    write = plan_write(plan, state.sector_size)
+
+    changed = sum(1 for p in plan if p[2])
+    if write is None:
+        print("Flashing 0 of {} sectors, nothing changed".format(len(plan)))
+        return plan
+    write_address, contents = write
+    print("Flashing {} of {} sectors ({} sectors written)".format(
+        changed, len(plan), len(contents) // state.sector_size))
+    with tempfile.NamedTemporaryFile(suffix=".bin") as f:
+        f.write(contents)
+        f.flush()
+        prog.flash(write_address, f.name)
+    return plan
+
+
 def main():
     parser = argparse.ArgumentParser(description="Board flashing tool")
-    make.get_args(parser)
+    make.get_args(parser, soc_args=False)
 
     parser.add_argument("--mode", default="image", choices=["image", "gateware", "bios", "firmware", "other"], help="Type of file to flash")
     parser.add_argument("--other-file", default=None)
     parser.add_argument("--address", type=int, help="Where to flash if using --mode=other")
+    parser.add_argument("--board-serial", default=os.environ.get('BOARD_SERIAL', None),
+                        help="Remember what was flashed onto this board (e.g. its DNA or JTAG cable serial)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only flash the sectors which changed since the last flash of --board-serial")
 
-    args = parser.parse_args()
+    # The other SoC options are only parsed (by make.get_soc_info) when
+    # the SoC has to be elaborated, the manifest of the build is used
+    # otherwise.
+    args, _ = parser.parse_known_args()
 
     builddir = make.get_builddir(args)
-    platform = make.get_platform(args)
-    soc = make.get_soc(args, platform)
+    platform = make.get_platform_info(args)
+    soc = make.get_soc_info(args)
     bios_maxsize = make.get_bios_maxsize(args, soc)
 
     if args.mode == 'image':
@@ -65,8 +211,25 @@ def main():
     assert file_end < address_end, "File is too big!\n%s file doesn't fit in %s space (%s extra bytes)." % (
         filename, file_size, address_end - address_start)
 
-    prog = make.get_prog(args, platform)
-    prog.flash(address_start, filepath)
+    prog = make.get_prog(args, make.get_platform(args))
+    if not args.board_serial:
+        assert not args.incremental, "--incremental needs --board-serial"
+        prog.flash(address_start, filepath)
+        return
+
+    state = FlashState(args.board_serial, platform.spiflash_sector_size)
+    if args.incremental:
+        plan = flash_incremental(prog, state, address_start, filepath)
+    else:
+        # Flashing the file whole erases the rest of the sectors it
+        # starts and ends in.
+        prog.flash(address_start, filepath)
+        plan = plan_sectors(lambda sector: None, state.hashes, state.sector_size,
+                            address_start, open(filepath, "rb").read())
+
+    for sector, contents, changed in plan:
+        state.update(sector, contents)
+    state.save()
 
 
 if __name__ == "__main__":
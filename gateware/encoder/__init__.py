@@ -1 +1 @@
-from gateware.encoder.core import EncoderDMAReader, EncoderBuffer, Encoder
+from gateware.encoder.core import EncoderDMAReader, EncoderPrefetchDMAReader, EncoderBuffer, EncoderBufferStalls, Encoder
@@ -1,7 +1,7 @@
 import os
 
 from migen import *
-from migen.genlib.cdc import MultiReg
+from migen.genlib.cdc import MultiReg, GrayCounter, GrayDecoder
 from migen.genlib.misc import chooser
 
 from litex.soc.interconnect import wishbone
@@ -115,121 +115,254 @@ class EncoderDMAReader(Module, AutoCSR):
         ]
 
 
+class EncoderPrefetchDMAReader(Module, AutoCSR):
+    """Same interface as EncoderDMAReader, for high resolutions.
+
+    The block address stream is walked with registered adders (no
+    multiplier in the address path) and the DMA data FIFO keeps up to
+    fifo_depth DRAM bursts in flight. 512 is one block RAM deep on
+    Spartan-6 and covers the DRAM latency many times over.
+    """
+    def __init__(self, dram_port, fifo_depth=512):
+        self.source = source = stream.Endpoint([("data", 128)])
+        self.base = CSRStorage(32)
+        self.h_width = CSRStorage(16)
+        self.v_width = CSRStorage(16)
+        self.start = CSR()
+        self.done = CSRStatus()
+
+        # # #
+
+        pixel_bits = 16 # ycbcr 4:2:2
+        burst_pixels = dram_port.dw//pixel_bits
+        alignment_bits = bits_for(dram_port.dw//8) - 1
+        burst_bits = log2_int(burst_pixels)
+        assert burst_pixels <= 8
+        # bursts per line of an 8x8 block
+        block_bursts = 8//burst_pixels
+
+        self.submodules.dma = dma = LiteDRAMDMAReader(dram_port,
+            fifo_depth=fifo_depth, fifo_buffered=True)
+
+        self.comb += dma.source.connect(source)
+
+        start = self.start.r & self.start.re
+        done = self.done.status
+
+        load = Signal()
+        step = Signal()
+
+        # dram words in a line and in 8 lines
+        stride = Signal(dram_port.aw)
+        stride8 = Signal(dram_port.aw)
+        self.sync += If(load,
+            stride.eq(self.h_width.storage[burst_bits:]),
+            stride8.eq(self.h_width.storage[burst_bits:] << 3)
+        )
+
+        # address of the current burst, of its line in the block, of its
+        # block and of its MCU row, all moved by adds only
+        address = Signal(dram_port.aw)
+        line_base = Signal(dram_port.aw)
+        block_base = Signal(dram_port.aw)
+        row_base = Signal(dram_port.aw)
+
+        # position in the frame, counted down
+        burst = Signal(max=max(block_bursts, 2))
+        line = Signal(3)
+        blocks = Signal(13)
+        rows = Signal(13)
+
+        last_burst = Signal()
+        last_line = Signal()
+        last_block = Signal()
+        last_row = Signal()
+        self.comb += [
+            last_burst.eq(burst == 0),
+            last_line.eq(line == 0),
+            last_block.eq(blocks == 0),
+            last_row.eq(rows == 0)
+        ]
+
+        next_line = Signal(dram_port.aw)
+        next_block = Signal(dram_port.aw)
+        next_row = Signal(dram_port.aw)
+        self.comb += [
+            next_line.eq(line_base + stride),
+            next_block.eq(block_base + block_bursts),
+            next_row.eq(row_base + stride8)
+        ]
+
+        base = self.base.storage[alignment_bits:]
+        self.sync += \
+            If(load,
+                address.eq(base),
+                line_base.eq(base),
+                block_base.eq(base),
+                row_base.eq(base),
+                burst.eq(block_bursts - 1),
+                line.eq(7),
+                blocks.eq(self.h_width.storage[3:] - 1),
+                rows.eq(self.v_width.storage[3:] - 1)
+            ).Elif(step,
+                If(~last_burst,
+                    address.eq(address + 1),
+                    burst.eq(burst - 1)
+                ).Else(
+                    burst.eq(block_bursts - 1),
+                    If(~last_line,
+                        address.eq(next_line),
+                        line_base.eq(next_line),
+                        line.eq(line - 1)
+                    ).Else(
+                        line.eq(7),
+                        If(~last_block,
+                            address.eq(next_block),
+                            line_base.eq(next_block),
+                            block_base.eq(next_block),
+                            blocks.eq(blocks - 1)
+                        ).Else(
+                            address.eq(next_row),
+                            line_base.eq(next_row),
+                            block_base.eq(next_row),
+                            row_base.eq(next_row),
+                            blocks.eq(self.h_width.storage[3:] - 1),
+                            rows.eq(rows - 1)
+                        )
+                    )
+                )
+            )
+
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        fsm.act("IDLE",
+            load.eq(1),
+            If(start,
+                NextState("READ")
+            ).Else(
+                done.eq(1)
+            )
+        )
+        fsm.act("READ",
+            dma.sink.valid.eq(1),
+            If(dma.sink.ready,
+                step.eq(1),
+                If(last_burst & last_line & last_block & last_row,
+                    NextState("IDLE")
+                )
+            )
+        )
+        self.comb += dma.sink.address.eq(address)
+
+
 class EncoderBuffer(Module):
-    def __init__(self):
+    """Buffer of nblocks 8x8 blocks between the DMA reader and the encoder.
+
+    The writer fills any free block, so the DMA can run up to nblocks
+    blocks ahead of the encoder. write_stalls (data from the DMA waiting
+    for a free block) and read_stalls (encoder waiting for a block) are
+    gray coded cycle counters, to be read from another clock domain with
+    EncoderBufferStalls.
+    """
+    def __init__(self, nblocks=2):
         self.sink = sink = stream.Endpoint([("data", 128)])
         self.source = source = stream.Endpoint([("data", 16)])
 
         # # #
 
         # mem
-        mem = Memory(128, 16)
+        mem = Memory(128, 8*nblocks)
         write_port = mem.get_port(write_capable=True)
         read_port = mem.get_port(async_read=True)
         self.specials += mem, write_port, read_port
 
-        write_sel = Signal()
-        write_swap = Signal()
-        read_sel = Signal(reset=1)
-        read_swap = Signal()
+        write_block = Signal(max=max(nblocks, 2))
+        write_done = Signal()
+        read_block = Signal(max=max(nblocks, 2))
+        read_done = Signal()
         self.sync += [
-            If(write_swap,
-                write_sel.eq(~write_sel)
+            If(write_done,
+                If(write_block == nblocks - 1,
+                    write_block.eq(0)
+                ).Else(
+                    write_block.eq(write_block + 1)
+                )
             ),
-            If(read_swap,
-                read_sel.eq(~read_sel)
+            If(read_done,
+                If(read_block == nblocks - 1,
+                    read_block.eq(0)
+                ).Else(
+                    read_block.eq(read_block + 1)
+                )
             )
         ]
 
+        # blocks written and not yet read
+        level = Signal(max=nblocks + 1)
+        self.sync += \
+            If(write_done & ~read_done,
+                level.eq(level + 1)
+            ).Elif(read_done & ~write_done,
+                level.eq(level - 1)
+            )
 
         # write path
-        v_write_clr = Signal()
-        v_write_inc = Signal()
         v_write = Signal(3)
         self.sync += \
-            If(v_write_clr,
-                v_write.eq(0)
-            ).Elif(v_write_inc,
+            If(sink.valid & sink.ready,
                 v_write.eq(v_write + 1)
             )
         self.comb += [
-            write_port.adr.eq(v_write),
-            write_port.adr[-1].eq(write_sel),
+            sink.ready.eq(level != nblocks),
+            write_done.eq(sink.valid & sink.ready & (v_write == 7)),
+            write_port.adr.eq(Cat(v_write, write_block)),
             write_port.dat_w.eq(sink.data),
             write_port.we.eq(sink.valid & sink.ready)
         ]
 
-        self.submodules.write_fsm = write_fsm = FSM(reset_state="IDLE")
-        write_fsm.act("IDLE",
-            v_write_clr.eq(1),
-            If(write_sel != read_sel,
-                NextState("WRITE")
-            )
-        )
-        write_fsm.act("WRITE",
-            sink.ready.eq(1),
-            If(sink.valid,
-                If(v_write == 7,
-                    write_swap.eq(1),
-                    NextState("IDLE")
-                ).Else(
-                    v_write_inc.eq(1)
-                )
-            )
-        )
-
         # read path
-        h_read_clr = Signal()
-        h_read_inc = Signal()
         h_read = Signal(3)
-        self.sync += \
-            If(h_read_clr,
-                h_read.eq(0)
-            ).Elif(h_read_inc,
-                h_read.eq(h_read + 1)
-            )
-
-        v_read_clr = Signal()
-        v_read_inc = Signal()
         v_read = Signal(3)
         self.sync += \
-            If(v_read_clr,
-                v_read.eq(0)
-            ).Elif(v_read_inc,
-                v_read.eq(v_read + 1)
+            If(source.valid & source.ready,
+                h_read.eq(h_read + 1),
+                If(h_read == 7,
+                    v_read.eq(v_read + 1)
+                )
             )
 
         self.comb += [
-            read_port.adr.eq(v_read),
-            read_port.adr[-1].eq(read_sel),
-            chooser(read_port.dat_r, h_read, source.data, reverse=True)
+            read_port.adr.eq(Cat(v_read, read_block)),
+            chooser(read_port.dat_r, h_read, source.data, reverse=True),
+            source.valid.eq(level != 0),
+            source.last.eq((h_read == 7) & (v_read == 7)),
+            read_done.eq(source.valid & source.ready & source.last)
         ]
 
-        self.submodules.read_fsm = read_fsm = FSM(reset_state="IDLE")
-        read_fsm.act("IDLE",
-            h_read_clr.eq(1),
-            v_read_clr.eq(1),
-            If(read_sel == write_sel,
-                read_swap.eq(1),
-                NextState("READ")
-            )
-        )
-        read_fsm.act("READ",
-            source.valid.eq(1),
-            source.last.eq((h_read == 7) & (v_read == 7)),
-            If(source.ready,
-                If(h_read == 7,
-                    h_read_clr.eq(1),
-                    If(v_read == 7,
-                        NextState("IDLE")
-                    ).Else(
-                        v_read_inc.eq(1)
-                    )
-                ).Else(
-                    h_read_inc.eq(1)
-                )
-            )
-        )
+        # stall counters
+        self.submodules.write_stall_counter = GrayCounter(32)
+        self.submodules.read_stall_counter = GrayCounter(32)
+        self.comb += [
+            self.write_stall_counter.ce.eq(sink.valid & ~sink.ready),
+            self.read_stall_counter.ce.eq(source.ready & ~source.valid)
+        ]
+        self.write_stalls = self.write_stall_counter.q
+        self.read_stalls = self.read_stall_counter.q
+
+
+class EncoderBufferStalls(Module, AutoCSR):
+    """CSRs of the stall counters of an EncoderBuffer in another clock domain."""
+    def __init__(self, buffer):
+        self.write_stalls = CSRStatus(32)
+        self.read_stalls = CSRStatus(32)
+
+        # # #
+
+        for gray, csr in [(buffer.write_stalls, self.write_stalls),
+                          (buffer.read_stalls, self.read_stalls)]:
+            decoder = GrayDecoder(32)
+            self.submodules += decoder
+            self.specials += MultiReg(gray, decoder.i)
+            self.sync += csr.status.eq(decoder.o)
 
 
 class Encoder(Module, AutoCSR):
@@ -1,6 +1,12 @@
 """Built In Self Test (BIST) modules for testing liteDRAM functionality."""
 
+from functools import reduce
+from operator import or_
+
 from migen import *
+from migen.genlib.fifo import SyncFIFOBuffered
+
+from litex.soc.interconnect.csr import *
 
 
 class LiteDRAMBISTCheckerScope(Module):
@@ -28,3 +34,78 @@ class LiteDRAMBISTCheckerScope(Module):
             self.data_expected,
             self.data_actual,
         ]
+
+
+class LiteDRAMBISTErrorLog(Module, AutoCSR):
+    """Logs the errors found by a LiteDRAMBISTChecker, for reading over CSRs.
+
+    The address and XOR mask (expected ^ actual) of the first `depth`
+    failing words go into a BRAM FIFO, further errors only count in
+    `overflow`. Every error also counts against its bank (`nbanks` banks
+    at bit `bank_offset` of the port address) and against each DQ bit
+    which was wrong in any beat of the word (`databits` DQ lines).
+
+    `pop` drops the head of the FIFO, `reset` clears the log.
+    """
+
+    def __init__(self, checker, databits, nbanks, bank_offset, depth=512, counter_width=32):
+        self.submodules.scope = scope = LiteDRAMBISTCheckerScope(checker)
+        dw = len(scope.data_actual)
+        aw = len(scope.data_address)
+        bankbits = log2_int(nbanks)
+
+        self._reset = CSR()
+        self._level = CSRStatus(bits_for(depth+1))
+        self._address = CSRStatus(aw)
+        self._mask = CSRStatus(dw)
+        self._pop = CSR()
+        self._errors = CSRStatus(counter_width)
+        self._overflow = CSRStatus(counter_width)
+        for i in range(nbanks):
+            setattr(self, "_bank{}_errors".format(i), CSRStatus(counter_width, name="bank{}_errors".format(i)))
+        for i in range(databits):
+            setattr(self, "_dq{}_errors".format(i), CSRStatus(counter_width, name="dq{}_errors".format(i)))
+
+        # # #
+
+        mask = Signal(dw)
+        self.comb += mask.eq(scope.data_expected ^ scope.data_actual)
+
+        # error fifo
+        fifo = ResetInserter()(SyncFIFOBuffered(aw + dw, depth))
+        self.submodules += fifo
+        self.comb += [
+            fifo.reset.eq(self._reset.re),
+            fifo.din.eq(Cat(scope.data_address, mask)),
+            fifo.we.eq(scope.data_error),
+            fifo.re.eq(self._pop.re),
+            self._level.status.eq(fifo.level),
+            If(fifo.readable,
+                self._address.status.eq(fifo.dout[:aw]),
+                self._mask.status.eq(fifo.dout[aw:]),
+            ),
+        ]
+
+        def count(status, inc):
+            self.sync += [
+                If(self._reset.re,
+                    status.eq(0),
+                ).Elif(inc & (status != 2**counter_width-1),
+                    status.eq(status + 1),
+                )
+            ]
+
+        count(self._errors.status, scope.data_error)
+        count(self._overflow.status, scope.data_error & ~fifo.writable)
+
+        # per bank
+        bank = Signal(max=max(nbanks, 2))
+        self.comb += bank.eq(scope.data_address[bank_offset:bank_offset+bankbits])
+        for i in range(nbanks):
+            status = getattr(self, "_bank{}_errors".format(i)).status
+            count(status, scope.data_error & (bank == i))
+
+        # per dq bit, over all the beats of the word
+        for i in range(databits):
+            status = getattr(self, "_dq{}_errors".format(i)).status
+            count(status, scope.data_error & reduce(or_, mask[i::databits]))
@@ -0,0 +1,80 @@
+from migen import *
+from migen.genlib.cdc import MultiReg, PulseSynchronizer
+from litex.soc.interconnect.csr import *
+
+
+class StreamProbe(Module, AutoCSR):
+    """Counts the activity of a stream.Endpoint over one second periods.
+
+    The counters run in the clock domain of the endpoint and are latched
+    each second of the sys clock domain (clk_freq). The CSRs give the
+    counts of the last complete period, updated half a period after it
+    ends once the counts have crossed back to the sys clock domain.
+
+    frames counts the frame strobe, and only exists when one is given.
+    """
+    def __init__(self, endpoint, clk_freq, clock_domain="sys", frame=None, counter_width=32):
+        self.valid = CSRStatus(counter_width)
+        self.ready = CSRStatus(counter_width)
+        self.stall = CSRStatus(counter_width)
+        self.bytes = CSRStatus(counter_width)
+        if frame is not None:
+            self.frames = CSRStatus(counter_width)
+
+        # # #
+
+        # period
+        latch = Signal()
+        update = Signal()
+        period_counter = Signal(max=clk_freq)
+        self.sync += \
+            If(period_counter == clk_freq - 1,
+                period_counter.eq(0),
+                latch.eq(1)
+            ).Else(
+                period_counter.eq(period_counter + 1),
+                latch.eq(0)
+            )
+        latch_ps = PulseSynchronizer("sys", clock_domain)
+        self.submodules += latch_ps
+        self.comb += [
+            latch_ps.i.eq(latch),
+            update.eq(period_counter == clk_freq//2)
+        ]
+
+        # counters
+        events = [
+            (self.valid, endpoint.valid, 1),
+            (self.ready, endpoint.ready, 1),
+            (self.stall, endpoint.valid & ~endpoint.ready, 1),
+            (self.bytes, endpoint.valid & endpoint.ready, len(endpoint.data)//8),
+        ]
+        if frame is not None:
+            events.append((self.frames, frame, 1))
+        sync = getattr(self.sync, clock_domain)
+        for csr, event, inc in events:
+            counter = Signal(counter_width)
+            latched = Signal(counter_width)
+            latched_sys = Signal(counter_width)
+            sync += \
+                If(latch_ps.o,
+                    latched.eq(counter),
+                    counter.eq(Mux(event, inc, 0))
+                ).Elif(event,
+                    counter.eq(counter + inc)
+                )
+            # latched only changes once a period, a few cycles after the
+            # latch, so it has long settled in the sys domain by the update.
+            self.specials += MultiReg(latched, latched_sys)
+            self.sync += If(update, csr.status.eq(latched_sys))
+
+
+class StreamProbes(Module, AutoCSR):
+    """StreamProbes of several endpoints sharing one CSR bank.
+
+    probes is a list of (name, endpoint, clock_domain, frame) tuples.
+    """
+    def __init__(self, clk_freq, probes):
+        for name, endpoint, clock_domain, frame in probes:
+            setattr(self.submodules, name,
+                    StreamProbe(endpoint, clk_freq, clock_domain, frame))
@@ -1,12 +1,27 @@
 import os
 
 from migen import *
+from migen.genlib.cdc import MultiReg, GrayCounter, GrayDecoder
 from migen.genlib.resetsync import AsyncResetSynchronizer
 from litex.soc.interconnect import stream
+from litex.soc.interconnect.csr import *
 
-class USBStreamer(Module):
-    def __init__(self, platform, pads):
+class USBStreamer(Module, AutoCSR):
+    """Streams the JPEG frames of the encoder to the FX2.
+
+    The bytes cross to the FX2 clock domain through a block RAM FIFO of
+    depth bytes and are only released to the FX2 in bursts: a burst is
+    watermark bytes (1012 bytes, the payload of one of the 1024 byte UVC
+    packets of fx2_jpeg_streamer, two full USB packets), or the end of a
+    frame, which is sent right away and ends with a pktend.
+
+    overflow counts the cycles the encoder waited on a full FIFO,
+    underflow the cycles a burst waited on an empty FIFO.
+    """
+    def __init__(self, platform, pads, depth=4096, watermark=1012):
         self.sink = sink = stream.Endpoint([("data", 8)])
+        self.overflow = CSRStatus(32)
+        self.underflow = CSRStatus(32)
 
         # # #
 
@@ -17,10 +32,81 @@ class USBStreamer(Module):
 
         self.specials += AsyncResetSynchronizer(self.cd_usb, ResetSignal())
 
-        fifo = stream.AsyncFIFO([("data", 8)], 4)
+        fifo = stream.AsyncFIFO([("data", 8)], depth, buffered=True)
         fifo = ClockDomainsRenamer({"write": "encoder", "read": "usb"})(fifo)
         self.submodules.fifo = fifo
-        self.comb += Record.connect(sink, fifo.sink)
+
+        # write side: mark the ends of frames (EOI marker, ff d9) and tell
+        # the read side each time a burst is in the fifo
+        sink_data_d = Signal(8)
+        eoi = Signal()
+        write_count = Signal(max=watermark)
+        write_burst = Signal()
+        self.comb += [
+            Record.connect(sink, fifo.sink, omit=["last"]),
+            eoi.eq((sink_data_d == 0xff) & (sink.data == 0xd9)),
+            fifo.sink.last.eq(eoi),
+            write_burst.eq(sink.valid & fifo.sink.ready &
+                (eoi | (write_count == watermark - 1)))
+        ]
+        self.sync.encoder += \
+            If(sink.valid & fifo.sink.ready,
+                sink_data_d.eq(sink.data),
+                If(write_burst,
+                    write_count.eq(0)
+                ).Else(
+                    write_count.eq(write_count + 1)
+                )
+            )
+
+        burst_bits = bits_for(depth) + 1
+        written_bursts = ClockDomainsRenamer("encoder")(GrayCounter(burst_bits))
+        written_bursts_decoder = GrayDecoder(burst_bits)
+        self.submodules += written_bursts, written_bursts_decoder
+        self.specials += MultiReg(written_bursts.q, written_bursts_decoder.i, "usb")
+        self.comb += written_bursts.ce.eq(write_burst)
+
+        # read side: release the bursts to the fx2
+        read_bursts = Signal(burst_bits)
+        bursts = Signal(burst_bits)
+        self.comb += bursts.eq(written_bursts_decoder.o - read_bursts)
+        read_count = Signal(max=watermark)
+        read_burst = Signal()
+        source_stb = Signal()
+        source_ack = Signal()
+        self.comb += [
+            source_stb.eq(fifo.source.valid & (bursts != 0)),
+            fifo.source.ready.eq(source_ack & (bursts != 0)),
+            read_burst.eq(fifo.source.valid & fifo.source.ready &
+                (fifo.source.last | (read_count == watermark - 1)))
+        ]
+        self.sync.usb += [
+            If(fifo.source.valid & fifo.source.ready,
+                If(read_burst,
+                    read_count.eq(0)
+                ).Else(
+                    read_count.eq(read_count + 1)
+                )
+            ),
+            If(read_burst,
+                read_bursts.eq(read_bursts + 1)
+            )
+        ]
+
+        # overflow / underflow
+        overflow_counter = ClockDomainsRenamer("encoder")(GrayCounter(32))
+        underflow_counter = ClockDomainsRenamer("usb")(GrayCounter(32))
+        self.submodules += overflow_counter, underflow_counter
+        self.comb += [
+            overflow_counter.ce.eq(sink.valid & ~fifo.sink.ready),
+            underflow_counter.ce.eq((bursts != 0) & ~fifo.source.valid)
+        ]
+        for counter, csr in [(overflow_counter, self.overflow),
+                             (underflow_counter, self.underflow)]:
+            decoder = GrayDecoder(32)
+            self.submodules += decoder
+            self.specials += MultiReg(counter.q, decoder.i)
+            self.sync += csr.status.eq(decoder.o)
 
         self.specials += Instance("fx2_jpeg_streamer",
             # clk, rst
@@ -28,9 +114,9 @@ class USBStreamer(Module):
             i_clk=ClockSignal("usb"),
 
             # jpeg encoder interface
-            i_sink_stb=fifo.source.valid,
+            i_sink_stb=source_stb,
             i_sink_data=fifo.source.data,
-            o_sink_ack=fifo.source.ready,
+            o_sink_ack=source_ack,
 
             # cypress fx2 slave fifo interface
             io_fx2_data=pads.data,
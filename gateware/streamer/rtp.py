@@ -1,158 +1,403 @@
-# RTP Proof of concept, metadata informations are missing (Sync, ...)
-# but this can be used as a basis to implement real RTP
+"""
+RTP/JPEG (RFC 2435) streaming of the encoder output over LiteEth UDP.
+
+The JFIF stream of the encoder is parsed on the fly: the quantization
+tables (DQT) and the size and subsampling of the frame (SOF0) are kept,
+the other headers are dropped and the entropy coded data of the scan is
+cut into packets of up to max_payload bytes. Each packet goes out with
+an RTP header (marker bit on the last packet of a frame, 90 kHz
+timestamp of the start of the frame, sequence number) and the RFC 2435
+JPEG header. The first packet of a frame also carries the quantization
+tables (Q = 255), so standard receivers can rebuild the JFIF headers.
+
+The Huffman tables of the encoder are the standard ones (RFC 2435
+section 3.1.8) and it doesn't use restart markers, so types 0 (4:2:2)
+and 1 (4:2:0) are enough.
+"""
+
+from migen import *
+
+from litex.soc.interconnect import stream
+from litex.soc.interconnect.csr import *
+
+from liteeth.common import eth_udp_user_description
+
 
 rtp_header_length = 12
-rtp_header_fields = {
-    "ver":              HeaderField(0,  6,  2),
-    "p":                HeaderField(0,  5,  1),
-    "x":                HeaderField(0,  4,  1),
-    "cc":               HeaderField(0,  0,  4),
-    "m":                HeaderField(1,  7,  1),
-    "pt":               HeaderField(1,  0,  7),
-    "sequence_number":  HeaderField(2,  0,  16),
-    "timestamp":        HeaderField(4,  0,  32),
-    "ssrc":             HeaderField(8,  0,  32)
-}
-rtp_header = Header(rtp_header_fields,
-                    rtp_header_length,
-                    swap_field_bytes=True)
-
-
-def eth_rtp_description(dw):
-    param_layout = rtp_header.get_layout()
-    payload_layout = [
-        ("data", dw),
-        ("error", dw//8)
-    ]
-    return EndpointDescription(payload_layout, param_layout, packetized=True)
+rtp_jpeg_header_length = 8
+rtp_qtable_header_length = 4
 
+rtp_version = 2
+rtp_payload_type_jpeg = 26
+# Quantization tables in the first packet of each frame.
+rtp_jpeg_q = 255
+# Clock of the timestamps of video payloads.
+rtp_clock = 90000
 
-def eth_rtp_user_description(dw):
-    param_layout = [
-        ("src_port", 16),
-        ("dst_port", 16),
-        ("ip_address", 32),
-        ("length", 16)
-    ]
-    payload_layout = [
-        ("data", dw),
-        ("error", dw//8)
+# JPEG markers
+jpeg_soi = 0xd8
+jpeg_eoi = 0xd9
+jpeg_sof0 = 0xc0
+jpeg_dqt = 0xdb
+jpeg_sos = 0xda
+
+
+def rtp_jpeg_packet_description():
+    """A packet of the scan, as queued by the parser for the sender."""
+    return [
+        ("length", 16),     # bytes of tables and scan data in the packet
+        ("offset", 24),     # fragment offset, in scan bytes
+        ("tables", 1),      # first packet of the frame, carries the tables
+        ("marker", 1),      # last packet of the frame
+        ("timestamp", 32),
+        ("type", 8),
+        ("width", 8),       # in 8 pixel units
+        ("height", 8),
+        ("qt_length", 16),  # bytes of quantization tables
     ]
-    return EndpointDescription(payload_layout, param_layout, packetized=True)
 
 
-class EncoderRTPGenerator(Module):
-    def __init__(self, ip_address, udp_port, fifo_depth=1024):
-        self.sink = sink = Sink([("data", 8)])
-        self.source = source = Source(eth_rtp_user_description(8))
+def be32(v):
+    """The bytes of a 32-bit field in network order, first byte in the LSBs."""
+    return Cat(v[24:32], v[16:24], v[8:16], v[0:8])
+
+
+class RTPTimestamp(Module):
+    """Free running 90 kHz counter from the clk_freq clock."""
+    def __init__(self, clk_freq):
+        self.value = Signal(32)
+
+        # # #
+
+        phase = Signal(max=clk_freq + rtp_clock)
+        self.sync += \
+            If(phase + rtp_clock >= clk_freq,
+                phase.eq(phase + rtp_clock - clk_freq),
+                self.value.eq(self.value + 1)
+            ).Else(
+                phase.eq(phase + rtp_clock)
+            )
+
+
+class JPEGScanParser(Module):
+    """Cuts the scan of a JFIF stream into RTP/JPEG packets.
+
+    data gets the quantization tables and the scan bytes (byte stuffing
+    kept, EOI dropped) with last on the last byte of each packet, packets
+    gets a description of each packet once all of its bytes are in data.
+    """
+    def __init__(self, max_payload, timestamp):
+        self.sink = sink = stream.Endpoint([("data", 8)])
+        self.data = data = stream.Endpoint([("data", 8)])
+        self.packets = packets = stream.Endpoint(rtp_jpeg_packet_description())
 
         # # #
 
-        self.submodules.fifo = fifo = SyncFIFO([("data", 8)], fifo_depth)
-        self.comb += Record.connect(sink, fifo.sink)
+        # the first packet has room for 4 quantization tables
+        assert max_payload > 4*64
+
+        b = sink.data
 
-        self.submodules.level = level = FlipFlop(max=fifo_depth+1)
-        self.comb += level.d.eq(fifo.fifo.level)
+        # frame
+        frame_timestamp = Signal(32)
+        height = Signal(16)
+        width = Signal(16)
+        hv = Signal(8)
+        qt_length = Signal(16)
 
-        self.submodules.counter = counter = Counter(max=fifo_depth)
+        # current packet
+        count = Signal(16)
+        offset = Signal(24)
+        scan_count = Signal(24)
+        first = Signal(reset=1)
 
-        self.submodules.flush_timer = WaitTimer(10000)
-        flush = Signal()
+        # emission of a byte to data, from the fsm
+        emit = Signal()
+        emit_data = Signal(8)
+        emit_scan = Signal()
+        emit_end = Signal()
+        can_emit = Signal()
+        packet_end = Signal()
         self.comb += [
-            flush.eq((fifo.fifo.level > 0) & self.flush_timer.done)
+            can_emit.eq(data.ready & packets.ready),
+            packet_end.eq(emit_end | (emit_scan & (count == max_payload - 1))),
+            data.valid.eq(emit & packets.ready),
+            data.data.eq(emit_data),
+            data.last.eq(packet_end),
+            packets.valid.eq(emit & packet_end & data.ready),
+            packets.length.eq(count + 1),
+            packets.offset.eq(offset),
+            packets.tables.eq(first),
+            packets.marker.eq(emit_end),
+            packets.timestamp.eq(frame_timestamp),
+            packets.type.eq(hv == 0x22),
+            packets.width.eq(width[3:]),
+            packets.height.eq(height[3:]),
+            packets.qt_length.eq(qt_length)
         ]
+        self.sync += \
+            If(emit & can_emit,
+                If(packet_end,
+                    count.eq(0),
+                    offset.eq(scan_count + emit_scan),
+                    first.eq(0)
+                ).Else(
+                    count.eq(count + 1)
+                ),
+                If(emit_scan,
+                    scan_count.eq(scan_count + 1)
+                ),
+                If(emit_end,
+                    offset.eq(0),
+                    scan_count.eq(0),
+                    first.eq(1)
+                )
+            )
 
-        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
-        fsm.act("IDLE",
-          self.flush_timer.wait.eq(fifo.fifo.level > 0),
-            If((fifo.fifo.level >= 256) | flush,
-                level.ce.eq(1),
-                counter.reset.eq(1),
-                NextState("SEND")
+        # segments
+        marker = Signal(8)
+        length = Signal(16)
+        position = Signal(16)
+        dqt_position = Signal(max=65)
+
+        # scan, held one byte back to drop the EOI
+        pending = Signal(8)
+        pending_valid = Signal()
+
+        self.submodules.fsm = fsm = FSM(reset_state="SEARCH")
+        fsm.act("SEARCH",
+            sink.ready.eq(1),
+            If(sink.valid & (b == 0xff),
+                NextState("MARKER")
             )
         )
-        fsm.act("SEND",
-            source.stb.eq(fifo.source.stb),
-            source.sop.eq(counter.value == 0),
-            If(level.q == 0,
-                source.eop.eq(1),
-            ).Else(
-                source.eop.eq(counter.value == (level.q-1)),
+        fsm.act("MARKER",
+            sink.ready.eq(1),
+            If(sink.valid,
+                NextValue(marker, b),
+                If(b == jpeg_soi,
+                    NextValue(frame_timestamp, timestamp),
+                    NextValue(qt_length, 0),
+                    NextState("SEARCH")
+                ).Elif((b == 0xff),
+                    NextState("MARKER")
+                ).Elif((b == jpeg_eoi) | (b == 0x01) | ((b & 0xf8) == 0xd0),
+                    # standalone markers
+                    NextState("SEARCH")
+                ).Else(
+                    NextState("LENGTH_H")
+                )
+            )
+        )
+        fsm.act("LENGTH_H",
+            sink.ready.eq(1),
+            If(sink.valid,
+                NextValue(length[8:], b),
+                NextState("LENGTH_L")
+            )
+        )
+        fsm.act("LENGTH_L",
+            sink.ready.eq(1),
+            If(sink.valid,
+                NextValue(length[:8], b),
+                NextValue(position, 2),
+                NextValue(dqt_position, 0),
+                NextValue(pending_valid, 0),
+                If(Cat(b, length[8:]) <= 2,
+                    If(marker == jpeg_sos,
+                        NextState("SCAN")
+                    ).Else(
+                        NextState("SEARCH")
+                    )
+                ).Else(
+                    NextState("SEGMENT")
+                )
+            )
+        )
+        fsm.act("SEGMENT",
+            sink.ready.eq(1),
+            # table bytes of a DQT, not its Pq/Tq bytes
+            If((marker == jpeg_dqt) & (dqt_position != 0),
+                emit.eq(sink.valid),
+                emit_data.eq(b),
+                sink.ready.eq(can_emit)
             ),
-            source.src_port.eq(udp_port),
-            source.dst_port.eq(udp_port),
-            source.ip_address.eq(ip_address),
-            If(level.q == 0,
-                source.length.eq(1),
+            If(sink.valid & sink.ready,
+                NextValue(position, position + 1),
+                If(dqt_position == 64,
+                    NextValue(dqt_position, 0)
+                ).Else(
+                    NextValue(dqt_position, dqt_position + 1)
+                ),
+                If((marker == jpeg_dqt) & (dqt_position != 0),
+                    NextValue(qt_length, qt_length + 1)
+                ),
+                If(marker == jpeg_sof0,
+                    Case(position, {
+                        3: NextValue(height[8:], b),
+                        4: NextValue(height[:8], b),
+                        5: NextValue(width[8:], b),
+                        6: NextValue(width[:8], b),
+                        9: NextValue(hv, b),
+                    })
+                ),
+                If(position == length - 1,
+                    If(marker == jpeg_sos,
+                        NextState("SCAN")
+                    ).Else(
+                        NextState("SEARCH")
+                    )
+                )
+            )
+        )
+        fsm.act("SCAN",
+            If(b == 0xff,
+                sink.ready.eq(1),
+                If(sink.valid,
+                    NextState("SCAN_FF")
+                )
             ).Else(
-                source.length.eq(level.q),
-            ),
-            source.data.eq(fifo.source.data),
-            fifo.source.ack.eq(source.ack),
-            If(source.stb & source.ack,
-                counter.ce.eq(1),
-                If(source.eop,
-                    NextState("IDLE")
+                emit.eq(sink.valid & pending_valid),
+                emit_data.eq(pending),
+                emit_scan.eq(1),
+                sink.ready.eq(can_emit | ~pending_valid),
+                If(sink.valid & sink.ready,
+                    NextValue(pending, b),
+                    NextValue(pending_valid, 1)
+                )
+            )
+        )
+        fsm.act("SCAN_FF",
+            emit_data.eq(pending),
+            emit_scan.eq(1),
+            If(b == jpeg_eoi,
+                # end of the frame, pending is its last byte
+                emit.eq(sink.valid & pending_valid),
+                emit_end.eq(1),
+                sink.ready.eq(can_emit | ~pending_valid),
+                If(sink.valid & sink.ready,
+                    NextValue(pending_valid, 0),
+                    NextState("SEARCH")
+                )
+            ).Elif(pending_valid,
+                # stuffed 0xff (or a restart marker), send what came
+                # before, then the 0xff
+                emit.eq(sink.valid),
+                If(sink.valid & can_emit,
+                    NextValue(pending_valid, 0)
+                )
+            ).Else(
+                emit.eq(sink.valid),
+                emit_data.eq(0xff),
+                sink.ready.eq(can_emit),
+                If(sink.valid & sink.ready,
+                    NextValue(pending, b),
+                    NextValue(pending_valid, 1),
+                    NextState("SCAN")
                 )
             )
         )
 
 
-class EncoderRTPPacketizer(Packetizer):
-    def __init__(self):
-        Packetizer.__init__(self,
-            eth_rtp_description(8),
-            eth_udp_user_description(8),
-            rtp_header)
+class RTPJPEGPacketizer(Module, AutoCSR):
+    """Streams the JFIF frames of sink to a LiteEth UDP port as RTP/JPEG.
 
+    sink is the byte stream of the encoder (moved to the sys clock domain
+    beforehand), source goes to a 32-bit user port of the UDP crossbar.
+    Nothing is sent while enable is low, the frames are dropped.
+    """
+    def __init__(self, clk_freq, max_payload=1400, fifo_depth=4096):
+        self.sink = sink = stream.Endpoint([("data", 8)])
+        self.source = source = stream.Endpoint(eth_udp_user_description(32))
 
-class EncoderRTPSender(Module):
-    def __init__(self):
-        self.sink = sink = Sink(eth_rtp_user_description(8))
-        self.source = source = Source(eth_udp_user_description(8))
+        self.enable = CSRStorage()
+        self.ip_address = CSRStorage(32)
+        self.udp_port = CSRStorage(16)
+        self.ssrc = CSRStorage(32, reset=1)
 
         # # #
 
-        timestamp = Signal(32)
-        self.sync += timestamp.eq(timestamp+1)
+        assert fifo_depth > max_payload
 
-        sequence_number = Counter(16)
-        self.submodules += sequence_number
+        self.submodules.timestamp = timestamp = RTPTimestamp(clk_freq)
+        self.submodules.parser = parser = JPEGScanParser(max_payload, timestamp.value)
+        self.comb += sink.connect(parser.sink)
 
-        self.submodules.packetizer = packetizer = EncoderRTPPacketizer()
+        data_fifo = stream.SyncFIFO([("data", 8)], fifo_depth, buffered=True)
+        packets_fifo = stream.SyncFIFO(rtp_jpeg_packet_description(), 16)
+        converter = stream.Converter(8, 32, report_valid_token_count=True)
+        self.submodules += data_fifo, packets_fifo, converter
         self.comb += [
-            packetizer.sink.stb.eq(sink.stb),
-            packetizer.sink.sop.eq(sink.sop),
-            packetizer.sink.eop.eq(sink.eop),
-            sink.ack.eq(packetizer.sink.ack),
-            packetizer.sink.ver.eq(0x2),
-            packetizer.sink.p.eq(0),
-            packetizer.sink.x.eq(0),
-            packetizer.sink.cc.eq(0),
-            packetizer.sink.m.eq(0),
-            packetizer.sink.pt.eq(26), #JPEG
-            packetizer.sink.sequence_number.eq(sequence_number.value),
-            packetizer.sink.timestamp.eq(timestamp),
-            packetizer.sink.ssrc.eq(1),
-            packetizer.sink.data.eq(sink.data)
+            parser.data.connect(data_fifo.sink),
+            parser.packets.connect(packets_fifo.sink),
+            data_fifo.source.connect(converter.sink)
+        ]
+
+        packet = packets_fifo.source
+        sequence_number = Signal(16)
+        header = Array([
+            Cat(C(rtp_version << 6, 8),
+                C(rtp_payload_type_jpeg, 7), packet.marker,
+                sequence_number[8:16], sequence_number[0:8]),
+            be32(packet.timestamp),
+            be32(self.ssrc.storage),
+            Cat(C(0, 8), packet.offset[16:24], packet.offset[8:16], packet.offset[0:8]),
+            Cat(packet.type, C(rtp_jpeg_q, 8), packet.width, packet.height),
+            Cat(C(0, 8), C(0, 8), packet.qt_length[8:16], packet.qt_length[0:8])
+        ])
+        header_words = (rtp_header_length + rtp_jpeg_header_length)//4
+        header_index = Signal(max=len(header))
+        last_header = Signal()
+        self.comb += last_header.eq(header_index ==
+            Mux(packet.tables, header_words, header_words - 1))
+
+        self.comb += [
+            source.src_port.eq(self.udp_port.storage),
+            source.dst_port.eq(self.udp_port.storage),
+            source.ip_address.eq(self.ip_address.storage),
+            source.length.eq(rtp_header_length + rtp_jpeg_header_length +
+                Mux(packet.tables, rtp_qtable_header_length, 0) + packet.length)
         ]
 
         self.submodules.fsm = fsm = FSM(reset_state="IDLE")
         fsm.act("IDLE",
-            packetizer.source.ack.eq(1),
-            If(packetizer.source.stb & packetizer.source.sop,
-                packetizer.source.ack.eq(0),
-                NextState("SEND")
+            NextValue(header_index, 0),
+            If(packet.valid,
+                If(self.enable.storage,
+                    NextState("HEADER")
+                ).Else(
+                    NextState("DROP")
+                )
             )
         )
-        fsm.act("SEND",
-            Record.connect(packetizer.source, source),
-            source.src_port.eq(sink.src_port),
-            source.dst_port.eq(sink.dst_port),
-            source.ip_address.eq(sink.ip_address),
-            source.length.eq(sink.length + rtp_header.length),
-            If(source.stb & source.eop & source.ack,
-                sequence_number.ce.eq(1),
-                NextState("IDLE"),
+        fsm.act("HEADER",
+            source.valid.eq(1),
+            source.data.eq(header[header_index]),
+            If(source.ready,
+                NextValue(header_index, header_index + 1),
+                If(last_header,
+                    NextState("DATA")
+                )
+            )
+        )
+        fsm.act("DATA",
+            source.valid.eq(converter.source.valid),
+            source.data.eq(converter.source.data),
+            source.last.eq(converter.source.last),
+            If(converter.source.last,
+                source.last_be.eq(1 << (converter.source.valid_token_count - 1))
+            ),
+            converter.source.ready.eq(source.ready),
+            If(source.valid & source.ready & source.last,
+                packet.ready.eq(1),
+                NextValue(sequence_number, sequence_number + 1),
+                NextState("IDLE")
             )
-        )
\ No newline at end of file
+        )
+        fsm.act("DROP",
+            converter.source.ready.eq(1),
+            If(converter.source.valid & converter.source.last,
+                packet.ready.eq(1),
+                NextState("IDLE")
+            )
+        )
@@ -1,18 +1,37 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
+import hashlib
+import importlib
+import importlib.util
+import json
 import os
+import re
+import shutil
+import subprocess
+import types
 
-from litex.build.tools import write_to_file
-from litex.soc.integration.soc_sdram import *
-from litex.soc.integration.builder import *
+# LiteX is only imported by the functions which need it, so the tools
+# which just find the files of a build (flash.py, mkimage.py, ...) start
+# without loading it.
 
+from targets.utils import _platform_toolchain_cmd_split
 
-def get_args(parser, platform='opsis', target='hdmi2usb'):
+
+def get_args(parser, platform='opsis', target='hdmi2usb', soc_args=True):
+    """Arguments selecting a build, soc_args=False leaves out the SoC
+    options but the CPU, which don't need LiteX."""
     parser.add_argument("--platform", action="store", default=os.environ.get('PLATFORM', platform))
     parser.add_argument("--target", action="store", default=os.environ.get('TARGET', target))
 
-    soc_sdram_args(parser)
+    if soc_args:
+        from litex.soc.integration.soc_sdram import soc_sdram_args
+        soc_sdram_args(parser)
+    else:
+        parser.add_argument("--cpu-type", default=None)
+        parser.add_argument("--cpu-variant", default=None)
+    parser.set_defaults(soc_args=soc_args)
     parser.set_defaults(cpu_type=os.environ.get('CPU', 'lm32'))
     parser.set_defaults(cpu_variant=os.environ.get('CPU_VARIANT', None) or None)
 
@@ -46,20 +65,208 @@ def get_testdir(args):
     return testdir
 
 
+def get_platforms():
+    """Names of the platforms which have targets."""
+    names = set()
+    for path in importlib.util.find_spec("targets").submodule_search_locations:
+        for name in os.listdir(path):
+            if name in ("common", "__pycache__"):
+                continue
+            if os.path.isdir(os.path.join(path, name)):
+                names.add(name)
+    return sorted(names)
+
+
+def get_targets(platform):
+    """Names of the modules of a platform which define a SoC."""
+    names = set()
+    for path in importlib.util.find_spec("targets.{}".format(platform)).submodule_search_locations:
+        for filename in os.listdir(path):
+            name, ext = os.path.splitext(filename)
+            if ext != ".py" or name.startswith("__"):
+                continue
+            if re.search(r"^SoC\s*=", open(os.path.join(path, filename)).read(), re.M):
+                names.add(name)
+    return sorted(names)
+
+
+@functools.lru_cache()
+def get_platform_module(name):
+    return importlib.import_module("platforms.{}".format(name))
+
+
+@functools.lru_cache()
+def get_target_module(platform, target):
+    return importlib.import_module("targets.{}.{}".format(platform, target.lower()))
+
+
 def get_platform(args):
     assert args.platform is not None
-    exec("from platforms.{} import Platform".format(args.platform), globals())
+    Platform = get_platform_module(args.platform).Platform
     return Platform(**dict(args.platform_option))
 
 
 def get_soc(args, platform):
-    exec("from targets.{}.{} import SoC".format(args.platform, args.target.lower(), args.target), globals())
+    from litex.soc.integration.soc_sdram import soc_sdram_argdict
+    SoC = get_target_module(args.platform, args.target).SoC
     soc = SoC(platform, ident=SoC.__name__, **soc_sdram_argdict(args), **dict(args.target_option))
     if hasattr(soc, 'configure_iprange'):
         soc.configure_iprange(args.iprange)
     return soc
 
 
+PLATFORM_INDEX = os.path.join("build", "platforms.json")
+# Static Platform class attributes which are stored in the index.
+PLATFORM_INFO = (
+    "name",
+    "default_clk_name",
+    "default_clk_period",
+    "gateware_size",
+    "spiflash_model",
+    "spiflash_read_dummy_bits",
+    "spiflash_clock_div",
+    "spiflash_total_size",
+    "spiflash_page_size",
+    "spiflash_sector_size",
+)
+
+
+def get_platform_info(args):
+    """Static attributes of the Platform class, without importing it.
+
+    The attributes are kept in build/platforms.json and only read from
+    the platform module when its source changed since it was indexed.
+    """
+    assert args.platform is not None
+    filename = importlib.util.find_spec("platforms.{}".format(args.platform)).origin
+    source = hashlib.sha256(open(filename, "rb").read()).hexdigest()
+
+    try:
+        index = json.load(open(PLATFORM_INDEX))
+    except (OSError, ValueError):
+        index = {}
+
+    entry = index.get(args.platform, {})
+    if entry.get("source") != source:
+        Platform = get_platform_module(args.platform).Platform
+        entry = {
+            "source": source,
+            "info": {a: getattr(Platform, a) for a in PLATFORM_INFO if hasattr(Platform, a)},
+        }
+        index[args.platform] = entry
+
+        os.makedirs(os.path.dirname(PLATFORM_INDEX), exist_ok=True)
+        tmpfile = "{}.tmp{}".format(PLATFORM_INDEX, os.getpid())
+        with open(tmpfile, "w") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmpfile, PLATFORM_INDEX)
+
+    return types.SimpleNamespace(**entry["info"])
+
+
+def get_soc_manifest(args):
+    return os.path.join(get_testdir(args), "soc.json")
+
+
+def get_soc_key(args):
+    """Hash of the options which change the SoC built in a build directory."""
+    from litex.soc.integration.soc_sdram import soc_sdram_argdict
+    options = [
+        sorted(soc_sdram_argdict(args).items()),
+        sorted(args.platform_option),
+        sorted(args.target_option),
+        args.iprange,
+    ]
+    return hashlib.sha256(repr(options).encode()).hexdigest()
+
+
+def write_soc_manifest(args, soc):
+    """Save the memory regions and constants of an elaborated SoC."""
+    manifest = {
+        "key": get_soc_key(args),
+        "mem_regions": {
+            name: {
+                "origin": region.origin,
+                "size": region.size,
+                "type": getattr(region, "type", None),
+            } for name, region in soc.mem_regions.items()
+        },
+        "constants": {
+            name: getattr(value, "value", value) for name, value in soc.constants.items()
+        },
+    }
+    filename = get_soc_manifest(args)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True, default=str)
+
+
+def check_csr_map(args):
+    """Lint the CSR and memory map of a build with test/check_csrs.py."""
+    testdir = get_testdir(args)
+    for filename in ("csr.json", "csr.csv"):
+        filename = os.path.join(testdir, filename)
+        if os.path.exists(filename):
+            break
+    else:
+        return
+    spec = importlib.util.spec_from_file_location("check_csrs", os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "test", "check_csrs.py"))
+    check_csrs = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(check_csrs)
+    errors, words = check_csrs.check(
+        check_csrs.load(filename), check_csrs.get_limits(args.platform))
+    for kind, msg in errors:
+        print("WARNING: {}: {}: {}".format(filename, kind, msg))
+
+
+def get_soc_args():
+    """The build arguments with the SoC options, for the tools which left
+    them out, parsed again from the command line."""
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    get_args(parser)
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def get_soc_info(args):
+    """Memory regions and constants of the SoC for a build.
+
+    They are read from the manifest make.py writes next to csr.csv. The SoC
+    is only elaborated when the manifest is missing, was written for
+    different options or is older than csr.csv.
+
+    Without the SoC options (get_args(soc_args=False)) the manifest is
+    taken as long as it is newer than csr.csv, it describes the last build
+    of the directory, whose files the tools use. When it has to be
+    elaborated, the SoC options are parsed from the command line then.
+    """
+    filename = get_soc_manifest(args)
+    csr_csv = os.path.join(get_testdir(args), "csr.csv")
+    try:
+        manifest = json.load(open(filename))
+        fresh = not args.soc_args or manifest["key"] == get_soc_key(args)
+        if os.path.exists(csr_csv):
+            fresh = fresh and os.path.getmtime(filename) >= os.path.getmtime(csr_csv)
+    except (OSError, ValueError, KeyError):
+        fresh = False
+
+    if not fresh:
+        if not args.soc_args:
+            args = get_soc_args()
+        soc = get_soc(args, get_platform(args))
+        return types.SimpleNamespace(
+            mem_regions=soc.mem_regions,
+            constants={n: getattr(v, "value", v) for n, v in soc.constants.items()})
+
+    return types.SimpleNamespace(
+        mem_regions={
+            name: types.SimpleNamespace(**region)
+            for name, region in manifest["mem_regions"].items()
+        },
+        constants=manifest["constants"])
+
+
 def get_prog(args, platform):
     assert platform is not None
     prog = platform.create_programmer()
@@ -110,24 +317,175 @@ def get_firmware(builddir, filetype="flash"):
         assert False, "Unknown file type %s" % filetype
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Opsis LiteX SoC", conflict_handler='resolve')
-    get_args(parser)
-    builder_args(parser)
-    soc_sdram_args(parser)
-
-    args = parser.parse_args()
-
-    platform = get_platform(args)
-
-    soc = get_soc(args, platform)
-
-    builddir = get_builddir(args)
-    testdir = get_testdir(args)
-
+# Files in the gateware directory which are inputs to the FPGA toolchain.
+GATEWARE_CACHE_INPUTS = (
+    ".v", ".vhd", ".vhdl", ".init",
+    ".ucf", ".xdc", ".lpf",
+    ".prj", ".xst", ".ys", ".tcl", ".sh",
+)
+# Inputs of some toolchains which other toolchains write as outputs (ISE
+# map writes a .pcf next to the sources).
+GATEWARE_CACHE_TOOLCHAIN_INPUTS = {
+    "icestorm": (".pcf",),
+}
+# Files in the gateware directory which are produced by the FPGA toolchain.
+GATEWARE_CACHE_OUTPUTS = (".bit", ".bin")
+
+
+def get_gateware_cache_inputs(platform):
+    inputs = GATEWARE_CACHE_INPUTS
+    toolchain = type(platform.toolchain).__module__.split(".")[-1]
+    return inputs + GATEWARE_CACHE_TOOLCHAIN_INPUTS.get(toolchain, ())
+
+
+def get_gateware_cache_key(platform, gatewaredir, build_options):
+    """Hash everything the FPGA toolchain consumes for a build.
+
+    Files are hashed by basename so the key doesn't depend on where the
+    repository is checked out. It has to be computed before the toolchain
+    runs, the gateware directory also holds its outputs afterwards.
+    """
+    h = hashlib.sha256()
+
+    def add_file(filename):
+        h.update(os.path.basename(filename).encode())
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1024*1024), b""):
+                h.update(block)
+
+    inputs = get_gateware_cache_inputs(platform)
+    for filename in sorted(os.listdir(gatewaredir)):
+        if os.path.splitext(filename)[1] in inputs:
+            add_file(os.path.join(gatewaredir, filename))
+    for filename, language, library in sorted(platform.sources):
+        add_file(filename)
+
+    h.update(repr(getattr(platform.toolchain, "build_template", None)).encode())
+    h.update(repr(sorted(build_options)).encode())
+    return h.hexdigest()
+
+
+def gateware_cache_restore(cachedir, key, gatewaredir):
+    entrydir = os.path.join(cachedir, key)
+    if not os.path.isdir(entrydir):
+        return False
+    for filename in os.listdir(entrydir):
+        # copyfile (rather than copy2) so the restored files are newer
+        # than their inputs as far as make is concerned.
+        shutil.copyfile(
+            os.path.join(entrydir, filename),
+            os.path.join(gatewaredir, filename))
+    return True
+
+
+def gateware_cache_store(cachedir, key, gatewaredir, build_name="top"):
+    entrydir = os.path.join(cachedir, key)
+    if os.path.isdir(entrydir):
+        return
+    tmpdir = "{}.tmp{}".format(entrydir, os.getpid())
+    os.makedirs(tmpdir, exist_ok=True)
+    for ext in GATEWARE_CACHE_OUTPUTS:
+        filename = os.path.join(gatewaredir, build_name + ext)
+        if os.path.exists(filename):
+            shutil.copyfile(filename, os.path.join(tmpdir, build_name + ext))
+    try:
+        os.rename(tmpdir, entrydir)
+    except OSError:
+        # Another build stored the same entry first.
+        shutil.rmtree(tmpdir)
+
+
+def run_gateware_cached(args, gatewaredir, key, run):
+    """Restore the bitstream of key from the cache, or run() the toolchain and store it."""
+    if gateware_cache_restore(args.gateware_cache_dir, key, gatewaredir):
+        print("Gateware restored from cache ({})".format(key))
+        return 0
+    r = run()
+    if r == 0:
+        gateware_cache_store(args.gateware_cache_dir, key, gatewaredir)
+    return r
+
+
+class ToolchainScript:
+    """Stands in for subprocess in the modules of a toolchain, to decide
+    whether the build script it generated runs.
+
+    hook(run) is called instead of running the build_* script, once the
+    toolchain has written all of its inputs. run() runs the script and
+    returns its exit code, hook returns the exit code the toolchain sees.
+    """
+    class Done:
+        def __init__(self, returncode, stdout=None, stderr=None):
+            self.returncode = returncode
+            self.stdout = stdout
+            self.stderr = stderr
+
+        def communicate(self, *args, **kw):
+            return self.stdout, self.stderr
+
+        def wait(self, *args, **kw):
+            return self.returncode
+
+        poll = wait
+
+    def __init__(self, toolchain, hook):
+        self.modules = []
+        for cls in type(toolchain).__mro__:
+            module = importlib.import_module(cls.__module__)
+            if getattr(module, "subprocess", None) is subprocess and module not in self.modules:
+                self.modules.append(module)
+        self.hook = hook
+
+    def __enter__(self):
+        for module in self.modules:
+            module.subprocess = self
+        return self
+
+    def __exit__(self, *args):
+        for module in self.modules:
+            module.subprocess = subprocess
+
+    def __getattr__(self, name):
+        return getattr(subprocess, name)
+
+    @staticmethod
+    def is_build_script(cmd):
+        if isinstance(cmd, str):
+            cmd = cmd.split()
+        return any(re.match(r"^build_.*\.(sh|bat)$", os.path.basename(str(part))) for part in cmd)
+
+    def Popen(self, cmd, *args, **kw):
+        if not self.is_build_script(cmd):
+            return subprocess.Popen(cmd, *args, **kw)
+        empty = "" if kw.get("universal_newlines") or kw.get("text") else b""
+        output = [empty, empty]
+
+        def run():
+            r = subprocess.run(cmd, *args, **kw)
+            output[:] = r.stdout, r.stderr
+            return r.returncode
+        return self.Done(self.hook(run), *output)
+
+    def call(self, cmd, *args, **kw):
+        if not self.is_build_script(cmd):
+            return subprocess.call(cmd, *args, **kw)
+        return self.hook(lambda: subprocess.call(cmd, *args, **kw))
+
+    def check_call(self, cmd, *args, **kw):
+        if not self.is_build_script(cmd):
+            return subprocess.check_call(cmd, *args, **kw)
+        r = self.hook(lambda: subprocess.call(cmd, *args, **kw))
+        if r:
+            raise subprocess.CalledProcessError(r, cmd)
+        return 0
+
+
+def build(args, platform, soc, builddir, testdir, compile_gateware):
+    from litex.soc.integration.builder import Builder, builder_argdict
     buildargs = builder_argdict(args)
     if not buildargs.get('output_dir', None):
         buildargs['output_dir'] = builddir
+    buildargs['compile_gateware'] = compile_gateware
 
     if hasattr(soc, 'cpu_type'):
         if not buildargs.get('csr_csv', None):
@@ -164,11 +522,265 @@ def main():
                 builder.add_software_package("firmware", "{}/firmware".format(os.getcwd()))
             else:
                 builder.add_software_package("stub", "{}/firmware/stub".format(os.getcwd()))
-        vns = builder.build(**dict(args.build_option))
+        return builder.build(**dict(args.build_option))
+    else:
+        return platform.build(soc, build_dir=os.path.join(builddir, "gateware"), run=compile_gateware)
+
+
+def build_all(args, builddir, testdir):
+    platform = get_platform(args)
+    soc = get_soc(args, platform)
+
+    from litex.soc.integration.builder import builder_argdict
+    compile_gateware = builder_argdict(args)['compile_gateware']
+    if not compile_gateware or args.no_gateware_cache:
+        vns = build(args, platform, soc, builddir, testdir, compile_gateware)
+        return platform, soc, vns
+
+    # The toolchain changes directory, and runs its build script only
+    # when no cached bitstream matches the inputs it just generated.
+    gatewaredir = os.path.abspath(os.path.join(builddir, "gateware"))
+
+    def hook(run):
+        key = get_gateware_cache_key(platform, gatewaredir, args.build_option)
+        return run_gateware_cached(args, gatewaredir, key, run)
+
+    with ToolchainScript(platform.toolchain, hook):
+        vns = build(args, platform, soc, builddir, testdir, True)
+    return platform, soc, vns
+
+
+STAGES = ["elaborate", "synthesize", "place-and-route", "pack"]
+
+
+def get_toolchain_stages(platform, gatewaredir, build_name="top"):
+    """Split the generated toolchain build script into stages.
+
+    Returns a dictionary of stage name to the list of commands from the
+    build script for toolchains driven by a build_template (yosys,
+    nextpnr, icepack, ...). The first command of the template is the
+    synthesis, the last one packs the bitstream and everything in between
+    is place-and-route.
+
+    Returns None for toolchains (such as ISE and Vivado) which have to be
+    run as a whole.
+    """
+    template = getattr(platform.toolchain, "build_template", None)
+    if not template:
+        return None
+    cmds = _platform_toolchain_cmd_split(template)
+
+    script = os.path.join(gatewaredir, "build_{}.sh".format(build_name))
+    preamble = []
+    stages = {stage: [] for stage in STAGES[1:]}
+    for line in open(script).readlines():
+        parts = line.split()
+        if not parts or parts[0] not in cmds:
+            preamble.append(line)
+            continue
+        i, _ = cmds[parts[0]]
+        if i == 0:
+            stage = "synthesize"
+        elif i == len(cmds) - 1:
+            stage = "pack"
+        else:
+            stage = "place-and-route"
+        stages[stage].append(line)
+
+    return {stage: preamble + lines for stage, lines in stages.items() if lines}
+
+
+def get_file_digest(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_gateware_files(gatewaredir):
+    files = {}
+    for filename in os.listdir(gatewaredir):
+        st = os.stat(os.path.join(gatewaredir, filename))
+        files[filename] = (st.st_mtime_ns, st.st_size)
+    return files
+
+
+def get_stage_key(stage, script, inputs):
+    """Hash the commands of a stage and what it consumes.
+
+    inputs is the gateware cache key for the first toolchain stage and the
+    stamp of the stage before it for the others, so a stage is stale when
+    the stage before it produced different files.
+    """
+    h = hashlib.sha256()
+    h.update(stage.encode())
+    h.update("".join(script).encode())
+    h.update(json.dumps(inputs, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def get_stage_stamp(gatewaredir, stage):
+    return os.path.join(gatewaredir, "{}.stamp".format(stage))
+
+
+def read_stage_stamp(gatewaredir, stage):
+    try:
+        stamp = json.load(open(get_stage_stamp(gatewaredir, stage)))
+        return {"inputs": stamp["inputs"], "outputs": stamp["outputs"]}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_stage_stamp(gatewaredir, stage, key, outputs):
+    with open(get_stage_stamp(gatewaredir, stage), "w") as f:
+        json.dump({"stage": stage, "inputs": key, "outputs": outputs}, f)
+
+
+def stage_up_to_date(gatewaredir, stage, key):
+    """Whether stage finished with these inputs and its outputs are untouched."""
+    stamp = read_stage_stamp(gatewaredir, stage)
+    if stamp is None or stamp["inputs"] != key:
+        return False
+    for filename, digest in stamp["outputs"].items():
+        filename = os.path.join(gatewaredir, filename)
+        if not os.path.isfile(filename) or get_file_digest(filename) != digest:
+            return False
+    return True
+
+
+def run_stage(gatewaredir, stage, key, run):
+    """run() a stage and stamp it with its inputs and the files it wrote."""
+    before = get_gateware_files(gatewaredir)
+    r = run()
+    if r == 0:
+        after = get_gateware_files(gatewaredir)
+        outputs = {
+            filename: get_file_digest(os.path.join(gatewaredir, filename))
+            for filename in sorted(after)
+            if after[filename] != before.get(filename) and not filename.endswith(".stamp")}
+        write_stage_stamp(gatewaredir, stage, key, outputs)
+    return r
+
+
+def run_vendor_toolchain(args, platform, gatewaredir, run):
+    """Run a vendor toolchain as a whole, through the gateware cache."""
+    key = get_gateware_cache_key(platform, gatewaredir, args.build_option)
+    if args.resume and stage_up_to_date(gatewaredir, "pack", key):
+        print("Stage synthesize/place-and-route/pack: up to date")
+        return 0
+    print("Stage synthesize/place-and-route/pack")
+    if args.no_gateware_cache:
+        return run_stage(gatewaredir, "pack", key, run)
+    return run_stage(gatewaredir, "pack", key,
+        lambda: run_gateware_cached(args, gatewaredir, key, run))
+
+
+def build_stages(args, builddir, testdir):
+    """Run the selected build stages, skipping finished ones on --resume.
+
+    Elaboration is always run when selected, as its inputs are the Python
+    sources of the whole tree. The later stages are skipped when their
+    inputs are unchanged since the stage last finished and the files it
+    wrote are still there.
+
+    Vendor toolchains (ISE, Vivado) are run as a whole from the build
+    script of the elaboration, and go through the gateware cache.
+    """
+    stages = args.only_stage or STAGES
+    gatewaredir = os.path.abspath(os.path.join(builddir, "gateware"))
+
+    platform = get_platform(args)
+    soc = vns = None
+    vendor = not getattr(platform.toolchain, "build_template", None)
+    run_toolchain = any(stage in stages for stage in STAGES[1:])
+
+    if vendor:
+        def hook(run):
+            if not run_toolchain:
+                return 0
+            return run_vendor_toolchain(args, platform, gatewaredir, run)
+
+        if "elaborate" in stages:
+            print("Stage elaborate")
+            soc = get_soc(args, platform)
+            # The toolchain only writes its build script when it runs it.
+            with ToolchainScript(platform.toolchain, hook):
+                vns = build(args, platform, soc, builddir, testdir, True)
+        elif run_toolchain:
+            script = os.path.join(gatewaredir, "build_top.sh")
+            if not os.path.exists(script):
+                raise SystemExit("No {}, run the elaborate stage first".format(script))
+            r = hook(lambda: subprocess.call(["bash", script], cwd=gatewaredir))
+            if r:
+                raise subprocess.CalledProcessError(r, script)
+        return platform, soc, vns
+
+    if "elaborate" in stages:
+        print("Stage elaborate")
+        soc = get_soc(args, platform)
+        vns = build(args, platform, soc, builddir, testdir, False)
+
+    toolchain_stages = get_toolchain_stages(platform, gatewaredir)
+    inputs = get_gateware_cache_key(platform, gatewaredir, args.build_option)
+    for stage in STAGES[1:]:
+        if stage not in toolchain_stages:
+            continue
+        script = toolchain_stages[stage]
+        key = get_stage_key(stage, script, inputs)
+        inputs = read_stage_stamp(gatewaredir, stage)
+        if stage not in stages:
+            continue
+        if args.resume and stage_up_to_date(gatewaredir, stage, key):
+            print("Stage {}: up to date".format(stage))
+            continue
+        print("Stage {}".format(stage))
+        r = run_stage(gatewaredir, stage, key,
+            lambda: subprocess.call(["bash", "-c", "".join(script)], cwd=gatewaredir))
+        if r:
+            raise subprocess.CalledProcessError(r, stage)
+        inputs = read_stage_stamp(gatewaredir, stage)
+
+    return platform, soc, vns
+
+
+def main():
+    from litex.soc.integration.builder import builder_args
+    from litex.soc.integration.soc_sdram import soc_sdram_args
+
+    parser = argparse.ArgumentParser(description="Opsis LiteX SoC", conflict_handler='resolve')
+    get_args(parser)
+    builder_args(parser)
+    soc_sdram_args(parser)
+
+    parser.add_argument("--gateware-cache-dir",
+                        default=os.environ.get('GATEWARE_CACHE_DIR', os.path.join("build", "gateware-cache")),
+                        help="directory of cached bitstreams, keyed by toolchain inputs")
+    parser.add_argument("--no-gateware-cache", action="store_true", help="always run the FPGA toolchain")
+    parser.add_argument("--only-stage", action="append", default=[], choices=STAGES,
+                        help="only run the given build stage (can be given multiple times)")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip build stages whose inputs didn't change since they last finished")
+
+    args = parser.parse_args()
+    # The toolchains change directory while building.
+    args.gateware_cache_dir = os.path.abspath(args.gateware_cache_dir)
+
+    builddir = get_builddir(args)
+    testdir = get_testdir(args)
+
+    if args.resume or args.only_stage:
+        platform, soc, vns = build_stages(args, builddir, testdir)
+        if soc is None:
+            return
     else:
-        vns = platform.build(soc, build_dir=os.path.join(builddir, "gateware"))
+        platform, soc, vns = build_all(args, builddir, testdir)
+
+    write_soc_manifest(args, soc)
+    check_csr_map(args)
 
     if hasattr(soc, 'pcie_phy'):
+        from litex.build.tools import write_to_file
         from litex.soc.integration.export import get_csr_header, get_soc_header
         csr_header = get_csr_header(soc.csr_regions, soc.constants, with_access_functions=False)
         soc_header = get_soc_header(soc.constants, with_access_functions=False)
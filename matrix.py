@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Build many platform/target/cpu configurations in parallel.
+
+Each configuration is built by its own make.py process into its own build
+directory, so builds share nothing and can run side by side.
+"""
+
+import argparse
+import collections
+import datetime
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import make
+
+
+# Default number of concurrent builds for each toolchain.
+TOOLCHAIN_JOBS = {
+    "ise": 4,
+    "vivado": 2,
+}
+
+# Rough peak memory use (in MB) of one build with each toolchain.
+TOOLCHAIN_MEMORY = {
+    "ise": 2048,
+    "vivado": 4096,
+    "icestorm": 1024,
+    "verilator": 2048,
+}
+
+# Default toolchain for each of the platform base classes.
+PLATFORM_TOOLCHAINS = {
+    "XilinxPlatform": "ise",
+    "LatticePlatform": "icestorm",
+}
+
+
+Config = collections.namedtuple("Config", ["platform", "target", "cpu", "cpu_variant"])
+
+
+def get_toolchain(platform):
+    """Guess which toolchain builds a platform without importing it."""
+    filename = os.path.join("platforms", platform + ".py")
+    if not os.path.exists(filename):
+        return "verilator"
+    src = open(filename).read()
+    m = re.search(r'^class Platform\((\w+)\):', src, re.M)
+    if not m:
+        return "verilator"
+    m_toolchain = re.search(r'def __init__\(self,[^)]*toolchain="(\w+)"', src)
+    if m_toolchain:
+        return m_toolchain.group(1)
+    return PLATFORM_TOOLCHAINS.get(m.group(1), "verilator")
+
+
+def parse_config(s, cpus):
+    """
+    >>> parse_config("arty:net:vexriscv.linux", ["lm32"])
+    [Config(platform='arty', target='net', cpu='vexriscv', cpu_variant='linux')]
+    >>> parse_config("opsis:video", ["lm32", "or1k"])
+    [Config(platform='opsis', target='video', cpu='lm32', cpu_variant=None), Config(platform='opsis', target='video', cpu='or1k', cpu_variant=None)]
+    """
+    parts = s.split(":")
+    assert 1 <= len(parts) <= 3, "Invalid configuration {!r}".format(s)
+    platform = parts[0]
+    if len(parts) > 1:
+        targets = [parts[1]]
+    else:
+        targets = make.get_targets(platform)
+    if len(parts) > 2:
+        cpus = [parts[2]]
+
+    configs = []
+    for target in targets:
+        for full_cpu in cpus:
+            cpu, _, cpu_variant = full_cpu.partition(".")
+            configs.append(Config(platform, target, cpu, cpu_variant or None))
+    return configs
+
+
+def parse_limits(values, defaults):
+    """
+    >>> sorted(parse_limits(["vivado=1", "icestorm=8"], {"vivado": 2, "ise": 4}).items())
+    [('icestorm', 8), ('ise', 4), ('vivado', 1)]
+    """
+    limits = dict(defaults)
+    for v in values:
+        name, _, value = v.partition("=")
+        limits[name] = int(value)
+    return limits
+
+
+class MemoryBudget:
+    """Keeps track of the memory budget used by the running builds."""
+
+    def __init__(self, total):
+        self.total = total
+        self.used = 0
+
+    def fits(self, amount):
+        # Always let a build start when nothing else is running, even if
+        # it is bigger than the whole budget.
+        return not self.used or self.used + amount <= self.total
+
+    def acquire(self, amount):
+        self.used += amount
+
+    def release(self, amount):
+        self.used -= amount
+
+
+class Job:
+    def __init__(self, config, make_args):
+        self.config = config
+        self.make_args = make_args
+        self.toolchain = get_toolchain(config.platform)
+        self.builddir = make.get_builddir(argparse.Namespace(
+            platform=config.platform,
+            target=config.target,
+            cpu_type=config.cpu,
+            cpu_variant=config.cpu_variant,
+            target_option=[]))
+        self.logfile = os.path.join(self.builddir, "output.{}.log".format(
+            datetime.datetime.now().strftime("%Y%m%d-%H%M%S")))
+        self.returncode = None
+        self.walltime = 0.0
+
+    @property
+    def name(self):
+        return os.path.basename(os.path.normpath(self.builddir))
+
+    def cmdline(self):
+        cmd = [
+            sys.executable, "-u", "make.py",
+            "--platform={}".format(self.config.platform),
+            "--target={}".format(self.config.target),
+            "--cpu-type={}".format(self.config.cpu),
+        ]
+        if self.config.cpu_variant:
+            cmd.append("--cpu-variant={}".format(self.config.cpu_variant))
+        return cmd + self.make_args
+
+    def run(self, verbose=False):
+        os.makedirs(self.builddir, exist_ok=True)
+        env = dict(os.environ)
+        env["PYTHONHASHSEED"] = "0"
+
+        start = time.time()
+        with open(self.logfile, "w") as log:
+            p = subprocess.Popen(
+                self.cmdline(), env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True)
+            for line in p.stdout:
+                log.write(line)
+                if verbose:
+                    print("[{}] {}".format(self.name, line), end="", flush=True)
+            self.returncode = p.wait()
+        self.walltime = time.time() - start
+        return self.returncode
+
+
+class Scheduler:
+    """Runs the jobs on max_jobs workers.
+
+    A free worker takes the first waiting job whose toolchain and memory
+    slots are free, so jobs waiting for a slot never hold a worker or the
+    slots of other toolchains.
+    """
+    def __init__(self, jobs, max_jobs, toolchain_jobs, toolchain_memory, memory_budget, verbose=False):
+        self.jobs = jobs
+        self.max_jobs = max_jobs
+        self.toolchain_jobs = toolchain_jobs
+        self.toolchain_memory = toolchain_memory
+        self.memory = MemoryBudget(memory_budget)
+        self.verbose = verbose
+        self.print_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.waiting = list(jobs)
+        self.running = collections.Counter()
+
+    def log(self, msg):
+        with self.print_lock:
+            print(msg, flush=True)
+
+    def can_start(self, job):
+        limit = self.toolchain_jobs.get(job.toolchain, None)
+        if limit is not None and self.running[job.toolchain] >= limit:
+            return False
+        return self.memory.fits(self.toolchain_memory.get(job.toolchain, 0))
+
+    def next_job(self):
+        """Take the next job which can start, None when there are no more."""
+        with self.cond:
+            while self.waiting:
+                for job in self.waiting:
+                    if self.can_start(job):
+                        self.waiting.remove(job)
+                        self.running[job.toolchain] += 1
+                        self.memory.acquire(self.toolchain_memory.get(job.toolchain, 0))
+                        return job
+                self.cond.wait()
+            return None
+
+    def finish_job(self, job):
+        with self.cond:
+            self.running[job.toolchain] -= 1
+            self.memory.release(self.toolchain_memory.get(job.toolchain, 0))
+            self.cond.notify_all()
+
+    def run_job(self, job):
+        try:
+            self.log("Starting {} ({}) -> {}".format(job.name, job.toolchain, job.logfile))
+            job.run(self.verbose)
+            self.log("Finished {} in {:.0f}s ({})".format(
+                job.name, job.walltime, "ok" if job.returncode == 0 else "FAILED"))
+        finally:
+            self.finish_job(job)
+
+    def worker(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            self.run_job(job)
+
+    def run(self):
+        threads = [threading.Thread(target=self.worker)
+                   for _ in range(max(1, min(self.max_jobs, len(self.jobs))))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+
+def print_summary(jobs):
+    print()
+    print("{:50} {:10} {:>10}  {}".format("Build", "Status", "Time", "Log"))
+    print("-"*100)
+    for job in jobs:
+        status = "ok" if job.returncode == 0 else "FAILED"
+        print("{:50} {:10} {:>9.0f}s  {}".format(job.name, status, job.walltime, job.logfile))
+    print("-"*100)
+    failed = sum(1 for job in jobs if job.returncode != 0)
+    print("{} builds, {} failed".format(len(jobs), failed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("configs", nargs="*",
+                        help="PLATFORM[:TARGET[:CPU[.VARIANT]]] to build (default: every platform and target)")
+    parser.add_argument("--cpu", action="append", default=[],
+                        help="CPU[.VARIANT] to build when a configuration doesn't give one (default: $CPU or lm32)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="maximum number of builds to run at once")
+    parser.add_argument("--toolchain-jobs", action="append", default=[], metavar="TOOLCHAIN=N",
+                        help="maximum number of concurrent builds with a toolchain")
+    parser.add_argument("--toolchain-memory", action="append", default=[], metavar="TOOLCHAIN=MB",
+                        help="memory needed by one build with a toolchain")
+    parser.add_argument("--memory-budget", type=int, default=None, metavar="MB",
+                        help="total memory the running builds may use (default: physical memory)")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="also print the output of every build")
+    parser.add_argument("--make-arg", action="append", default=[],
+                        help="extra argument passed to each make.py")
+
+    args = parser.parse_args()
+
+    cpus = args.cpu or [os.environ.get('CPU', 'lm32')]
+    configs = []
+    for c in args.configs or make.get_platforms():
+        configs.extend(parse_config(c, cpus))
+
+    memory_budget = args.memory_budget
+    if memory_budget is None:
+        memory_budget = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024*1024)
+
+    jobs = [Job(c, args.make_arg) for c in configs]
+    scheduler = Scheduler(
+        jobs,
+        max_jobs=args.jobs,
+        toolchain_jobs=parse_limits(args.toolchain_jobs, TOOLCHAIN_JOBS),
+        toolchain_memory=parse_limits(args.toolchain_memory, TOOLCHAIN_MEMORY),
+        memory_budget=memory_budget,
+        verbose=args.verbose)
+    scheduler.run()
+
+    print_summary(jobs)
+    sys.exit(1 if any(job.returncode != 0 for job in jobs) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -63,8 +63,76 @@ def get_regions(size_gw, size_bios, size_flash):
     return [region_gw, region_bios, region_fw]
 
 
-def fill_region(image_fileobj, region, input_filename, fill_zero=False):
+def check_regions(regions, size_flash):
+    """Check the regions are in order, don't overlap and fit in the flash.
+
+    >>> check_regions(get_regions(256, 128, 1000), 1000)
+    >>> check_regions([
+    ...     Region("A", "", 0, 256),
+    ...     Region("B", "", 128, 128),
+    ... ], 1000)
+    Traceback (most recent call last):
+     ...
+    AssertionError: Region 'A' (0x000000-0x000100) overlaps 'B' (0x000080-0x000100)
     """
+    for a, b in zip(regions, regions[1:]):
+        assert a.end <= b.start, (
+            "Region {!r} (0x{:06x}-0x{:06x}) overlaps {!r} (0x{:06x}-0x{:06x})".format(
+                a.name, a.start, a.end, b.name, b.start, b.end))
+    for r in regions:
+        assert r.end <= size_flash, (
+            "Region {!r} (0x{:06x}-0x{:06x}) doesn't fit in the flash (0x{:06x})".format(
+                r.name, r.start, r.end, size_flash))
+
+
+# Size of the blocks padding is written in.
+PAD_BLOCK_SIZE = 1024*1024
+
+
+def pad(image_fileobj, end, value=b'\xff'):
+    """Pad the image up to end, with value or (for zeros) a sparse hole."""
+    start = image_fileobj.seek(0, os.SEEK_END)
+    if start >= end:
+        return
+    if value == b'\0':
+        image_fileobj.truncate(end)
+        return
+    block = value * PAD_BLOCK_SIZE
+    for pos in range(start, end, PAD_BLOCK_SIZE):
+        image_fileobj.write(block[:min(PAD_BLOCK_SIZE, end - pos)])
+
+
+def copy_file(image_fileobj, offset, input_filename, size):
+    """Copy a file into the image without passing it through Python."""
+    fd_out = image_fileobj.fileno()
+    with open(input_filename, "rb") as f:
+        fd_in = f.fileno()
+        copied = 0
+        try:
+            while copied < size:
+                n = os.copy_file_range(
+                    fd_in, fd_out, size - copied,
+                    offset_src=copied, offset_dst=offset + copied)
+                if n == 0:
+                    break
+                copied += n
+        except (AttributeError, OSError):
+            # Old Python or kernel, or files on different filesystems.
+            os.lseek(fd_out, offset + copied, os.SEEK_SET)
+            while copied < size:
+                n = os.sendfile(fd_out, fd_in, copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+    assert copied == size, "Short copy of {} ({} of {} bytes)".format(
+        input_filename, copied, size)
+
+
+def fill_region(image_fileobj, region, input_filename, fill_zero=False, input_data=b"", input_desc="Skipped"):
+    """Place a file (or input_data) at the start of a region of the image.
+
+    The image must be opened unbuffered, as the file is copied directly
+    between the file descriptors.
 
     Output;
     -----
@@ -74,37 +142,59 @@ def fill_region(image_fileobj, region, input_filename, fill_zero=False):
 
     {name  } @ {start   } (using {input_len} bytes of {length  } bytes) {input_fn} - {desc}
     {hex file data}
-    """
 
-    if inputfile:
-        input_data   = open(input_filename, "rb").read()
-        input_size   = len(input_data)
-        input_result = "Loaded from {}".format(input_filename)
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> _ = open(os.path.join(d, "in.bin"), "wb").write(b"\\x01\\x02\\x03")
+    >>> with open(os.path.join(d, "out.bin"), "wb", buffering=0) as f:
+    ...     _ = fill_region(f, Region("BIOS", "LiteX BIOS", 8, 8), os.path.join(d, "in.bin"), fill_zero=True)
+    ...     _ = fill_region(f, Region("Firmware", "Firmware", 16, 8), None, input_data=b"\\xff"*4, input_desc="Cleared")
+    ... # doctest: +ELLIPSIS
+        BIOS @ 0x00000008 (using          3 bytes of          8 bytes) /...in.bin... - LiteX BIOS
+    01 02 03
+    Firmware @ 0x00000010 (using          4 bytes of          8 bytes) Cleared                                                      - Firmware
+    ff ff ff ff
+    >>> open(os.path.join(d, "out.bin"), "rb").read()
+    b'\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x01\\x02\\x03\\x00\\x00\\x00\\x00\\x00\\xff\\xff\\xff\\xff'
+    """
+    if input_filename:
+        input_size = os.stat(input_filename).st_size
+        with open(input_filename, "rb") as f:
+            head = f.read(64)
+        input_desc = input_filename
+    else:
+        input_size = len(input_data)
+        head = input_data[:64]
+
+    print(("{:>8} @ 0x{:08x} (using {:10} bytes of {:10} bytes) {:60} - {}"
+           ).format(
+               region.name,
+               region.start,
+               input_size,
+               region.size,
+               input_desc,
+               region.desc))
+    print(" ".join("{:02x}".format(i) for i in head))
+
+    assert input_size <= region.size, (
+        "{} is too big for the {} region ({} > {} bytes)".format(
+            input_desc, region.name, input_size, region.size))
+    assert image_fileobj.seek(0, os.SEEK_END) <= region.start, (
+        "{} region starts before the end of the image".format(region.name))
+
+    if input_filename:
+        copy_file(image_fileobj, region.start, input_filename, input_size)
     else:
-        input_data   = b""
-        input_size   = len(input_data)
-        input_result = "Skipped"
-
-    #   "{name:08s} @ 0x{start:08x} "
-    #   "(using {input_size:10} bytes of {:10} bytes - {:02.2)%) {:60s} - {}"
-
-    #print(
-    #    "{:08s} @ 0x{:08x} (using {:10} bytes of {:10} bytes - {:02.2)% {:60s} - {}"
-    #).format()
-
-    print(" ".join("{:02x}".format(i) for i in input_data[:64]))
-    assert input_size < region.size
-    assert f.tell() < region.start, "{} < {}".format(f.tell(), region.start)
-    f.seek(region.start)
-    f.write(input_data)
+        image_fileobj.seek(region.start)
+        image_fileobj.write(input_data)
     if fill_zero:
-        while f.tell() < region.end:
-            f.write('\0')
+        pad(image_fileobj, region.end, b'\0')
+    return input_size
 
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
-    make.get_args(parser)
+    make.get_args(parser, soc_args=False)
 
     parser.add_argument("--output-file", default="image.bin")
     parser.add_argument("--override-gateware")
@@ -112,7 +202,10 @@ def main():
     parser.add_argument("--firmware-name", default="HDMI2USB")
     parser.add_argument("--force-image-size")
 
-    args = parser.parse_args()
+    # The other SoC options are only parsed (by make.get_soc_info) when
+    # the SoC has to be elaborated, the manifest of the build is used
+    # otherwise.
+    args, _ = parser.parse_known_args()
 
     builddir = make.get_builddir(args)
     if os.path.sep not in args.output_file:
@@ -161,82 +254,48 @@ def main():
         assert firmware.endswith('.fbi'), (
             "Firmware must be a MiSoC .fbi image.")
 
-    platform = make.get_platform(args)
-    soc = make.get_soc(args, platform)
+    platform = make.get_platform_info(args)
+    soc = make.get_soc_info(args)
     bios_size = make.get_bios_maxsize(args, soc)
 
-    gateware_pos = 0
-    bios_pos = platform.gateware_size
-    firmware_pos = platform.gateware_size + bios_size
-
     flash_size = platform.spiflash_total_size
     if args.force_image_size and args.force_image_size.lower() not in ("true", "1"):
             flash_size = int(args.force_image_size)
 
+    region_gw, region_bios, region_fw = regions = get_regions(
+        platform.gateware_size, bios_size, flash_size)
+    region_fw = region_fw._replace(
+        desc="{} Firmware in FBI format (loaded into DRAM)".format(args.firmware_name))
+
+    # Check everything fits before writing anything.
+    check_regions(regions, flash_size)
+    for region, filename in ((region_gw, gateware), (region_bios, bios), (region_fw, firmware)):
+        if not filename:
+            continue
+        size = os.stat(filename).st_size
+        assert size <= region.size, (
+            "{} is too big for the {} region ({} > {} bytes)".format(
+                filename, region.name, size, region.size))
+
     print()
-    with open(output_file, "wb") as f:
+    # Unbuffered, as the inputs are copied directly into the file.
+    with open(output_file, "wb", buffering=0) as f:
         # FPGA gateware
-        if gateware:
-            gateware_data = open(gateware, "rb").read()
-        else:
-            gateware_data = b""
-            gateware = "Skipped"
-
-        print(("Gateware @ 0x{:08x} (using {:10} bytes of {:10} bytes) {:60}"
-               " - FPGA Bitstream"
-               ).format(
-                   gateware_pos,
-                   len(gateware_data),
-                   bios_pos - gateware_pos,
-                   gateware))
-        print(" ".join("{:02x}".format(i) for i in gateware_data[:64]))
-        assert len(gateware_data) < platform.gateware_size
-        f.seek(0)
-        f.write(gateware_data)
-
-        if bios:
-            bios_data = open(bios, "rb").read()
-        else:
-            bios_data = b""
-            bios = "Skipped"
+        fill_region(f, region_gw, gateware)
 
         # LiteX BIOS
-        assert len(bios_data) < bios_size
-        f.seek(bios_pos)
-        f.write(bios_data)
-        print(("    BIOS @ 0x{:08x} (using {:10} bytes of {:10} bytes) {:60}"
-               " - LiteX BIOS with CRC"
-               ).format(
-                   bios_pos,
-                   len(bios_data),
-                   firmware_pos - bios_pos,
-                   bios))
-        print(" ".join("{:02x}".format(i) for i in bios_data[:64]))
+        fill_region(f, region_bios, bios)
 
+        # SoftCPU firmware
         if firmware:
-            firmware_data = open(firmware, "rb").read()
+            firmware_size = fill_region(f, region_fw, firmware)
         else:
-            firmware_data = b"\xff\xff\xff\xff"
-            firmware = "Cleared"
-            #firmware_data = b""
-            #firmware = "Skipped"
-
-        # SoftCPU firmware
-        print(("Firmware @ 0x{:08x} (using {:10} bytes of {:10} bytes) {:60}"
-               " - {} Firmware in FBI format (loaded into DRAM)"
-               ).format(
-                   firmware_pos,
-                   len(firmware_data),
-                   flash_size - firmware_pos,
-                   firmware,
-                   args.firmware_name))
-        print(" ".join("{:02x}".format(i) for i in firmware_data[:64]))
-        f.seek(firmware_pos)
-        f.write(firmware_data)
+            firmware_size = fill_region(
+                f, region_fw, None, input_data=b"\xff\xff\xff\xff", input_desc="Cleared")
 
         # Result
         remain = platform.spiflash_total_size - (
-            firmware_pos+len(firmware_data))
+            region_fw.start+firmware_size)
         print("-"*40)
         print(("       Remaining space {:10} bytes"
                " ({} Megabits, {:.2f} Megabytes)"
@@ -247,12 +306,12 @@ def main():
                ).format(total, int(total*8/1024/1024), total/1024/1024))
 
         if args.force_image_size:
-            f.write(b'\xff' * (flash_size - f.tell()))
+            pad(f, flash_size)
 
     print()
     print("Flash image: {}".format(output_file))
-    flash_image_data = open(output_file, "rb").read()
-    print(" ".join("{:02x}".format(i) for i in flash_image_data[:64]))
+    with open(output_file, "rb") as f:
+        print(" ".join("{:02x}".format(i) for i in f.read(64)))
 
 
 if __name__ == "__main__":
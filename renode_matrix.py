@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Run the Renode test suites of many configurations in parallel.
+
+The Renode platform scripts (.repl/.resc) of a build are generated once
+and kept in the build directory under a hash of its csr.json and the
+generator options, so later runs of the same build skip the generator.
+Every suite runs in its own Renode instance with its own results
+directory, and the results of all of them are collected into one JUnit
+file.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import make
+import matrix
+
+
+TOP_DIR = os.path.dirname(os.path.abspath(__file__))
+TESTS_DIR = os.path.join(TOP_DIR, "tests", "renode")
+GENERATOR = os.path.join(TOP_DIR, "third_party", "litex-renode", "generate-renode-scripts.py")
+RENODE_DIR = os.path.join(TOP_DIR, "build", "conda", "opt", "renode")
+
+# Name of the CPU in the BIOS banner, for the CPUs Renode has.
+CPU_TYPES = {
+    "vexriscv": "VexRiscv",
+    "picorv32": "PicoRV32",
+}
+
+# The tests load binaries into the flash to avoid using netboot.
+NO_FLASH_PLATFORMS = ("mimas_a7", "netv2", "pano_logic_g2")
+# Memory regions of a size Renode doesn't support yet.
+UNSUPPORTED_PLATFORMS = ("ice40_hx8k_b_evn", "tinyfpga_bx", "icefun")
+
+# First robot remote server port, each running suite gets its own.
+BASE_PORT = 9999
+
+
+def skip_reason(config, firmware):
+    """Why a configuration can't be tested in Renode, or None.
+
+    >>> skip_reason(matrix.Config("arty", "base", "lm32", None), "firmware")
+    'CPU lm32 is not supported in Renode yet'
+    >>> skip_reason(matrix.Config("arty", "base", "vexriscv", None), "zephyr") is None
+    True
+    """
+    if config.cpu not in CPU_TYPES:
+        return "CPU {} is not supported in Renode yet".format(config.cpu)
+    if config.platform in NO_FLASH_PLATFORMS:
+        return "{} does not have flash memory".format(config.platform)
+    if config.platform in UNSUPPORTED_PLATFORMS:
+        return "{} has memory regions Renode doesn't support".format(config.platform)
+    if firmware == "zephyr" and config.platform == "icebreaker":
+        return "running zephyr directly from flash is not supported"
+    return None
+
+
+def generator_args(builddir, config, firmware):
+    software = os.path.join(TOP_DIR, builddir, "software")
+    args = ["--bios-binary", os.path.join(software, "bios", "bios.bin")]
+    if firmware == "linux" and config.cpu == "vexriscv":
+        for filename in ("linux/firmware.bin:Image", "linux/riscv32-rootfs.cpio:rootfs.cpio",
+                         "linux/rv32.dtb", "linux/boot.json"):
+            args += ["--tftp-binary", os.path.join(software, filename)]
+        args += [
+            "--tftp-binary", os.path.join(TOP_DIR, builddir, "emulator", "emulator.bin"),
+            "--tftp-server-ip", "192.168.100.100",
+            "--tftp-server-port", "6069",
+        ]
+    else:
+        args += ["--firmware-binary", os.path.join(software, firmware, "firmware.bin")]
+    return args
+
+
+def get_scripts(builddir, config, firmware):
+    """The .resc of a build, generated unless already cached."""
+    testdir = os.path.join(TOP_DIR, builddir, "test")
+    csr_csv = os.path.join(testdir, "csr.csv")
+    csr_json = os.path.join(testdir, "csr.json")
+    args = generator_args(builddir, config, firmware)
+
+    h = hashlib.sha256()
+    with open(csr_json if os.path.exists(csr_json) else csr_csv, "rb") as f:
+        h.update(f.read())
+    h.update(repr(args).encode())
+    scriptdir = os.path.join(TOP_DIR, builddir, "renode", h.hexdigest()[:16])
+    resc = os.path.join(scriptdir, "litex_buildenv.resc")
+    if os.path.exists(resc):
+        return resc
+
+    tmpdir = "{}.tmp{}".format(scriptdir, threading.get_ident())
+    os.makedirs(tmpdir, exist_ok=True)
+    subprocess.check_call(
+        [sys.executable, GENERATOR, csr_csv,
+         "--repl", os.path.join(tmpdir, "litex_buildenv.repl"),
+         "--resc", os.path.join(tmpdir, "litex_buildenv.resc")] + args,
+        stdout=subprocess.DEVNULL)
+    # The .resc refers to the .repl by its path.
+    with open(os.path.join(tmpdir, "litex_buildenv.resc")) as f:
+        contents = f.read().replace(tmpdir, scriptdir)
+    with open(os.path.join(tmpdir, "litex_buildenv.resc"), "w") as f:
+        f.write(contents)
+    try:
+        os.rename(tmpdir, scriptdir)
+    except OSError:
+        shutil.rmtree(tmpdir)
+    return resc
+
+
+class Run:
+    def __init__(self, config, firmware):
+        self.config = config
+        self.firmware = firmware
+        self.builddir = make.get_builddir(argparse.Namespace(
+            platform=config.platform,
+            target=config.target,
+            cpu_type=config.cpu,
+            cpu_variant=config.cpu_variant,
+            target_option=[]))
+        self.skipped = skip_reason(config, firmware)
+        self.returncode = None
+        self.walltime = 0.0
+        self.results = []
+        self.error = None
+
+    @property
+    def name(self):
+        return "{}.{}".format(os.path.basename(os.path.normpath(self.builddir)), self.firmware)
+
+    @property
+    def resultsdir(self):
+        return os.path.join(TOP_DIR, self.builddir, "renode", "results", self.firmware)
+
+    def suites(self):
+        suites = [os.path.join(TESTS_DIR, "BIOS.robot")]
+        # The stub firmware isn't tested.
+        if self.firmware != "stub":
+            suites.append(os.path.join(TESTS_DIR, "Firmware-{}.robot".format(self.firmware)))
+        return suites
+
+    def run(self, port):
+        start = time.time()
+        try:
+            resc = get_scripts(self.builddir, self.config, self.firmware)
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.error = "Generating the Renode scripts failed: {}".format(e)
+            self.returncode = 1
+            return
+        shutil.rmtree(self.resultsdir, ignore_errors=True)
+        os.makedirs(self.resultsdir)
+        with open(os.path.join(self.resultsdir, "output.log"), "w") as log:
+            self.returncode = subprocess.call(
+                [sys.executable, "tests/run_tests.py",
+                 "--variable", "LITEX_SCRIPT:{}".format(resc),
+                 "--variable", "CPU_TYPE:{}".format(CPU_TYPES[self.config.cpu]),
+                 "--robot-framework-remote-server-full-directory", os.path.join(RENODE_DIR, "bin"),
+                 "--robot-framework-remote-server-port", str(port),
+                 "--results-dir", self.resultsdir,
+                ] + self.suites(),
+                cwd=RENODE_DIR, stdout=log, stderr=subprocess.STDOUT)
+        self.walltime = time.time() - start
+        self.results = read_robot_output(os.path.join(self.resultsdir, "robot_output.xml"))
+
+
+def robot_elapsed(status):
+    """Seconds a robot test took, from either output.xml format.
+
+    >>> robot_elapsed(ET.fromstring('<status starttime="20200102 10:00:00.000" endtime="20200102 10:00:02.500"/>'))
+    2.5
+    >>> robot_elapsed(ET.fromstring('<status elapsed="1.25"/>'))
+    1.25
+    """
+    if status.get("elapsed"):
+        return float(status.get("elapsed"))
+    try:
+        start, end = (datetime.datetime.strptime(status.get(a), "%Y%m%d %H:%M:%S.%f")
+                      for a in ("starttime", "endtime"))
+    except (TypeError, ValueError):
+        return 0.0
+    return (end - start).total_seconds()
+
+
+def read_robot_output(filename):
+    """(suite, test, status, seconds, message) of each test in a robot output.xml."""
+    if not os.path.exists(filename):
+        return []
+    results = []
+    for suite in ET.parse(filename).getroot().iter("suite"):
+        for test in suite.findall("test"):
+            status = test.find("status")
+            seconds = robot_elapsed(status)
+            results.append((suite.get("name"), test.get("name"), status.get("status"),
+                            seconds, (status.text or "").strip()))
+    return results
+
+
+def write_junit(runs, filename):
+    testsuites = ET.Element("testsuites")
+    for run in runs:
+        ts = ET.SubElement(testsuites, "testsuite", name=run.name, time="{:.1f}".format(run.walltime))
+        failures = skipped = 0
+        if run.skipped:
+            tc = ET.SubElement(ts, "testcase", classname=run.name, name="renode")
+            ET.SubElement(tc, "skipped", message=run.skipped)
+            skipped += 1
+        elif run.error or (run.returncode and not run.results):
+            tc = ET.SubElement(ts, "testcase", classname=run.name, name="renode")
+            ET.SubElement(tc, "failure", message=run.error or "Renode exited with {}".format(run.returncode))
+            failures += 1
+        for suite, test, status, seconds, message in run.results:
+            tc = ET.SubElement(ts, "testcase", classname="{}.{}".format(run.name, suite),
+                               name=test, time="{:.1f}".format(seconds))
+            if status != "PASS":
+                ET.SubElement(tc, "failure", message=message)
+                failures += 1
+        ts.set("tests", str(len(ts)))
+        ts.set("failures", str(failures))
+        ts.set("skipped", str(skipped))
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    ET.ElementTree(testsuites).write(filename, encoding="utf-8", xml_declaration=True)
+
+
+def print_summary(runs):
+    print()
+    print("{:60} {:10} {:>10}".format("Run", "Status", "Time"))
+    print("-"*82)
+    for run in runs:
+        if run.skipped:
+            status = "skipped"
+        else:
+            status = "ok" if run.returncode == 0 else "FAILED"
+        print("{:60} {:10} {:>9.0f}s".format(run.name, status, run.walltime))
+    print("-"*82)
+    failed = [r for r in runs if not r.skipped and r.returncode != 0]
+    print("{} runs, {} skipped, {} failed".format(
+        len(runs), sum(1 for r in runs if r.skipped), len(failed)))
+    for run in failed:
+        print("  {}: {}".format(run.name, run.error or run.resultsdir))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("configs", nargs="*",
+                        help="PLATFORM[:TARGET[:CPU[.VARIANT]]] to test (default: every platform and target)")
+    parser.add_argument("--cpu", action="append", default=[],
+                        help="CPU[.VARIANT] to test when a configuration doesn't give one (default: $CPU or vexriscv)")
+    parser.add_argument("--firmware", action="append", default=[],
+                        help="firmware to test (can be given multiple times, default: $FIRMWARE or firmware)")
+    parser.add_argument("-j", "--jobs", type=int, default=max(os.cpu_count()//2, 1),
+                        help="maximum number of Renode instances to run at once")
+    parser.add_argument("--junit", default=os.path.join("build", "renode-results.xml"),
+                        help="JUnit file to write the results to")
+    args = parser.parse_args()
+
+    assert os.path.isdir(RENODE_DIR), (
+        "Renode not found in {}, run scripts/test-renode.sh once to install it".format(RENODE_DIR))
+
+    cpus = args.cpu or [os.environ.get('CPU', 'vexriscv')]
+    firmwares = args.firmware or [os.environ.get('FIRMWARE', 'firmware')]
+    runs = []
+    for c in args.configs or make.get_platforms():
+        for config in matrix.parse_config(c, cpus):
+            runs.extend(Run(config, firmware) for firmware in firmwares)
+
+    print_lock = threading.Lock()
+    ports = list(range(BASE_PORT, BASE_PORT + args.jobs))
+    ports_lock = threading.Lock()
+
+    def run_one(run):
+        with ports_lock:
+            port = ports.pop()
+        try:
+            run.run(port)
+        finally:
+            with ports_lock:
+                ports.append(port)
+        with print_lock:
+            print("Finished {} in {:.0f}s ({})".format(
+                run.name, run.walltime, "ok" if run.returncode == 0 else "FAILED"), flush=True)
+
+    with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+        for f in [executor.submit(run_one, r) for r in runs if not r.skipped]:
+            f.result()
+
+    write_junit(runs, args.junit)
+    print_summary(runs)
+    print("JUnit results: {}".format(args.junit))
+    sys.exit(1 if any(not r.skipped and r.returncode != 0 for r in runs) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+Run a sim target in Verilator, reusing the compiled model between runs.
+
+The generated C++ and Verilog are hashed and the compiled simulator is
+kept in a cache under that key, so a run only pays for the Verilator
+compile when the gateware really changed. Memory contents (the BIOS and
+the firmware ROM) are loaded from their .init files when the simulation
+starts, so they are not part of the key; --firmware swaps the firmware
+in the cached model without building again.
+
+With --snapshot the state of the simulated SoC is saved once the BIOS is
+done with its init (when it prints --snapshot-at, before it reads the
+firmware) and later runs restore it instead of booting, then load the
+firmware ROM from its .init file again. The snapshot is keyed on the
+model and the other memory contents. Verilator can only save single
+threaded models, so --snapshot builds one.
+
+With --expect the console output is matched against the given regular
+expressions, in order, and the simulation is stopped as soon as all of
+them were seen, which is what the firmware tests use. When restoring a
+snapshot the console starts after --snapshot-at.
+"""
+
+import argparse
+import hashlib
+import inspect
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import make
+
+
+# Files of the sim build directory the compiled model depends on.
+MODEL_INPUTS = (".v", ".h", ".c", ".cpp", ".mak", ".sh")
+# Generated at run time, or only read by the running model.
+MODEL_IGNORE = re.compile(r"^run_.*\.sh$|\.init$|^sim_config\.js$")
+
+
+def get_model_key(gatewaredir, threads):
+    """Hash everything the Verilator compile consumes."""
+    h = hashlib.sha256()
+    for filename in sorted(os.listdir(gatewaredir)):
+        if MODEL_IGNORE.search(filename):
+            continue
+        if os.path.splitext(filename)[1] not in MODEL_INPUTS:
+            continue
+        h.update(filename.encode())
+        with open(os.path.join(gatewaredir, filename), "rb") as f:
+            h.update(f.read())
+    h.update(subprocess.check_output(["verilator", "--version"]))
+    h.update(repr(threads).encode())
+    return h.hexdigest()
+
+
+def get_model_files(gatewaredir):
+    """The compiled simulator and the modules it loads."""
+    files = []
+    objdir = os.path.join(gatewaredir, "obj_dir")
+    if os.path.isdir(objdir):
+        files += [
+            os.path.join("obj_dir", f) for f in os.listdir(objdir)
+            if f.startswith("V") and os.access(os.path.join(objdir, f), os.X_OK)
+            and not os.path.splitext(f)[1]]
+    modulesdir = os.path.join(gatewaredir, "modules")
+    if os.path.isdir(modulesdir):
+        files += [os.path.join("modules", f) for f in os.listdir(modulesdir) if f.endswith(".so")]
+    return files
+
+
+def model_cache_restore(cachedir, key, gatewaredir):
+    entrydir = os.path.join(cachedir, key)
+    if not os.path.isdir(entrydir):
+        return False
+    for dirpath, dirnames, filenames in os.walk(entrydir):
+        for filename in filenames:
+            src = os.path.join(dirpath, filename)
+            dst = os.path.join(gatewaredir, os.path.relpath(src, entrydir))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copy2(src, dst)
+    return True
+
+
+def model_cache_store(cachedir, key, gatewaredir):
+    entrydir = os.path.join(cachedir, key)
+    if os.path.isdir(entrydir):
+        return
+    tmpdir = "{}.tmp{}".format(entrydir, os.getpid())
+    for filename in get_model_files(gatewaredir):
+        dst = os.path.join(tmpdir, filename)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copy2(os.path.join(gatewaredir, filename), dst)
+    try:
+        os.rename(tmpdir, entrydir)
+    except OSError:
+        # Another run stored the same model first.
+        shutil.rmtree(tmpdir)
+
+
+def init_contents(words, width=32):
+    """The .init file migen writes for a memory with these contents.
+
+    >>> init_contents([1, 0xdeadbeef])
+    '00000001\\nDEADBEEF\\n'
+    """
+    return "".join("{:0{}X}\n".format(w, width//4) for w in words)
+
+
+def read_firmware(filename):
+    with open(filename, "rb") as f:
+        data = f.read()
+    data += b"\0"*(-len(data) % 4)
+    return list(struct.unpack(">{}I".format(len(data)//4), data))
+
+
+def find_init_file(gatewaredir, mem):
+    """The .init file holding the contents of mem."""
+    contents = init_contents(mem.init, mem.width).lower()
+    for filename in sorted(os.listdir(gatewaredir)):
+        if filename.endswith(".init"):
+            path = os.path.join(gatewaredir, filename)
+            if open(path).read().lower() == contents:
+                return path
+    assert False, "No .init file with the contents of {}".format(mem.filename)
+
+
+def swap_firmware(path, mem, filename):
+    words = read_firmware(filename)
+    assert len(words) <= mem.depth, (
+        "Firmware is too big! {} bytes > {} bytes".format(4*len(words), 4*mem.depth))
+    with open(path, "w") as f:
+        f.write(init_contents(words, mem.width))
+    print("Firmware {} in {}".format(filename, os.path.basename(path)))
+
+
+SNAPSHOT_CODE = """
+/* Snapshots of the model, added by sim.py. */
+#include <verilated_save.h>
+/* Verilator 4.210 moved the signals of the design to a root class. */
+#ifdef __has_include
+#if __has_include("{cls}___024root.h")
+#include "{cls}___024root.h"
+#define SNAPSHOT_ROOTP
+#endif
+#endif
+#ifdef SNAPSHOT_ROOTP
+#define SNAPSHOT_ROOT(sim) ((sim)->rootp)
+#else
+#define SNAPSHOT_ROOT(sim) (sim)
+#endif
+
+static {cls} *snapshot_sim;
+static const char *snapshot_file;
+static const char *snapshot_at;
+static char snapshot_buf[256];
+static size_t snapshot_seen;
+static int snapshot_last_clk;
+
+/* The firmware ROM, which may have been swapped since the snapshot. */
+static void litex_sim_snapshot_reload({cls} *sim)
+{{
+    FILE *f = fopen("{init}", "r");
+    unsigned int word;
+    int i = 0;
+
+    if(!f) {{
+        perror("{init}");
+        exit(1);
+    }}
+    while(i < {depth} && fscanf(f, "%x", &word) == 1)
+        SNAPSHOT_ROOT(sim)->{mem}[i++] = word;
+    while(i < {depth})
+        SNAPSHOT_ROOT(sim)->{mem}[i++] = 0;
+    fclose(f);
+}}
+
+static void litex_sim_snapshot_save(void)
+{{
+    char tmp[4096];
+    VerilatedSave os;
+
+    snprintf(tmp, sizeof(tmp), "%s.tmp", snapshot_file);
+    os.open(tmp);
+    os << *snapshot_sim;
+    os.close();
+    rename(tmp, snapshot_file);
+}}
+
+static void litex_sim_snapshot_init({cls} *sim)
+{{
+    const char *restore = getenv("SIM_RESTORE");
+
+    snapshot_sim = sim;
+    snapshot_file = getenv("SIM_SNAPSHOT");
+    snapshot_at = snapshot_file ? getenv("SIM_SNAPSHOT_AT") : NULL;
+    if(snapshot_at && (!*snapshot_at || strlen(snapshot_at) > sizeof(snapshot_buf)))
+        snapshot_at = NULL;
+    if(restore) {{
+        VerilatedRestore os;
+        os.open(restore);
+        os >> *sim;
+        os.close();
+        litex_sim_snapshot_reload(sim);
+    }}
+}}
+
+/* Watches the console for snapshot_at, the character sent is the one
+ * on the pads in the low half of the clock. */
+static void litex_sim_snapshot_dump(void)
+{{
+    {cls} *sim = snapshot_sim;
+    size_t n;
+
+    if(!snapshot_at)
+        return;
+    if(!sim->{clk} && snapshot_last_clk && sim->{serial}_source_valid && sim->{serial}_source_ready) {{
+        n = strlen(snapshot_at);
+        memmove(snapshot_buf, snapshot_buf + 1, n - 1);
+        snapshot_buf[n - 1] = sim->{serial}_source_data;
+        if(++snapshot_seen >= n && !memcmp(snapshot_buf, snapshot_at, n)) {{
+            litex_sim_snapshot_save();
+            snapshot_at = NULL;
+        }}
+    }}
+    snapshot_last_clk = sim->{clk};
+}}
+"""
+
+
+def add_snapshots(gatewaredir, platform, firmware_init, mem):
+    """Make the model savable and hook the snapshots into its sim_init.cpp."""
+    memory = None
+    for filename in os.listdir(gatewaredir):
+        if filename.endswith(".v"):
+            for init, name in re.findall(r'\$readmemh\("([^"]+)",\s*(\w+)\)',
+                                         open(os.path.join(gatewaredir, filename)).read()):
+                if os.path.basename(init) == os.path.basename(firmware_init):
+                    memory = name
+    assert memory, "No memory is loaded from {}".format(firmware_init)
+
+    path = os.path.join(gatewaredir, "sim_init.cpp")
+    code = open(path).read()
+    cls = re.search(r"sim = new (\w+);", code)
+    assert cls and "litex_sim_dump()\n{\n" in code, "Unknown sim_init.cpp layout"
+    cls = cls.group(1)
+    code = code.replace('#include "sim_header.h"\n', '#include "sim_header.h"\n' + SNAPSHOT_CODE.format(
+        cls=cls, mem="{}__DOT__{}".format(cls[1:], memory), init=os.path.basename(firmware_init),
+        depth=mem.depth, clk=platform.default_clk_name, serial="serial"), 1)
+    code = code.replace("litex_sim_dump()\n{\n", "litex_sim_dump()\n{\n    litex_sim_snapshot_dump();\n", 1)
+    code = code.replace("sim = new {};\n".format(cls), "sim = new {};\n    litex_sim_snapshot_init(sim);\n".format(cls), 1)
+    with open(path, "w") as f:
+        f.write(code)
+
+    scripts = [f for f in os.listdir(gatewaredir) if f.startswith("build_") and f.endswith(".sh")]
+    for script in scripts:
+        path = os.path.join(gatewaredir, script)
+        contents = open(path).read()
+        assert 'CC_SRCS="' in contents, "Unknown build script layout"
+        with open(path, "w") as f:
+            f.write(contents.replace('CC_SRCS="', 'CC_SRCS="--savable ', 1))
+
+
+def get_snapshot_key(model_key, gatewaredir, firmware_init, snapshot_at):
+    """The model, and the memory contents it boots from but the firmware."""
+    h = hashlib.sha256(model_key.encode())
+    for filename in sorted(os.listdir(gatewaredir)):
+        if filename.endswith(".init") and filename != os.path.basename(firmware_init):
+            h.update(filename.encode())
+            with open(os.path.join(gatewaredir, filename), "rb") as f:
+                h.update(f.read())
+    h.update(snapshot_at.encode())
+    return h.hexdigest()
+
+
+def build_model(args, gatewaredir, threads):
+    """Compile the simulator unless the cache has it."""
+    key = get_model_key(gatewaredir, threads)
+    if not args.no_model_cache and model_cache_restore(args.model_cache_dir, key, gatewaredir):
+        print("Model restored from cache ({})".format(key))
+        return key
+    scripts = [f for f in os.listdir(gatewaredir) if f.startswith("build_") and f.endswith(".sh")]
+    assert len(scripts) == 1, "Expected one build script in {}".format(gatewaredir)
+    start = time.time()
+    subprocess.check_call(["bash", scripts[0]], cwd=gatewaredir)
+    print("Model compiled in {:.0f}s".format(time.time() - start))
+    if not args.no_model_cache:
+        model_cache_store(args.model_cache_dir, key, gatewaredir)
+    return key
+
+
+def run_model(gatewaredir, expect, timeout, log, env=None):
+    """Run the simulator, returns True once all of expect were seen in order."""
+    binary = [f for f in get_model_files(gatewaredir) if f.startswith("obj_dir")]
+    assert len(binary) == 1, "No compiled simulator in {}".format(gatewaredir)
+    p = subprocess.Popen(
+        [os.path.join(".", binary[0])], cwd=gatewaredir, env=env,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    pending = [re.compile(e) for e in expect]
+    passed = threading.Event()
+
+    def reader():
+        line = b""
+        for c in iter(lambda: p.stdout.read(1), b""):
+            sys.stdout.buffer.write(c)
+            sys.stdout.flush()
+            log.write(c)
+            line += c
+            while pending and pending[0].search(line.decode(errors="replace")):
+                pending.pop(0)
+                line = b""
+            if not pending and expect:
+                passed.set()
+                return
+            if c == b"\n":
+                line = b""
+
+    t = threading.Thread(target=reader, daemon=True)
+    t.start()
+    t.join(timeout)
+    p.kill()
+    p.wait()
+    if expect and not passed.is_set():
+        print("\nStopped after {}s waiting for {!r}".format(timeout, pending[0].pattern))
+    return passed.is_set()
+
+
+def main():
+    from litex.soc.integration.builder import builder_args
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0], conflict_handler='resolve')
+    make.get_args(parser, platform='sim', target='base')
+    builder_args(parser)
+    parser.add_argument("--threads", default=1, type=int,
+                        help="Verilator threads")
+    parser.add_argument("--firmware", default=None,
+                        help="Firmware (.fbi or .bin) to run instead of the one built in")
+    parser.add_argument("--expect", default=[], action="append",
+                        help="Regular expression to wait for on the console (can be given multiple times)")
+    parser.add_argument("--timeout", default=None, type=float,
+                        help="Seconds to run the simulation for (default: forever)")
+    parser.add_argument("--model-cache-dir",
+                        default=os.environ.get('SIM_MODEL_CACHE_DIR', os.path.join("build", "sim-model-cache")),
+                        help="directory of compiled simulators, keyed by their sources")
+    parser.add_argument("--no-model-cache", action="store_true", help="always compile the simulator")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="restore the SoC after the BIOS init from a snapshot (taken on the first run)")
+    parser.add_argument("--snapshot-at", default="Booting from flash",
+                        help="console output after which the snapshot is taken")
+    args = parser.parse_args()
+    assert args.platform == "sim", "sim.py only runs the sim platform"
+
+    builddir = make.get_builddir(args)
+    testdir = make.get_testdir(args)
+    gatewaredir = os.path.join(builddir, "gateware")
+
+    platform = make.get_platform(args)
+    soc = make.get_soc(args, platform)
+    build_params = inspect.signature(platform.toolchain.build).parameters
+    if args.snapshot and args.threads > 1:
+        print("Verilator can't save a multithreaded simulator, using 1 thread.")
+        args.threads = 1
+    if "threads" in build_params:
+        args.build_option.append(("threads", args.threads))
+    elif args.threads > 1:
+        print("This LiteX can't build a multithreaded simulator, using 1 thread.")
+        args.threads = 1
+    # Only generate the sources, the model is compiled (or restored) below.
+    # Depending on the LiteX version the toolchain compiles the model as
+    # part of generating it, skip its build script.
+    with make.ToolchainScript(platform.toolchain, lambda run: 0):
+        make.build(args, platform, soc, builddir, testdir, compile_gateware=False)
+
+    mem = soc.firmware_ram.mem
+    firmware_init = find_init_file(gatewaredir, mem)
+    if args.snapshot:
+        add_snapshots(gatewaredir, platform, firmware_init, mem)
+    key = build_model(args, gatewaredir, args.threads)
+    if args.firmware:
+        swap_firmware(firmware_init, mem, args.firmware)
+
+    env = dict(os.environ)
+    if args.snapshot:
+        snapshot = os.path.join(
+            args.model_cache_dir, "snapshots",
+            get_snapshot_key(key, gatewaredir, firmware_init, args.snapshot_at))
+        if os.path.exists(snapshot):
+            print("Restoring snapshot {}".format(snapshot))
+            env["SIM_RESTORE"] = os.path.abspath(snapshot)
+        else:
+            os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+            env["SIM_SNAPSHOT"] = os.path.abspath(snapshot)
+            env["SIM_SNAPSHOT_AT"] = args.snapshot_at
+
+    logname = os.path.join(testdir, "sim.log")
+    os.makedirs(testdir, exist_ok=True)
+    with open(logname, "wb") as log:
+        ok = run_model(gatewaredir, args.expect, args.timeout, log, env)
+    print()
+    print("Console log: {}".format(logname))
+    if "SIM_SNAPSHOT" in env:
+        if os.path.exists(snapshot):
+            print("Snapshot saved to {}".format(snapshot))
+        else:
+            print("No snapshot, {!r} was not seen".format(args.snapshot_at))
+    if args.expect:
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
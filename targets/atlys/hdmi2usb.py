@@ -30,8 +30,10 @@ class HDMI2USBSoC(BaseSoC):
         encoder_buffer = ClockDomainsRenamer("encoder")(EncoderBuffer())
         encoder = Encoder(platform)
         encoder_streamer = USBStreamer(platform, platform.request("fx2"))
-        self.submodules += encoder_cdc, encoder_buffer, encoder, encoder_streamer
+        self.submodules += encoder_cdc, encoder_buffer, encoder
+        self.submodules.encoder_streamer = encoder_streamer
         self.add_csr("encoder")
+        self.add_csr("encoder_streamer")
 
         self.comb += [
             self.encoder_reader.source.connect(encoder_cdc.sink),
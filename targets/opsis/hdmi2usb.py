@@ -2,8 +2,9 @@ from migen.fhdl.decorators import ClockDomainsRenamer
 from litex.soc.integration.soc_core import mem_decoder
 from litex.soc.interconnect import stream
 
-from gateware.encoder import EncoderDMAReader, EncoderBuffer, Encoder
+from gateware.encoder import EncoderPrefetchDMAReader, EncoderBuffer, EncoderBufferStalls, Encoder
 from gateware.streamer import USBStreamer
+from gateware.stream_probe import StreamProbes
 
 from targets.opsis.video import SoC as BaseSoC
 
@@ -17,16 +18,21 @@ class HDMI2USBSoC(BaseSoC):
         BaseSoC.__init__(self, platform, *args, **kwargs)
 
         encoder_port = self.sdram.crossbar.get_port()
-        self.submodules.encoder_reader = EncoderDMAReader(encoder_port)
+        self.submodules.encoder_reader = EncoderPrefetchDMAReader(encoder_port,
+            fifo_depth=512)
         self.add_csr("encoder_reader")
         encoder_cdc = stream.AsyncFIFO([("data", 128)], 4)
         encoder_cdc = ClockDomainsRenamer({"write": "sys",
                                            "read": "encoder"})(encoder_cdc)
-        encoder_buffer = ClockDomainsRenamer("encoder")(EncoderBuffer())
+        encoder_buffer = ClockDomainsRenamer("encoder")(EncoderBuffer(nblocks=4))
         encoder = Encoder(platform)
         encoder_streamer = USBStreamer(platform, platform.request("fx2"))
-        self.submodules += encoder_cdc, encoder_buffer, encoder, encoder_streamer
+        self.submodules += encoder_cdc, encoder_buffer, encoder
+        self.submodules.encoder_streamer = encoder_streamer
         self.add_csr("encoder")
+        self.add_csr("encoder_streamer")
+        self.submodules.encoder_buffer = EncoderBufferStalls(encoder_buffer)
+        self.add_csr("encoder_buffer")
 
         self.comb += [
             self.encoder_reader.source.connect(encoder_cdc.sink),
@@ -34,6 +40,14 @@ class HDMI2USBSoC(BaseSoC):
             encoder_buffer.source.connect(encoder.sink),
             encoder.source.connect(encoder_streamer.sink)
         ]
+        self.submodules.encoder_probe = StreamProbes(self.clk_freq, [
+            ("reader", self.encoder_reader.source, "sys",
+                self.encoder_reader.start.re & self.encoder_reader.start.r),
+            ("buffer", encoder_buffer.sink, "encoder", None),
+            ("encoder", encoder.sink, "encoder", None),
+            ("streamer", encoder_streamer.sink, "encoder", None)
+        ])
+        self.add_csr("encoder_probe")
         self.add_wb_slave(self.mem_map["encoder"], encoder.bus)
         self.add_memory_region("encoder",
             self.mem_map["encoder"], 0x2000, type="io")
@@ -48,6 +48,7 @@ bios-flash-$(PLATFORM):
 help-$(PLATFORM):
 	@echo " make $(PLATFORM)-setup"
 	@echo " make $(PLATFORM)-teardown"
+	@echo " make $(PLATFORM)-run SIM_ARGS=..."
 
 reset-$(PLATFORM):
 	@echo "Unsupported."
@@ -68,4 +69,12 @@ $(PLATFORM)-teardown:
 	sudo ifconfig tap0 down
 	sudo openvpn --rmtun --dev tap0
 
-.PHONY: $(PLATFORM)-setup $(PLATFORM)-teardown
+$(PLATFORM)-run:
+	$(PYTHON) -u ./sim.py \
+		--platform=$(PLATFORM) \
+		--target=$(TARGET) \
+		--cpu-type=$(CPU) \
+		--iprange=$(TFTP_IPRANGE) \
+		$(SIM_ARGS)
+
+.PHONY: $(PLATFORM)-setup $(PLATFORM)-teardown $(PLATFORM)-run
@@ -63,6 +63,7 @@ class BaseSoC(SoCSDRAM):
             write_latency=0
         )
         self.submodules.sdrphy = SDRAMPHYModel(sdram_module, phy_settings)
+        self.sdram_module = sdram_module
         controller_settings = ControllerSettings(with_refresh=False)
         self.register_sdram(self.sdrphy,
                             sdram_module.geom_settings,
@@ -1,5 +1,7 @@
 from litedram.frontend.bist import LiteDRAMBISTGenerator, LiteDRAMBISTChecker
 
+from gateware.memtest import LiteDRAMBISTErrorLog
+
 from targets.sim.net import NetSoC as BaseSoC
 
 
@@ -7,10 +9,11 @@ class MemTestSoC(BaseSoC):
     def __init__(self, platform, *args, **kwargs):
         BaseSoC.__init__(self, platform, *args, **kwargs)
 
-        self.submodules.generator = LiteDRAMBISTGenerator(
-            self.sdram.crossbar.get_port(mode="write"),
-        )
+        generator_port = self.sdram.crossbar.get_port(mode="write")
+        self.submodules.generator = LiteDRAMBISTGenerator(generator_port)
         self.add_csr("generator")
+        # Lets the host scripts (test/bist.py) count in port words.
+        self.add_constant("BIST_PORT_WIDTH", generator_port.data_width)
         #self.submodules.checker = LiteDRAMBISTChecker(
         #    self.sdram.crossbar.get_port(mode="read", data_width=16),
         #    clock_domain="hdmi_out1_pix",
@@ -21,5 +24,15 @@ class MemTestSoC(BaseSoC):
         )
         self.add_csr("checker")
 
+        # SDR with a single phase, so a port word is one column
+        geom = self.sdram_module.geom_settings
+        self.submodules.checker_errors = LiteDRAMBISTErrorLog(
+            self.checker,
+            databits=self.sdrphy.settings.dfi_databits,
+            nbanks=2**geom.bankbits,
+            bank_offset=geom.colbits,
+        )
+        self.add_csr("checker_errors")
+
 
 SoC = MemTestSoC
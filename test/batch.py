@@ -0,0 +1,384 @@
+"""
+Batched CSR access.
+
+Every RemoteClient register read is a full round trip to the board. A
+CSRBatch queues reads and writes instead, coalesces them into Etherbone
+records (a burst of writes followed by a list of reads) and sends them as
+a few packets, all in flight at once. Reads return futures which resolve
+when the packet carrying them comes back.
+
+    with CSRBatch(wb) as b:
+        b.write(wb.regs.sdram_dfii_pi0_address, 0x408)
+        b.write(wb.regs.sdram_dfii_pi0_baddress, 2)
+        b.write(wb.regs.sdram_dfii_pi0_command_issue, 1)
+        phase = b.read(wb.regs.hdmi_in0_data0_cap_phase)
+    print(phase.result())
+
+Operations reach the board in the order they were queued.
+"""
+
+import collections
+import socket
+import time
+
+from concurrent.futures import Future
+
+from litex.tools.remote.etherbone import EtherbonePacket, EtherboneRecord
+from litex.tools.remote.etherbone import EtherboneReads, EtherboneWrites
+
+
+# Etherbone counts writes and reads in a record with a byte.
+MAX_RECORD_OPS = 255
+
+# Spacing of the return addresses used to tag reads, larger than the
+# biggest read list of a record.
+TAG_STRIDE = 4*(MAX_RECORD_OPS+1)
+
+
+def reg_width(reg):
+    # CSRRegister grew data_width, older versions call it busword.
+    return getattr(reg, "data_width", getattr(reg, "busword", 8))
+
+
+def split_value(value, length, width):
+    """Split a CSR value into bus words, most significant first.
+
+    >>> split_value(0x12345678, 4, 8)
+    [18, 52, 86, 120]
+    >>> split_value(0x12345678, 1, 32)
+    [305419896]
+    """
+    mask = (1 << width) - 1
+    return [(value >> (width*(length-1-i))) & mask for i in range(length)]
+
+
+def join_value(datas, width):
+    """
+    >>> hex(join_value([0x12, 0x34, 0x56, 0x78], 8))
+    '0x12345678'
+    """
+    value = 0
+    for d in datas:
+        value = (value << width) | d
+    return value
+
+
+class Record:
+    def __init__(self):
+        self.write_base = None
+        self.write_datas = []
+        self.read_addrs = []
+        # (future, number of words, word width) for each queued read, a
+        # width of None returns the words as a list.
+        self.read_groups = []
+        self.tag = None
+        # Whether the writes can safely be done twice.
+        self.idempotent = True
+
+    def can_write(self, addr, n):
+        if self.read_addrs:
+            return False
+        if self.write_base is None:
+            return n <= MAX_RECORD_OPS
+        return (addr == self.write_base + 4*len(self.write_datas)
+                and len(self.write_datas) + n <= MAX_RECORD_OPS)
+
+    def can_read(self, n):
+        return len(self.read_addrs) + n <= MAX_RECORD_OPS
+
+    def size(self):
+        size = 4
+        if self.write_datas:
+            size += 4 + 4*len(self.write_datas)
+        if self.read_addrs:
+            size += 4 + 4*len(self.read_addrs)
+        return size
+
+    def encode(self):
+        record = EtherboneRecord()
+        if self.write_datas:
+            record.writes = EtherboneWrites(base_addr=self.write_base, datas=self.write_datas)
+            record.wcount = len(record.writes)
+        if self.read_addrs:
+            record.reads = EtherboneReads(base_ret_addr=self.tag, addrs=self.read_addrs)
+            record.rcount = len(record.reads)
+        return record
+
+    def resolve(self, datas):
+        assert len(datas) == len(self.read_addrs), (
+            "Wanted {} words, got {}".format(len(self.read_addrs), len(datas)))
+        i = 0
+        for future, n, width in self.read_groups:
+            if width is None:
+                future.set_result(datas[i:i+n])
+            else:
+                future.set_result(join_value(datas[i:i+n], width))
+            i += n
+
+    def fail(self, e):
+        for future, n, width in self.read_groups:
+            future.set_exception(e)
+
+
+class ServerTransport:
+    """Pipelines packets through the litex_server connection of a RemoteClient.
+
+    The server only looks at the first record of each packet, so every
+    record gets a packet of its own, but up to window reads are kept in
+    flight before waiting for their replies.
+    """
+    max_records = 1
+    max_bytes = None
+
+    def __init__(self, wb, window=64):
+        self.wb = wb
+        self.window = window
+
+    def _receive(self, record):
+        reply = EtherbonePacket(init=self.wb.receive_packet(self.wb.socket))
+        reply.decode()
+        record.resolve(reply.records.pop().writes.get_datas())
+
+    def exchange(self, packets):
+        """Send (packet, records) pairs, resolving the reads of each record."""
+        # Replies come back in order, one per record with reads.
+        inflight = collections.deque()
+        for packet, records in packets:
+            while len(inflight) >= self.window:
+                self._receive(inflight.popleft())
+            self.wb.send_packet(self.wb.socket, packet)
+            inflight.extend(r for r in records if r.read_addrs)
+        while inflight:
+            self._receive(inflight.popleft())
+
+
+class UDPTransport:
+    """Sends multi-record packets straight to the board's Etherbone core.
+
+    Borrows the UDP socket of the litex_server started by connect() (the
+    board always answers to the same port) and takes the server's lock, so
+    other clients wait while a batch is on the wire. Up to window packets
+    with reads are kept in flight and replies are matched to records by
+    the return address of their reads.
+
+    Write-only packets get no reply, so nothing limits how many are in
+    flight; follow writes with a read to pace them.
+
+    Lost replies are retried by resending their packet. A packet with
+    writes (unless they are idempotent) is only sent once every earlier
+    read has been answered, so a resent read can never overtake a write
+    queued after it, and it is never resent itself as a lost reply doesn't
+    tell whether the writes were done.
+    """
+    max_records = 16
+    # Keep packets inside an Ethernet frame.
+    max_bytes = 1400
+
+    def __init__(self, server, window=16, timeout=0.1, retries=5):
+        self.server = server
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+
+    def _sockets(self):
+        comm = self.server.comm
+        if hasattr(comm, "tx_socket"):
+            return comm.tx_socket, comm.rx_socket
+        return comm.socket, comm.socket
+
+    def exchange(self, packets):
+        while self.server.lock:
+            time.sleep(0.001)
+        self.server.lock = True
+        tx, rx = self._sockets()
+        old_timeout = rx.gettimeout()
+        rx.settimeout(self.timeout)
+        try:
+            self._exchange(tx, rx, packets)
+        finally:
+            rx.settimeout(old_timeout)
+            self.server.lock = False
+
+    def _exchange(self, tx, rx, packets):
+        dest = (self.server.comm.server, self.server.comm.port)
+        queue = collections.deque(packets)
+        # Records waiting for a reply, by tag, and the packets carrying them.
+        inflight = {}
+        outstanding = collections.OrderedDict()
+        retries = self.retries
+        while queue or inflight:
+            while queue and len(outstanding) < self.window:
+                packet, records = queue[0]
+                if inflight and any(r.write_datas and not r.idempotent for r in records):
+                    break
+                queue.popleft()
+                tx.sendto(packet_bytes(packet), dest)
+                reads = [r for r in records if r.read_addrs]
+                if reads:
+                    outstanding[id(packet)] = (packet, records, reads)
+                    for r in reads:
+                        inflight[r.tag] = (id(packet), r)
+            if not inflight:
+                continue
+
+            try:
+                data, _ = rx.recvfrom(8192)
+            except socket.timeout:
+                lost = list(outstanding.values())
+                if not retries or any(r.write_datas and not r.idempotent
+                                      for _, records, _ in lost for r in records):
+                    e = TimeoutError("No reply for {} Etherbone reads".format(len(inflight)))
+                    for _, r in inflight.values():
+                        r.fail(e)
+                    raise e
+                retries -= 1
+                for packet, _, _ in lost:
+                    tx.sendto(packet_bytes(packet), dest)
+                continue
+
+            reply = EtherbonePacket(init=data)
+            reply.decode()
+            for record in reply.records:
+                if record.writes is None or record.writes.base_addr not in inflight:
+                    continue
+                key, r = inflight.pop(record.writes.base_addr)
+                r.resolve(record.writes.get_datas())
+                reads = outstanding[key][2]
+                reads.remove(r)
+                if not reads:
+                    del outstanding[key]
+                    retries = self.retries
+
+
+class PlainTransport:
+    """Runs records one at a time through a client's read() and write().
+
+    For bridges which don't speak Etherbone to a litex_server, reads of
+    consecutive addresses are still done as one burst.
+    """
+    max_records = 1
+    max_bytes = None
+
+    def __init__(self, wb):
+        self.wb = wb
+
+    def exchange(self, packets):
+        for packet, records in packets:
+            for r in records:
+                if r.write_datas:
+                    self.wb.write(r.write_base, r.write_datas)
+                if r.read_addrs:
+                    datas = []
+                    for addr, n in bursts(r.read_addrs):
+                        datas += self.wb.read(addr, n)
+                    r.resolve(datas)
+
+
+def bursts(addrs):
+    """Split addresses into runs of consecutive words.
+
+    >>> list(bursts([0, 4, 8, 0x100, 0x104, 0]))
+    [(0, 3), (256, 2), (0, 1)]
+    """
+    start, n = None, 0
+    for addr in addrs:
+        if start is not None and addr == start + 4*n:
+            n += 1
+            continue
+        if start is not None:
+            yield start, n
+        start, n = addr, 1
+    if start is not None:
+        yield start, n
+
+
+def packet_bytes(packet):
+    # Newer Etherbone packets keep their encoding in .bytes.
+    return getattr(packet, "bytes", None) or bytes(packet)
+
+
+def get_transport(wb):
+    server = getattr(wb, "server", None)
+    if server is not None and type(server.comm).__name__ == "CommUDP":
+        return UDPTransport(server)
+    if hasattr(wb, "send_packet"):
+        return ServerTransport(wb)
+    return PlainTransport(wb)
+
+
+class CSRBatch:
+    def __init__(self, wb, transport=None):
+        self.wb = wb
+        self.transport = transport or get_transport(wb)
+        self.records = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.flush()
+
+    def _record(self):
+        if not self.records:
+            self.records.append(Record())
+        return self.records[-1]
+
+    def write_words(self, addr, datas, idempotent=False):
+        """Queue writes of datas to consecutive words from addr.
+
+        Only idempotent writes (like plain memory) may be resent when a
+        reply is lost.
+        """
+        record = self._record()
+        if not record.can_write(addr, len(datas)):
+            record = Record()
+            self.records.append(record)
+        if record.write_base is None:
+            record.write_base = addr
+        record.write_datas.extend(datas)
+        record.idempotent &= idempotent
+
+    def read_words(self, addr, n, width=32):
+        """Queue a read of n words, returning a future for their value.
+
+        With width=None the future gives the list of words instead.
+        """
+        record = self._record()
+        if not record.can_read(n):
+            record = Record()
+            self.records.append(record)
+        future = Future()
+        record.read_addrs.extend(addr + 4*i for i in range(n))
+        record.read_groups.append((future, n, width))
+        return future
+
+    def write(self, reg, value):
+        self.write_words(reg.addr, split_value(value, reg.length, reg_width(reg)))
+
+    def read(self, reg):
+        return self.read_words(reg.addr, reg.length, reg_width(reg))
+
+    def flush(self):
+        records, self.records = self.records, []
+        for i, r in enumerate(records):
+            r.tag = i*TAG_STRIDE
+
+        groups = []
+        size = 0
+        max_bytes = self.transport.max_bytes
+        for r in records:
+            if (not groups or len(groups[-1]) == self.transport.max_records
+                    or (max_bytes and size + r.size() > max_bytes)):
+                groups.append([])
+                size = 0
+            groups[-1].append(r)
+            size += r.size()
+
+        packets = []
+        for group in groups:
+            packet = EtherbonePacket()
+            packet.records = [r.encode() for r in group]
+            packet.encode()
+            packets.append((packet, group))
+        self.transport.exchange(packets)
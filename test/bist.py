@@ -0,0 +1,177 @@
+"""
+Runs the LiteDRAM BIST generator and checker from the host.
+
+Memory is covered in chunks, the checker reads back a chunk while the
+generator writes the next one, so both DRAM ports are kept busy. All the
+CSR accesses of a step go in one batch.
+
+Lengths and bases are in DRAM port words, like the BIST cores use them.
+"""
+
+import time
+
+from batch import CSRBatch
+
+
+# Poll interval while waiting for the BIST cores.
+POLL = 0.001
+
+# Data width of the BIST DRAM ports (bits), when the design doesn't give it.
+PORT_WIDTH = 128
+
+
+def get_port_width(wb, default=PORT_WIDTH):
+    """Data width of the BIST DRAM ports (bits), from the BIST_PORT_WIDTH
+    constant of the design."""
+    return int(getattr(wb.constants, "bist_port_width", default))
+
+
+class Engine:
+    """The CSRs of a LiteDRAMBISTGenerator or LiteDRAMBISTChecker."""
+
+    def __init__(self, wb, name):
+        self.name = name
+        self.reset = getattr(wb.regs, name + "_reset")
+        self.start = getattr(wb.regs, name + "_start")
+        self.done = getattr(wb.regs, name + "_done")
+        self.base = getattr(wb.regs, name + "_base")
+        self.length = getattr(wb.regs, name + "_length")
+        # Only in newer LiteDRAM.
+        self.ticks = getattr(wb.regs, name + "_ticks", None)
+        # Only in the checker.
+        self.err_count = getattr(wb.regs, name + "_err_count", None)
+
+    def run(self, b, base, length):
+        """Queue a run over length words from base on batch b."""
+        b.write(self.reset, 1)
+        b.write(self.reset, 0)
+        b.write(self.base, base)
+        b.write(self.length, length)
+        b.write(self.start, 1)
+
+    def status(self, b):
+        """Queue reads of done, ticks and err_count, as futures."""
+        return [b.read(r) if r is not None else None
+                for r in (self.done, self.ticks, self.err_count)]
+
+
+def wait(wb, engines, timeout):
+    """Wait for all engines, returns {engine: (ticks, err_count)}."""
+    end = time.time() + timeout
+    pending = list(engines)
+    result = {}
+    while True:
+        with CSRBatch(wb) as b:
+            status = [(e, e.status(b)) for e in pending]
+        pending = []
+        for e, (done, ticks, err_count) in status:
+            if done.result():
+                result[e] = tuple(f.result() if f is not None else None for f in (ticks, err_count))
+            else:
+                pending.append(e)
+        if not pending:
+            return result
+        assert time.time() < end, "BIST {} timed out".format(
+            ", ".join(e.name for e in pending))
+        time.sleep(POLL)
+
+
+class Result:
+    def __init__(self):
+        self.words = 0
+        self.errors = 0
+        self.bad_chunks = []
+        self.ticks = {"generator": 0, "checker": 0}
+        self.seconds = 0
+
+    def bandwidth(self, word_bytes, clk_freq=None):
+        """MB/s of the generator and the checker.
+
+        From the cycle counters when the cores have them, otherwise from
+        the host time of the whole (overlapped) run.
+        """
+        size = self.words*word_bytes
+        bw = {}
+        for name, ticks in self.ticks.items():
+            if clk_freq and ticks:
+                bw[name] = size*clk_freq/ticks/1e6
+            elif self.seconds:
+                bw[name] = size/self.seconds/1e6
+        return bw
+
+
+def chunks(base, length, chunk):
+    """Split length words from base into chunks.
+
+    >>> list(chunks(0, 10, 4))
+    [(0, 4), (4, 4), (8, 2)]
+    """
+    for pos in range(0, length, chunk):
+        yield base + pos, min(chunk, length - pos)
+
+
+def run(wb, base, length, chunk, timeout=10, progress=None):
+    """Write then check length words from base, chunk words at a time."""
+    generator = Engine(wb, "generator")
+    checker = Engine(wb, "checker")
+    assert checker.err_count is not None, "The BIST checker has no err_count register"
+    result = Result()
+    start = time.time()
+
+    def add(status, checked=None):
+        for e, (ticks, err_count) in status.items():
+            result.ticks[e.name] += ticks or 0
+        if checked is not None:
+            errors = status[checker][1]
+            result.words += checked[1]
+            result.errors += errors
+            if errors:
+                result.bad_chunks.append((checked[0], checked[1], errors))
+            if progress:
+                progress(result)
+
+    parts = list(chunks(base, length, chunk))
+    with CSRBatch(wb) as b:
+        generator.run(b, *parts[0])
+    add(wait(wb, [generator], timeout))
+    for i, part in enumerate(parts):
+        engines = [checker]
+        with CSRBatch(wb) as b:
+            checker.run(b, *part)
+            if i+1 < len(parts):
+                generator.run(b, *parts[i+1])
+                engines.append(generator)
+        add(wait(wb, engines, timeout), part)
+
+    result.seconds = time.time() - start
+    return result
+
+
+def read_error_log(wb, name="checker_errors"):
+    """Pull the whole log of a LiteDRAMBISTErrorLog and clear it.
+
+    Returns a dict with the errors and overflow counts, the per bank and
+    per DQ bit counts and the logged (address, mask) pairs.
+    """
+    regs = {n[len(name)+1:]: r for n, r in wb.regs.d.items() if n.startswith(name + "_")}
+    banks = sorted((r for r in regs if r.startswith("bank")), key=lambda r: int(r[4:-7]))
+    dqs = sorted((r for r in regs if r.startswith("dq")), key=lambda r: int(r[2:-7]))
+
+    with CSRBatch(wb) as b:
+        counts = {r: b.read(regs[r]) for r in ["errors", "overflow", "level"] + banks + dqs}
+    counts = {r: f.result() for r, f in counts.items()}
+
+    with CSRBatch(wb) as b:
+        entries = []
+        for i in range(counts["level"]):
+            entries.append((b.read(regs["address"]), b.read(regs["mask"])))
+            b.write(regs["pop"], 1)
+        b.write(regs["reset"], 1)
+
+    return {
+        "errors": counts["errors"],
+        "overflow": counts["overflow"],
+        "banks": [counts[r] for r in banks],
+        "dq": [counts[r] for r in dqs],
+        "entries": [(a.result(), m.result()) for a, m in entries],
+    }
@@ -0,0 +1,120 @@
+"""
+Bulk memory transfers over Etherbone.
+
+Reads and writes are split into full Etherbone records and sent through
+a CSRBatch, which keeps a window of packets in flight (and retries lost
+UDP replies) instead of waiting for every block in turn. Each block of
+writes reads back its last word, which paces the writes and checks they
+arrived.
+
+Data is passed as 32-bit words, either as anything numpy can turn into a
+uint32 array or as bytes (a big-endian memory image).
+"""
+
+import time
+
+import numpy
+
+from batch import CSRBatch, MAX_RECORD_OPS
+
+
+# Words queued before waiting for the batch, so progress can be reported.
+SEGMENT_WORDS = 64*1024
+
+
+def as_words(data):
+    """
+    >>> as_words(b"\\x12\\x34\\x56\\x78\\x00\\x00\\x00\\x01")
+    array([305419896,         1], dtype=uint32)
+    >>> as_words([1, 2, 3])
+    array([1, 2, 3], dtype=uint32)
+    """
+    if isinstance(data, (bytes, bytearray)) or (
+            isinstance(data, memoryview) and data.format == "B"):
+        return numpy.frombuffer(data, dtype=">u4").astype(numpy.uint32)
+    return numpy.asarray(data, dtype=numpy.uint32).reshape(-1)
+
+
+class Throughput:
+    def __init__(self, desc, nbytes, verbose=True):
+        self.desc = desc
+        self.nbytes = nbytes
+        self.verbose = verbose
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.time() - self.start
+        if self.verbose and exc[0] is None:
+            print("{}: {} bytes in {:.2f}s ({:.2f} kbytes/s)".format(
+                self.desc, self.nbytes, self.seconds,
+                self.nbytes/max(self.seconds, 1e-9)/1024))
+
+
+def read(wb, addr, length, out=None, progress=None, verbose=True):
+    """Read length words from addr into a uint32 array (or out)."""
+    if out is None:
+        out = numpy.empty(length, dtype=numpy.uint32)
+    words = numpy.asarray(out).reshape(-1)
+    assert len(words) >= length, "Output too small ({} < {} words)".format(len(words), length)
+
+    with Throughput("Read 0x{:08x}".format(addr), 4*length, verbose):
+        for seg in range(0, length, SEGMENT_WORDS):
+            seg_end = min(seg + SEGMENT_WORDS, length)
+            chunks = []
+            with CSRBatch(wb) as b:
+                for pos in range(seg, seg_end, MAX_RECORD_OPS):
+                    n = min(MAX_RECORD_OPS, seg_end - pos)
+                    chunks.append((pos, n, b.read_words(addr + 4*pos, n, None)))
+            for pos, n, f in chunks:
+                words[pos:pos+n] = f.result()
+            if progress:
+                progress(seg_end)
+    return out
+
+
+def read_bytes(wb, addr, length, **kw):
+    """Read length bytes (a multiple of 4) as a big-endian memory image."""
+    assert length % 4 == 0, "Length must be whole words ({})".format(length)
+    return read(wb, addr, length//4, **kw).astype(">u4").tobytes()
+
+
+def write(wb, addr, data, verify=False, retries=3, progress=None, verbose=True):
+    """Write words to memory at addr.
+
+    With verify all the data is read back and the blocks which differ are
+    written again.
+    """
+    words = as_words(data)
+    length = len(words)
+
+    with Throughput("Write 0x{:08x}".format(addr), 4*length, verbose):
+        for seg in range(0, length, SEGMENT_WORDS):
+            seg_end = min(seg + SEGMENT_WORDS, length)
+            acks = []
+            with CSRBatch(wb) as b:
+                for pos in range(seg, seg_end, MAX_RECORD_OPS):
+                    n = min(MAX_RECORD_OPS, seg_end - pos)
+                    b.write_words(addr + 4*pos, words[pos:pos+n].tolist(), idempotent=True)
+                    acks.append((pos+n-1, b.read_words(addr + 4*(pos+n-1), 1, None)))
+            for pos, f in acks:
+                assert f.result()[0] == words[pos], (
+                    "Write to 0x{:08x} didn't arrive".format(addr + 4*pos))
+            if progress:
+                progress(seg_end)
+
+    if not verify:
+        return
+    for i in range(retries+1):
+        readback = read(wb, addr, length, verbose=verbose)
+        bad = numpy.flatnonzero(readback != words)
+        if not len(bad):
+            return
+        assert i < retries, "{} words at 0x{:08x} didn't verify".format(len(bad), addr)
+        with CSRBatch(wb) as b:
+            for pos in numpy.unique(bad // MAX_RECORD_OPS) * MAX_RECORD_OPS:
+                pos = int(pos)
+                n = min(MAX_RECORD_OPS, length - pos)
+                b.write_words(addr + 4*pos, words[pos:pos+n].tolist(), idempotent=True)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Calibrate the data channel delays of an HDMI input.
+
+All three channels are searched at the same time, each measurement round
+moves every channel to its next tap together (in one CSR batch, or one
+batch per step between the busy polls of the Spartan-6 delays) and then
+waits for a single phase detector window. Master and slave delays always
+move together, as in the firmware. A coarse sweep finds a tap inside the
+eye, binary searches then find its edges and each channel is set to the
+middle of its eye.
+
+Taps where the phase detector reports errors are known bad straight
+away, only taps which look good are measured again with longer windows,
+so most of the search runs with short windows.
+
+The result is written as a calibration profile for the board (by DNA),
+which --apply loads again without searching.
+"""
+
+import datetime
+import json
+import time
+
+from common import *
+
+
+# dly_ctl of the Spartan-6 data capture (PLL clocking), see firmware/hdmi_in0.c
+DVISAMPLER_DELAY_MASTER_CAL = 0x01
+DVISAMPLER_DELAY_MASTER_RST = 0x02
+DVISAMPLER_DELAY_SLAVE_CAL  = 0x04
+DVISAMPLER_DELAY_SLAVE_RST  = 0x08
+DVISAMPLER_DELAY_INC        = 0x10
+DVISAMPLER_DELAY_DEC        = 0x20
+
+# dly_ctl of the 7-series data capture (MMCM clocking), see firmware/extra-flags.h
+DVISAMPLER_DELAY_RST        = 0x01
+DVISAMPLER_DELAY_MASTER_INC = 0x02
+DVISAMPLER_DELAY_MASTER_DEC = 0x04
+DVISAMPLER_DELAY_SLAVE_INC  = 0x08
+DVISAMPLER_DELAY_SLAVE_DEC  = 0x10
+
+# Spartan-6 IODELAY2s are busy for a few cycles after each command.
+DELAY_BUSY_TIMEOUT = 0.1
+
+DVISAMPLER_TOO_LATE  = 0x1
+DVISAMPLER_TOO_EARLY = 0x2
+
+
+class Channel:
+    def __init__(self, wb, name, n):
+        self.n = n
+        self.dly_ctl = getattr(wb.regs, "{}_data{}_cap_dly_ctl".format(name, n))
+        self.dly_busy = getattr(wb.regs, "{}_data{}_cap_dly_busy".format(name, n), None)
+        self.phase = getattr(wb.regs, "{}_data{}_cap_phase".format(name, n))
+        self.phase_reset = getattr(wb.regs, "{}_data{}_cap_phase_reset".format(name, n))
+        self.delay = None
+
+
+class DelayLines:
+    """Moves the master and slave delays of the data channels together.
+
+    The dly_ctl bits depend on the FPGA family, told apart like the
+    firmware does by the clocking of the input: Spartan-6 inputs have a
+    PLL, 7-series inputs an MMCM.
+    """
+    def __init__(self, wb, name, channels):
+        self.wb = wb
+        self.channels = channels
+        self.s6 = hasattr(wb.regs, "{}_clocking_pll_reset".format(name))
+        if not self.s6 and not hasattr(wb.regs, "{}_clocking_mmcm_reset".format(name)):
+            raise SystemExit("{} has neither PLL nor MMCM clocking".format(name))
+        self.freq = getattr(wb.regs, "{}_freq_value".format(name), None)
+        if self.s6:
+            self.inc = DVISAMPLER_DELAY_INC
+            self.dec = DVISAMPLER_DELAY_DEC
+        else:
+            self.inc = DVISAMPLER_DELAY_MASTER_INC | DVISAMPLER_DELAY_SLAVE_INC
+            self.dec = DVISAMPLER_DELAY_MASTER_DEC | DVISAMPLER_DELAY_SLAVE_DEC
+
+    def wait_busy(self, channels):
+        deadline = time.time() + DELAY_BUSY_TIMEOUT
+        while True:
+            with CSRBatch(self.wb) as b:
+                busy = [b.read(c.dly_busy) for c in channels]
+            if not any(r.result() for r in busy):
+                return
+            if time.time() > deadline:
+                raise SystemExit("IDELAY busy timeout ({})".format(
+                    " ".join("{:x}".format(r.result()) for r in busy)))
+
+    def command(self, commands):
+        """Write a dly_ctl command per channel, waiting for the S6 delays."""
+        with CSRBatch(self.wb) as b:
+            for c, ctl in commands.items():
+                b.write(c.dly_ctl, ctl)
+        if self.s6:
+            self.wait_busy(list(commands))
+
+    def reset(self, channels):
+        if self.s6:
+            self.command({c: DVISAMPLER_DELAY_MASTER_CAL | DVISAMPLER_DELAY_SLAVE_CAL for c in channels})
+            self.command({c: DVISAMPLER_DELAY_MASTER_RST | DVISAMPLER_DELAY_SLAVE_RST for c in channels})
+        else:
+            self.command({c: DVISAMPLER_DELAY_RST for c in channels})
+            # The slave (phase detector) sits 90 degrees after the
+            # master, 78 ps taps, freq in 10 kHz units.
+            freq = self.freq.read()//10000 if self.freq is not None else 0
+            assert freq, "No pixel clock on the input"
+            with CSRBatch(self.wb) as b:
+                for i in range(10000000//(4*freq*78)):
+                    for c in channels:
+                        b.write(c.dly_ctl, DVISAMPLER_DELAY_SLAVE_INC)
+        for c in channels:
+            c.delay = 0
+
+    def set_delays(self, delays):
+        """Move each channel to its delay (None to leave it)."""
+        delays = {c: d for c, d in delays.items() if d is not None}
+        self.reset([c for c in delays if c.delay is None])
+        if self.s6:
+            # One step of every channel at a time, between busy polls.
+            while any(c.delay != d for c, d in delays.items()):
+                commands = {}
+                for c, d in delays.items():
+                    if c.delay != d:
+                        commands[c] = self.inc if d > c.delay else self.dec
+                        c.delay += 1 if d > c.delay else -1
+                self.command(commands)
+        else:
+            with CSRBatch(self.wb) as b:
+                for c, d in delays.items():
+                    step = self.inc if d > c.delay else self.dec
+                    for i in range(abs(d - c.delay)):
+                        b.write(c.dly_ctl, step)
+                    c.delay = d
+
+
+class Calibration:
+    def __init__(self, wb, lines, taps=32, min_window=0.01, max_window=0.1, verbose=True):
+        self.wb = wb
+        self.lines = lines
+        self.channels = lines.channels
+        self.taps = taps
+        self.min_window = min_window
+        self.max_window = max_window
+        self.verbose = verbose
+        self.rounds = 0
+
+    def measure(self, delays):
+        """Phase status of each channel at its delay (None to skip it).
+
+        Errors are conclusive, a clean window is repeated with twice the
+        length until max_window.
+        """
+        status = {c: None for c, d in delays.items() if d is not None}
+        self.lines.set_delays(delays)
+        window = self.min_window
+        pending = list(status)
+        while pending:
+            with CSRBatch(self.wb) as b:
+                for c in pending:
+                    b.write(c.phase_reset, 1)
+            time.sleep(window)
+            with CSRBatch(self.wb) as b:
+                phases = [(c, b.read(c.phase)) for c in pending]
+            self.rounds += 1
+            pending = []
+            for c, phase in phases:
+                status[c] = phase.result() & 0x3
+                if not status[c] and window < self.max_window:
+                    pending.append(c)
+            window *= 2
+        return status
+
+    def edge(self, good, bad):
+        """Binary search, for every channel, the last good tap from good towards bad."""
+        good = dict(good)
+        bad = dict(bad)
+        while True:
+            probes = {
+                c: (good[c] + bad[c])//2 if abs(bad[c] - good[c]) > 1 else None
+                for c in self.channels}
+            if all(p is None for p in probes.values()):
+                return good
+            for c, s in self.measure(probes).items():
+                if s:
+                    bad[c] = probes[c]
+                else:
+                    good[c] = probes[c]
+
+    def run(self, stride=4):
+        # Coarse sweep of every channel together.
+        coarse = {c: {} for c in self.channels}
+        for delay in range(0, self.taps, stride):
+            for c, s in self.measure({c: delay for c in self.channels}).items():
+                coarse[c][delay] = s
+                if self.verbose:
+                    print("CHAN: {:d} / DELAY: {:2d} / TOO_LATE: {:d} / TOO_EARLY: {:d}".format(
+                        c.n, delay, bool(s & DVISAMPLER_TOO_LATE), bool(s & DVISAMPLER_TOO_EARLY)))
+
+        # The longest run of good coarse taps, with the bad
+        # taps around it (or the ends of the delay line).
+        start, left, right = {}, {}, {}
+        for c, points in coarse.items():
+            runs = []
+            for delay in sorted(points):
+                if points[delay]:
+                    continue
+                if runs and runs[-1][1] == delay - stride:
+                    runs[-1][1] = delay
+                else:
+                    runs.append([delay, delay])
+            assert runs, "No eye found on channel {}".format(c.n)
+            lo, hi = max(runs, key=lambda r: r[1] - r[0])
+            start[c] = lo, hi
+            left[c] = lo - stride if lo - stride >= 0 else -1
+            right[c] = hi + stride if hi + stride < self.taps else self.taps
+
+        # Only search edges which are inside the delay line.
+        low = self.edge({c: start[c][0] for c in self.channels}, left)
+        high = self.edge({c: start[c][1] for c in self.channels}, right)
+
+        result = {}
+        for c in self.channels:
+            result[c] = (low[c], high[c], (low[c] + high[c])//2)
+        return result
+
+
+def get_profile_filename(args, name, dna):
+    return os.path.join(TOP_DIR, get_testdir(args), "calibration", "{}-{}.json".format(name, dna))
+
+
+def apply_delays(lines, delays):
+    lines.set_delays({c: delays[c.n] for c in lines.channels})
+
+
+def add_args(parser):
+    parser.add_argument("--input", default="hdmi_in0",
+                        help="HDMI input to calibrate")
+    parser.add_argument("--taps", default=32, type=int,
+                        help="Number of taps of the delay lines")
+    parser.add_argument("--min-window", default=0.01, type=float,
+                        help="Shortest phase measurement, in seconds")
+    parser.add_argument("--max-window", default=0.1, type=float,
+                        help="Longest phase measurement, in seconds")
+    parser.add_argument("--profile", default=None,
+                        help="Calibration profile to write (default: per board DNA in the test directory)")
+    parser.add_argument("--apply", default=None, metavar="PROFILE",
+                        help="Set the delays from a calibration profile instead of searching")
+
+
+def main():
+    args, wb = connect(__doc__, add_args=add_args)
+    channels = [Channel(wb, args.input, n) for n in range(3)]
+    lines = DelayLines(wb, args.input, channels)
+
+    if args.apply:
+        profile = json.load(open(args.apply))
+        apply_delays(lines, {c["channel"]: c["delay"] for c in profile["channels"]})
+        print("Applied delays from {}".format(args.apply))
+        wb.close()
+        return
+
+    start = time.time()
+    calibration = Calibration(wb, lines, args.taps, args.min_window, args.max_window)
+    result = calibration.run()
+    seconds = time.time() - start
+
+    print()
+    print("{:8} {:>6} {:>6} {:>6}".format("Channel", "Low", "High", "Delay"))
+    print("-"*30)
+    for c, (low, high, delay) in result.items():
+        print("{:8} {:6} {:6} {:6}".format(c.n, low, high, delay))
+    print("-"*30)
+    print("{} measurement rounds in {:.1f}s".format(calibration.rounds, seconds))
+
+    apply_delays(lines, {c.n: delay for c, (low, high, delay) in result.items()})
+
+    dna = get_dna(wb)
+    filename = args.profile or get_profile_filename(args, args.input, dna)
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump({
+            "dna": dna,
+            "input": args.input,
+            "date": datetime.datetime.now().isoformat(),
+            "channels": [
+                {"channel": c.n, "low": low, "high": high, "delay": delay}
+                for c, (low, high, delay) in result.items()],
+        }, f, indent=2)
+    print("Calibration profile: {}".format(filename))
+
+    wb.close()
+
+
+if __name__ == "__main__":
+    main()
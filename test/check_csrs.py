@@ -1,37 +1,297 @@
 #!/usr/bin/env python3
-import sys
+"""
+Lint the CSR and memory map of a build (csr.csv or csr.json).
+
+Checks that no CSR registers or memory regions overlap, that everything
+is aligned, that every register is in the bank of the block it belongs
+to and that the banks fit the limits of the platform.
+
+Registers, banks and regions are put in interval trees, so each check is
+a lookup rather than a scan over all the others.
+"""
+
+import argparse
+import collections
 import csv
-import pprint
+import json
+import os
+import sys
+
+
+# Limits of a build, LIMITS updated with PLATFORM_LIMITS[platform]. No
+# platform needs other limits so far, the defaults apply to all of them.
+LIMITS = {
+    # Size of a CSR bank (bytes).
+    "bank_size": 0x800,
+    # Registers (CSR words) in one bank.
+    "bank_words": 200,
+    # Number of CSR banks.
+    "banks": 32,
+    # Size of the CSR region (bytes), when the map doesn't give it.
+    "csr_size": 0x10000,
+    # Alignment of memory regions.
+    "region_align": 0x1000,
+}
+PLATFORM_LIMITS = {
+}
+
+
+Register = collections.namedtuple("Register", ("name", "addr", "size", "mode"))
+Region = collections.namedtuple("Region", ("name", "base", "size", "type"))
+Map = collections.namedtuple("Map", ("bases", "registers", "regions", "constants"))
+
+
+class IntervalTree:
+    """Static centered interval tree of half open [start, end) intervals.
+
+    >>> t = IntervalTree([(0, 4, "a"), (4, 8, "b"), (2, 6, "c"), (10, 12, "d")])
+    >>> sorted(t.overlapping(3, 5))
+    ['a', 'b', 'c']
+    >>> sorted(t.overlapping(8, 10))
+    []
+    >>> sorted(t.containing(11))
+    ['d']
+    """
+
+    class Node:
+        def __init__(self, center, by_start, by_end, left, right):
+            self.center = center
+            self.by_start = by_start
+            self.by_end = by_end
+            self.left = left
+            self.right = right
+
+    def __init__(self, intervals):
+        self.root = self._build([i for i in intervals if i[1] > i[0]])
+
+    def _build(self, intervals):
+        if not intervals:
+            return None
+        starts = sorted(i[0] for i in intervals)
+        center = starts[len(starts)//2]
+        left, right, here = [], [], []
+        for i in intervals:
+            if i[1] <= center:
+                left.append(i)
+            elif i[0] > center:
+                right.append(i)
+            else:
+                here.append(i)
+        return self.Node(
+            center,
+            sorted(here, key=lambda i: i[0]),
+            sorted(here, key=lambda i: -i[1]),
+            self._build(left),
+            self._build(right))
+
+    def overlapping(self, start, end):
+        """Items of the intervals overlapping [start, end)."""
+        node = self.root
+        stack = [node] if node else []
+        while stack:
+            node = stack.pop()
+            if end <= node.center:
+                for s, e, item in node.by_start:
+                    if s >= end:
+                        break
+                    yield item
+            elif start > node.center:
+                for s, e, item in node.by_end:
+                    if e <= start:
+                        break
+                    yield item
+            else:
+                for s, e, item in node.by_start:
+                    yield item
+            if start < node.center and node.left:
+                stack.append(node.left)
+            if end > node.center and node.right:
+                stack.append(node.right)
+
+    def containing(self, point):
+        return self.overlapping(point, point+1)
+
+
+def load_csv(filename):
+    bases, registers, regions, constants = {}, [], [], {}
+    for row in csv.reader(open(filename)):
+        if not row or row[0].startswith("#"):
+            continue
+        row += [""]*(5 - len(row))
+        kind, name, value, size, extra = row[:5]
+        if kind == "csr_base":
+            bases[name] = int(value, 0)
+        elif kind == "csr_register":
+            registers.append(Register(name, int(value, 0), int(size), extra))
+        elif kind == "memory_region":
+            regions.append(Region(name, int(value, 0), int(size, 0), extra or None))
+        elif kind == "constant":
+            constants[name] = value
+    return Map(bases, registers, regions, constants)
+
+
+def load_json(filename):
+    d = json.load(open(filename))
+    return Map(
+        dict(d.get("csr_bases", {})),
+        [Register(n, r["addr"], r["size"], r.get("type", ""))
+         for n, r in d.get("csr_registers", {}).items()],
+        [Region(n, m["base"], m["size"], m.get("type"))
+         for n, m in d.get("memories", {}).items()],
+        dict(d.get("constants", {})))
+
+
+def load(filename):
+    if os.path.splitext(filename)[1] == ".json":
+        return load_json(filename)
+    return load_csv(filename)
+
+
+def get_limits(platform=None, overrides=()):
+    """
+    >>> get_limits(None, ["bank_words=300"])["bank_words"]
+    300
+    """
+    limits = dict(LIMITS)
+    limits.update(PLATFORM_LIMITS.get(platform, {}))
+    for o in overrides:
+        name, _, value = o.partition("=")
+        assert name in LIMITS, "Unknown limit {}".format(name)
+        limits[name] = int(value, 0)
+    return limits
+
+
+def overlaps(items, span):
+    """Pairs of overlapping items, span(item) giving its [start, end)."""
+    tree = IntervalTree((span(i)[0], span(i)[1], n) for n, i in enumerate(items))
+    for n, i in enumerate(items):
+        for m in tree.overlapping(*span(i)):
+            if m > n:
+                yield i, items[m]
+
+
+def contains(outer, inner):
+    """Whether region outer holds the whole of region inner.
+
+    Bus windows hold other regions, like the spiflash of flash XIP
+    platforms with the rom and user_flash in it.
+
+    >>> spiflash = Region("spiflash", 0x20000000, 0x200000, "cached")
+    >>> contains(spiflash, Region("rom", 0x20050000, 0x8000, "cached"))
+    True
+    >>> contains(spiflash, Region("sram", 0x201f0000, 0x20000, "cached"))
+    False
+    """
+    return outer.base <= inner.base and inner.base + inner.size <= outer.base + outer.size
+
+
+def check(m, limits):
+    """The problems of a map, as (kind, message), and the words used in each bank."""
+    errors = []
+
+    def error(kind, msg, *args):
+        errors.append((kind, msg.format(*args)))
+
+    # memory regions
+    for r in m.regions:
+        if r.base % limits["region_align"]:
+            error("alignment", "region {} at 0x{:08x} is not aligned to 0x{:x}",
+                  r.name, r.base, limits["region_align"])
+    for a, b in overlaps(m.regions, lambda r: (r.base, r.base + r.size)):
+        # Regions can hold other regions, if they hold them whole.
+        outer, inner = (a, b) if a.size >= b.size else (b, a)
+        if contains(outer, inner):
+            continue
+        error("overlap", "region {} (0x{:08x}+0x{:x}) overlaps {} (0x{:08x}+0x{:x})",
+              a.name, a.base, a.size, b.name, b.base, b.size)
+
+    # registers
+    for r in m.registers:
+        if r.addr % 4:
+            error("alignment", "register {} at 0x{:08x} is not word aligned", r.name, r.addr)
+    for a, b in overlaps(m.registers, lambda r: (r.addr, r.addr + 4*r.size)):
+        error("overlap", "register {} (0x{:08x}+{}) overlaps {} (0x{:08x}+{})",
+              a.name, a.addr, a.size, b.name, b.addr, b.size)
+
+    # csr region
+    csr = [r for r in m.regions if r.name == "csr"]
+    if csr:
+        csr_start, csr_end = csr[0].base, csr[0].base + csr[0].size
+    elif m.bases:
+        csr_start = min(m.bases.values())
+        csr_end = csr_start + limits["csr_size"]
+    else:
+        csr_start = csr_end = None
+    if csr_start is not None:
+        for r in m.registers:
+            if not csr_start <= r.addr < csr_end or r.addr + 4*r.size > csr_end:
+                error("region", "register {} at 0x{:08x} is outside the CSR region 0x{:08x}-0x{:08x}",
+                      r.name, r.addr, csr_start, csr_end)
+
+    # banks
+    bank_size = limits["bank_size"]
+    for name, base in sorted(m.bases.items()):
+        if base % bank_size:
+            error("alignment", "bank {} at 0x{:08x} is not aligned to 0x{:x}", name, base, bank_size)
+    for a, b in overlaps(sorted(m.bases.items()), lambda b: (b[1], b[1] + bank_size)):
+        error("overlap", "bank {} (0x{:08x}) overlaps {} (0x{:08x})", a[0], a[1], b[0], b[1])
+    if len(m.bases) > limits["banks"]:
+        error("budget", "{} CSR banks, the limit is {}", len(m.bases), limits["banks"])
+
+    banks = IntervalTree((base, base + bank_size, name) for name, base in m.bases.items())
+    words = collections.Counter()
+    for r in m.registers:
+        owner = list(banks.containing(r.addr))
+        if not owner:
+            if m.bases:
+                error("bank", "register {} at 0x{:08x} is not in any bank", r.name, r.addr)
+            continue
+        bank = owner[0]
+        words[bank] += r.size
+        if not r.name.startswith(bank + "_") and r.name != bank:
+            error("bank", "register {} at 0x{:08x} is in the bank of {}", r.name, r.addr, bank)
+        if r.addr + 4*r.size > m.bases[bank] + bank_size:
+            error("bank", "register {} runs past the end of bank {}", r.name, bank)
+    for bank, n in sorted(words.items()):
+        if n > limits["bank_words"]:
+            error("budget", "bank {} has {} CSR words, the limit is {}", bank, n, limits["bank_words"])
 
-print(sys.argv[1])
+    return errors, words
 
-data = list(csv.reader(open(sys.argv[1],'r')))
 
-bases = [x for x in data if x[0] == 'csr_base']
-regs = [x for x in data if x[0] == 'csr_register']
+def get_platform(filename):
+    """Guess the platform from a build/<platform>_<target>_<cpu>/test/ path."""
+    build = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(filename))))
+    platforms = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "platforms")
+    names = [n[:-3] for n in os.listdir(platforms) if n.endswith(".py")]
+    matches = [n for n in names if build.startswith(n + "_") or build.startswith(n + ".")]
+    return max(matches, key=len) if matches else None
 
-mem_map = []
-for _, name, loc, size, rw in regs:
-    mem_map.append((int(loc, 16), int(size), name))
-mem_map.sort()
 
-for i, (loc, size, name) in enumerate(mem_map[:-1]):
-    print("{:x} {} {}".format(loc, size, name))
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("filename", help="csr.csv or csr.json of a build")
+    parser.add_argument("--platform", default=None,
+                        help="Platform whose limits to use (default: from the build directory)")
+    parser.add_argument("--limit", default=[], action="append", metavar="NAME=VALUE",
+                        help="Override a limit ({})".format(", ".join(sorted(LIMITS))))
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Print the words used in each bank")
+    args = parser.parse_args()
 
-    nloc, nsize, nname = mem_map[i+1]
-    assert (loc + size*4) <= nloc, "{:x}+{} < {:x} ({} < {})".format(loc, size, nloc, name, nname)
+    m = load(args.filename)
+    limits = get_limits(args.platform or get_platform(args.filename), args.limit)
+    errors, words = check(m, limits)
 
-    assert loc < (0xe0000000 + (2**14)*4), "{:x} {}".format(loc, name)
+    if args.verbose:
+        for bank, n in sorted(words.items()):
+            print("{:30} {:4} / {}".format(bank, n, limits["bank_words"]))
+    for kind, msg in errors:
+        print("{}: {}: {}".format(args.filename, kind, msg))
+    print("{}: {} registers, {} banks, {} regions, {} problems".format(
+        args.filename, len(m.registers), len(m.bases), len(m.regions), len(errors)))
+    sys.exit(1 if errors else 0)
 
-regs_in_base = {}
-for _, name, loc, size, rw in regs:                                                             
-    for _, bname, base, _, _ in bases:
-        if name.startswith(bname):
-            if bname not in regs_in_base:
-                regs_in_base[bname] = []
-            regs_in_base[bname].append((int(loc, 16), name[len(bname)+1:], int(size), rw))
 
-for name, regs in sorted(regs_in_base.items()):
-    num_regs = sum(size for loc, name, size, rw in regs)
-    assert num_regs < 200
-    print(name, num_regs)
+if __name__ == "__main__":
+    main()
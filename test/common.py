@@ -12,6 +12,9 @@ TOP_DIR=os.path.join(os.path.dirname(__file__), "..")
 sys.path.append(TOP_DIR)
 from make import get_args, get_testdir
 
+from batch import CSRBatch
+import bulk
+
 
 class ServerProxy(threading.Thread):
     daemon = True
@@ -19,9 +22,17 @@ class ServerProxy(threading.Thread):
     def __init__(self, args):
         threading.Thread.__init__(self)
         self.args = args
-        self.ready = False
+        self.ready = threading.Event()
+        self.server = None
 
     def run(self):
+        try:
+            self.start_server()
+        finally:
+            # Also wakes up connect() when the server couldn't start.
+            self.ready.set()
+
+    def start_server(self):
         args = self.args
         if args.uart:
             from litex.tools.remote.comm_uart import CommUART
@@ -65,7 +76,6 @@ class ServerProxy(threading.Thread):
         self.server = RemoteServer(comm, args.bind_ip, int(args.bind_port))
         self.server.open()
         self.server.start(4)
-        self.ready = True
 
 
 def connect(desc, *args, add_args=None, **kw):
@@ -116,12 +126,15 @@ def connect(desc, *args, add_args=None, **kw):
 
     s = ServerProxy(args)
     s.start()
-    while not s.ready:
-        continue
+    s.ready.wait()
+    if s.server is None:
+        exit(1)
 
     test_dir = os.path.join(TOP_DIR, get_testdir(args))
     wb = RemoteClient(args.bind_ip, int(args.bind_port), csr_csv="{}/csr.csv".format(test_dir), debug=True)
     wb.open()
+    # Lets CSRBatch talk to the board directly.
+    wb.server = s.server
     print()
     print("Device DNA: {}".format(get_dna(wb)))
     print("   Git Rev: {}".format(get_git(wb)))
@@ -170,10 +183,15 @@ def xadc2c(v):
 
 def get_xadc(wb):
     try:
-        temp = xadc2c(wb.regs.xadc_temperature.read())
-        vccaux = xadc2volts(wb.regs.xadc_vccaux.read())
-        vccbram = xadc2volts(wb.regs.xadc_vccbram.read())
-        vccint = xadc2volts(wb.regs.xadc_vccint.read())
+        with CSRBatch(wb) as b:
+            temp = b.read(wb.regs.xadc_temperature)
+            vccaux = b.read(wb.regs.xadc_vccaux)
+            vccbram = b.read(wb.regs.xadc_vccbram)
+            vccint = b.read(wb.regs.xadc_vccint)
+        temp = xadc2c(temp.result())
+        vccaux = xadc2volts(vccaux.result())
+        vccbram = xadc2volts(vccbram.result())
+        vccint = xadc2volts(vccint.result())
         return "{:.1f}°C -- vccint: {:.2f}V  vccaux: {:.2f}V  vccbram: {:.2f}V".format(
             temp, vccaux, vccbram, vccint)
     except (KeyError, AttributeError) as e:
@@ -200,14 +218,21 @@ def get_platform(wb):
         return 'Unknown on Unknown'
 
 
-def write_and_check(reg, value):
-    reg.write(value)
-    r = reg.read()
+def write_and_check(reg, value, wb=None):
+    if wb is None:
+        reg.write(value)
+        r = reg.read()
+    else:
+        # Write and read back in a single record.
+        with CSRBatch(wb) as b:
+            b.write(reg, value)
+            r = b.read(reg)
+        r = r.result()
     assert r == value, "Wanted {}, got {}".format(value, r)
 
 
 def memdump(wb, start, length):
-    data = wb.read(start, length)
+    data = bulk.read(wb, start, length)
     for i, d in enumerate(data):
         address = i*4 + start
         if address % 32 == 0:
@@ -219,24 +244,18 @@ def memdump(wb, start, length):
 
 import struct
 
-BLOCK_SIZE=64
 def cmpflash(wb, start, filename, skip=0, max=1024):
     assert skip%4==0
     with open(filename, 'rb') as f:
         local_data=f.read()[:skip+max]
-    j = skip
-    while j < len(local_data):
-        mem_data_len = min(BLOCK_SIZE, len(local_data)-j)
-        mem_data = b"".join(struct.pack('>I', k) for k in wb.read(start+j, mem_data_len))
-        for i in range(0, mem_data_len):
-            addr, expected, actual = j+i+start, local_data[j+i], mem_data[i]
-            if addr % 8 == 0:
-                print()
-                print("0x{:08x} ".format(addr), sep=' ', end='')
-            if expected != actual:
-                print()
-                print("{:08x} {:02x} != {:02x}".format(addr, expected, actual))
-            else:
-                print(".", end="", flush=True)
-        j += BLOCK_SIZE
-
+    mem_data = bulk.read_bytes(wb, start+skip, (len(local_data)-skip+3)//4*4)
+    for j in range(skip, len(local_data)):
+        addr, expected, actual = j+start, local_data[j], mem_data[j-skip]
+        if addr % 8 == 0:
+            print()
+            print("0x{:08x} ".format(addr), sep=' ', end='')
+        if expected != actual:
+            print()
+            print("{:08x} {:02x} != {:02x}".format(addr, expected, actual))
+        else:
+            print(".", end="", flush=True)
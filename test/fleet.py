@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Run a CSR script against many boards at once.
+
+Every board is talked to directly from a single asyncio process, UDP
+boards through one shared Etherbone socket and UART / PCIe / USB boards
+through their LiteX comm running on a thread of their own. The script
+runs on all of them concurrently and the results are collected in one
+table.
+
+  ./test/fleet.py --board opsis0=udp:192.168.100.50 \\
+                  --board opsis1=udp:192.168.100.51 \\
+                  --board arty=uart:/dev/ttyUSB1@build/arty_net_lm32/test/csr.csv
+
+A script is an async function taking a Board, for example
+
+  async def script(board):
+      return hex(await board.read("info_dna_id"))
+
+and is given with --script path/to/file.py:script.
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import csv
+import importlib.util
+import json
+import os
+import sys
+
+from litex.tools.remote.etherbone import EtherbonePacket, EtherboneRecord
+from litex.tools.remote.etherbone import EtherboneReads, EtherboneWrites
+
+TOP_DIR=os.path.join(os.path.dirname(__file__), "..")
+
+sys.path.append(TOP_DIR)
+from make import get_args, get_testdir
+
+from batch import MAX_RECORD_OPS, split_value, join_value, packet_bytes
+
+
+BoardSpec = collections.namedtuple("BoardSpec", ["name", "kind", "address", "csr_csv"])
+
+CSRRegister = collections.namedtuple("CSRRegister", ["name", "addr", "length", "mode"])
+
+
+def parse_board(s):
+    """
+    >>> parse_board("opsis0=udp:192.168.100.50")
+    BoardSpec(name='opsis0', kind='udp', address='192.168.100.50', csr_csv=None)
+    >>> parse_board("arty=uart:/dev/ttyUSB1@build/arty/test/csr.csv")
+    BoardSpec(name='arty', kind='uart', address='/dev/ttyUSB1', csr_csv='build/arty/test/csr.csv')
+    >>> parse_board("netv2=pcie:/sys/bus/pci/devices/0000:01:00.0/resource0")
+    BoardSpec(name='netv2', kind='pcie', address='/sys/bus/pci/devices/0000:01:00.0/resource0', csr_csv=None)
+    """
+    name, _, link = s.partition("=")
+    assert name and link, "Invalid board {!r}, want NAME=KIND:ADDRESS[@CSR_CSV]".format(s)
+    kind, _, address = link.partition(":")
+    assert kind in ("udp", "uart", "pcie", "usb"), "Unknown link {!r} for board {}".format(kind, name)
+    csr_csv = None
+    if "@" in address:
+        address, _, csr_csv = address.rpartition("@")
+    return BoardSpec(name, kind, address, csr_csv)
+
+
+def load_csrs(csr_csv):
+    """Read the registers, memory regions and constants from a csr.csv."""
+    regs = collections.OrderedDict()
+    mems = collections.OrderedDict()
+    constants = collections.OrderedDict()
+    with open(csr_csv) as f:
+        for row in csv.reader(l for l in f if not l.startswith("#")):
+            if not row:
+                continue
+            if row[0] == "csr_register":
+                regs[row[1]] = CSRRegister(row[1], int(row[2], 0), int(row[3]), row[4])
+            elif row[0] == "memory_region":
+                mems[row[1]] = (int(row[2], 0), int(row[3]))
+            elif row[0] == "constant":
+                constants[row[1]] = row[2]
+    return regs, mems, constants
+
+
+class EtherboneUDP(asyncio.DatagramProtocol):
+    """Etherbone over UDP for every board.
+
+    The boards all answer to the port they were sent to, so a single
+    socket is shared and replies are matched by board address and by the
+    return address of the reads.
+    """
+
+    def __init__(self, timeout=0.1, retries=5):
+        self.timeout = timeout
+        self.retries = retries
+        self.pending = {}
+        self.tags = collections.Counter()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        packet = EtherbonePacket(init=data)
+        packet.decode()
+        for record in packet.records:
+            if record.writes is None:
+                continue
+            future = self.pending.pop((addr[0], record.writes.base_addr), None)
+            if future is not None and not future.done():
+                future.set_result(record.writes.get_datas())
+
+    def _encode(self, record):
+        packet = EtherbonePacket()
+        packet.records = [record]
+        packet.encode()
+        return packet_bytes(packet)
+
+    async def write(self, dest, addr, datas, idempotent=False):
+        """Write datas, one packet at a time.
+
+        Each packet reads back its last word, so the writes are paced by
+        the replies. Like bulk.py, only idempotent writes are resent when
+        the reply is lost, as it doesn't tell whether they were done.
+        """
+        for i in range(0, len(datas), MAX_RECORD_OPS):
+            chunk = datas[i:i+MAX_RECORD_OPS]
+            last = addr + 4*(i+len(chunk)-1)
+            record = EtherboneRecord()
+            record.writes = EtherboneWrites(base_addr=addr+4*i, datas=chunk)
+            record.wcount = len(record.writes)
+            await self._exchange(dest, record, [last], self.retries if idempotent else 0)
+
+    async def read(self, dest, addr, length):
+        datas = []
+        for i in range(0, length, MAX_RECORD_OPS):
+            n = min(MAX_RECORD_OPS, length - i)
+            datas += await self._exchange(
+                dest, EtherboneRecord(), [addr + 4*(i+j) for j in range(n)], self.retries)
+        return datas
+
+    async def _exchange(self, dest, record, addrs, retries):
+        """Send record with reads of addrs, resending it up to retries times."""
+        # Tags are spaced so return addresses of a read never overlap.
+        self.tags[dest[0]] += 1
+        tag = (self.tags[dest[0]] * 4*(MAX_RECORD_OPS+1)) & 0xffffffff
+
+        record.reads = EtherboneReads(base_ret_addr=tag, addrs=addrs)
+        record.rcount = len(record.reads)
+        data = self._encode(record)
+        for retry in range(retries+1):
+            future = asyncio.get_running_loop().create_future()
+            self.pending[(dest[0], tag)] = future
+            self.transport.sendto(data, dest)
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                self.pending.pop((dest[0], tag), None)
+        raise TimeoutError("No reply from {} for {} of 0x{:08x}".format(
+            dest[0], "write" if record.wcount else "read", addrs[0]))
+
+
+class UDPLink:
+    def __init__(self, protocol, ip, port):
+        self.protocol = protocol
+        self.dest = (ip, port)
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def read(self, addr, length):
+        return await self.protocol.read(self.dest, addr, length)
+
+    async def write(self, addr, datas, idempotent=False):
+        await self.protocol.write(self.dest, addr, datas, idempotent)
+
+
+class CommLink:
+    """A blocking LiteX comm, run on a thread of its own."""
+
+    def __init__(self, comm):
+        self.comm = comm
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def _run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def open(self):
+        await self._run(self.comm.open)
+
+    async def close(self):
+        await self._run(self.comm.close)
+        self.executor.shutdown()
+
+    async def read(self, addr, length):
+        return await self._run(self.comm.read, addr, length)
+
+    async def write(self, addr, datas, idempotent=False):
+        await self._run(self.comm.write, addr, datas)
+
+
+class Board:
+    def __init__(self, name, link, csr_csv):
+        self.name = name
+        self.link = link
+        self.regs, self.mems, self.constants = load_csrs(csr_csv)
+        self.data_width = int(self.constants.get("config_csr_data_width", 8))
+
+    def _reg(self, reg):
+        if isinstance(reg, str):
+            return self.regs[reg]
+        return reg
+
+    async def read(self, reg):
+        reg = self._reg(reg)
+        return join_value(await self.link.read(reg.addr, reg.length), self.data_width)
+
+    async def write(self, reg, value, idempotent=False):
+        """Write a CSR, idempotent when writing it twice does no harm."""
+        reg = self._reg(reg)
+        await self.link.write(reg.addr, split_value(value, reg.length, self.data_width), idempotent)
+
+    async def read_mem(self, addr, length):
+        return await self.link.read(addr, length)
+
+    async def write_mem(self, addr, datas):
+        await self.link.write(addr, datas, idempotent=True)
+
+
+async def info(board):
+    """Default script, the same details connect() prints."""
+    result = collections.OrderedDict()
+    for name, reg in (("dna", "info_dna_id"), ("git", "info_git_commit")):
+        if reg in board.regs:
+            result[name] = "{:x}".format(await board.read(reg))
+    for name in ("target", "platform"):
+        reg = "info_platform_" + name
+        if reg in board.regs:
+            d = await board.read(reg)
+            n = (board.regs[reg].length*board.data_width + 7)//8
+            result[name] = "".join(chr(b) for b in d.to_bytes(n, "big") if b)
+    return result
+
+
+def load_script(s):
+    filename, _, func = s.rpartition(":")
+    spec = importlib.util.spec_from_file_location(
+        os.path.splitext(os.path.basename(filename))[0], filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, func)
+
+
+def make_link(spec, args, udp):
+    if spec.kind == "udp":
+        ip, _, port = spec.address.partition(":")
+        return UDPLink(udp, ip, int(port or args.udp_port))
+    elif spec.kind == "uart":
+        from litex.tools.remote.comm_uart import CommUART
+        return CommLink(CommUART(spec.address, int(float(args.uart_baudrate))))
+    elif spec.kind == "pcie":
+        from litex.tools.remote.comm_pcie import CommPCIe
+        return CommLink(CommPCIe(spec.address))
+    elif spec.kind == "usb":
+        from litex.tools.remote.comm_usb import CommUSB
+        vid, _, pid = spec.address.partition(":")
+        return CommLink(CommUSB(vid=int(vid, 0) if vid else None, pid=int(pid, 0) if pid else None))
+
+
+async def run_board(board, script):
+    await board.link.open()
+    try:
+        return await script(board)
+    finally:
+        await board.link.close()
+
+
+async def run_fleet(specs, args, script):
+    loop = asyncio.get_running_loop()
+    udp = None
+    if any(spec.kind == "udp" for spec in specs):
+        _, udp = await loop.create_datagram_endpoint(
+            lambda: EtherboneUDP(args.timeout, args.retries),
+            local_addr=(args.bind_ip, int(args.udp_port)))
+
+    default_csv = None
+    if not all(spec.csr_csv for spec in specs):
+        default_csv = os.path.join(TOP_DIR, get_testdir(args), "csr.csv")
+    boards = [
+        Board(spec.name, make_link(spec, args, udp), spec.csr_csv or default_csv)
+        for spec in specs]
+    try:
+        results = await asyncio.gather(
+            *(run_board(board, script) for board in boards),
+            return_exceptions=True)
+    finally:
+        if udp is not None:
+            udp.transport.close()
+    return collections.OrderedDict((b.name, r) for b, r in zip(boards, results))
+
+
+def print_results(results):
+    print()
+    print("{:20} {:8} {}".format("Board", "Status", "Result"))
+    print("-"*75)
+    for name, result in results.items():
+        if isinstance(result, Exception):
+            print("{:20} {:8} {!r}".format(name, "FAILED", result))
+        elif isinstance(result, dict):
+            print("{:20} {:8} {}".format(name, "ok", "  ".join(
+                "{}: {}".format(k, v) for k, v in result.items())))
+        else:
+            print("{:20} {:8} {}".format(name, "ok", result))
+    print("-"*75)
+    failed = sum(1 for r in results.values() if isinstance(r, Exception))
+    print("{} boards, {} failed".format(len(results), failed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    get_args(parser)
+    parser.add_argument("--board", action="append", default=[], required=True,
+                        help="NAME=KIND:ADDRESS[@CSR_CSV], KIND is udp, uart, pcie or usb")
+    parser.add_argument("--script", default=None,
+                        help="FILE:FUNCTION async script to run on each board (default: board info)")
+    parser.add_argument("--bind-ip", default="",
+                        help="Local address for the UDP socket")
+    parser.add_argument("--udp-port", default=1234,
+                        help="Etherbone UDP port")
+    parser.add_argument("--uart-baudrate", default=115200,
+                        help="UART baudrate")
+    parser.add_argument("--timeout", type=float, default=0.1,
+                        help="Seconds to wait for a UDP reply")
+    parser.add_argument("--retries", type=int, default=5,
+                        help="Times to resend a UDP read or idempotent write")
+    parser.add_argument("--json", default=None,
+                        help="Also write the results to this file")
+    args = parser.parse_args()
+
+    specs = [parse_board(b) for b in args.board]
+    names = [s.name for s in specs]
+    assert len(set(names)) == len(names), "Board names must be unique"
+    script = load_script(args.script) if args.script else info
+
+    results = asyncio.run(run_fleet(specs, args, script))
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                name: {"error": repr(r)} if isinstance(r, Exception) else r
+                for name, r in results.items()}, f, indent=2, default=str)
+
+    sys.exit(1 if any(isinstance(r, Exception) for r in results.values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Capture frame buffers from main RAM.
+
+Frames are read with the bulk reader into a preallocated buffer, decoded
+with numpy and written out as PNG and/or raw words. With --count 0 the
+capture runs until interrupted, and with --compare every frame is checked
+against a raw reference capture.
+"""
+
+import time
+
+import numpy
+import png
+
+from common import *
+
+import bulk
+
+
+# Offset of the pattern frame buffer in main RAM, see firmware/framebuffer.h
+FRAMEBUFFER_OFFSET = 0x01000000
+
+
+def decode_rgb10(words, width, height):
+    """Pixels packed as 10 bits each of red, green and blue.
+
+    >>> decode_rgb10(numpy.array([(1020 << 20) | (512 << 10) | 4], dtype=numpy.uint32), 1, 1).tolist()
+    [[[255, 128, 1]]]
+    """
+    words = words[:width*height].reshape(height, width)
+    rgb = numpy.empty((height, width, 3), dtype=numpy.uint8)
+    for i, shift in enumerate((20, 10, 0)):
+        rgb[..., i] = (words >> (shift + 2)) & 0xff
+    return rgb
+
+
+def decode_rgb(words, width, height):
+    """Pixels as 0x00RRGGBB words.
+
+    >>> decode_rgb(numpy.array([0x00ff8001], dtype=numpy.uint32), 1, 1).tolist()
+    [[[255, 128, 1]]]
+    """
+    words = words[:width*height].reshape(height, width)
+    rgb = numpy.empty((height, width, 3), dtype=numpy.uint8)
+    for i, shift in enumerate((16, 8, 0)):
+        rgb[..., i] = (words >> shift) & 0xff
+    return rgb
+
+
+def decode_ycbcr422(words, width, height):
+    """Two pixels per word, packed as UYVY (see firmware/pattern.py).
+
+    >>> decode_ycbcr422(numpy.array([0x80ff80ff, 0x80008000], dtype=numpy.uint32), 4, 1).tolist()
+    [[[255, 255, 255], [255, 255, 255], [0, 0, 0], [0, 0, 0]]]
+    """
+    words = words[:width*height//2].reshape(height, width//2)
+    cb = ((words >> 24) & 0xff).astype(numpy.float32) - 128
+    cr = ((words >> 8) & 0xff).astype(numpy.float32) - 128
+    y = numpy.empty((height, width), dtype=numpy.float32)
+    y[:, 0::2] = (words >> 16) & 0xff
+    y[:, 1::2] = words & 0xff
+    cb = numpy.repeat(cb, 2, axis=1)
+    cr = numpy.repeat(cr, 2, axis=1)
+
+    rgb = numpy.empty((height, width, 3), dtype=numpy.float32)
+    rgb[..., 0] = y + 1.402*cr
+    rgb[..., 1] = y - 0.344136*cb - 0.714136*cr
+    rgb[..., 2] = y + 1.772*cb
+    return numpy.clip(numpy.rint(rgb), 0, 255).astype(numpy.uint8)
+
+
+# Decoder and pixels per word of each format.
+FORMATS = {
+    "ycbcr422": (decode_ycbcr422, 2),
+    "rgb": (decode_rgb, 1),
+    "rgb10": (decode_rgb10, 1),
+}
+
+
+def frame_words(fmt, width, height):
+    """
+    >>> frame_words("ycbcr422", 1280, 720)
+    460800
+    """
+    decode, pixels_per_word = FORMATS[fmt]
+    return width*height//pixels_per_word
+
+
+def capture(wb, addr, fmt, width, height, out=None, verbose=True):
+    """Read one frame, returning its words."""
+    return bulk.read(wb, addr, frame_words(fmt, width, height), out=out, verbose=verbose)
+
+
+def decode(words, fmt, width, height):
+    decode, pixels_per_word = FORMATS[fmt]
+    return decode(words, width, height)
+
+
+def save_png(rgb, filename):
+    height, width, _ = rgb.shape
+    with open(filename, "wb") as f:
+        png.Writer(width, height, greyscale=False).write(f, rgb.reshape(height, width*3))
+
+
+def add_args(parser):
+    parser.add_argument("--offset", default=FRAMEBUFFER_OFFSET, type=lambda x: int(x, 0),
+                        help="Offset of the frame buffer in main RAM (default: pattern buffer)")
+    parser.add_argument("--address", default=None, type=lambda x: int(x, 0),
+                        help="Absolute address of the frame buffer, overrides --offset")
+    parser.add_argument("--width", default=None, type=int,
+                        help="Frame width (default: the HDMI output resolution)")
+    parser.add_argument("--height", default=None, type=int,
+                        help="Frame height (default: the HDMI output resolution)")
+    parser.add_argument("--format", default="ycbcr422", choices=sorted(FORMATS),
+                        help="Pixel format of the frame buffer")
+    parser.add_argument("--output", default="frame_{:04d}.png",
+                        help="PNG file name, formatted with the frame number ('' for none)")
+    parser.add_argument("--raw", default="",
+                        help="Raw file name, formatted with the frame number ('' for none)")
+    parser.add_argument("--count", default=1, type=int,
+                        help="Number of frames to capture (0 to run until interrupted)")
+    parser.add_argument("--compare", default=None,
+                        help="Raw reference capture to compare every frame against")
+
+
+def main():
+    args, wb = connect(__doc__, add_args=add_args)
+
+    addr = args.address
+    if addr is None:
+        addr = wb.mems.main_ram.base + args.offset
+    width, height = args.width, args.height
+    if width is None:
+        width = wb.regs.hdmi_out0_core_initiator_hres.read()
+    if height is None:
+        height = wb.regs.hdmi_out0_core_initiator_vres.read()
+
+    reference = None
+    if args.compare:
+        reference = numpy.fromfile(args.compare, dtype=">u4").astype(numpy.uint32)
+        assert len(reference) == frame_words(args.format, width, height), (
+            "{} isn't a {}x{} {} capture".format(args.compare, width, height, args.format))
+
+    print("Capturing {}x{} {} frames from 0x{:08x}".format(width, height, args.format, addr))
+    words = numpy.empty(frame_words(args.format, width, height), dtype=numpy.uint32)
+    mismatched = 0
+    n = 0
+    start = time.time()
+    try:
+        while args.count == 0 or n < args.count:
+            capture(wb, addr, args.format, width, height, out=words)
+            if args.raw:
+                words.astype(">u4").tofile(args.raw.format(n))
+            if args.output:
+                save_png(decode(words, args.format, width, height), args.output.format(n))
+            if reference is not None:
+                diff = numpy.count_nonzero(words != reference)
+                if diff:
+                    mismatched += 1
+                print("Frame {}: {} words differ from {}".format(n, diff, args.compare))
+            n += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        seconds = time.time() - start
+        print("{} frames in {:.1f}s ({:.2f} fps)".format(n, seconds, n/max(seconds, 1e-9)))
+        wb.close()
+
+    if mismatched:
+        print("{} of {} frames didn't match".format(mismatched, n))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
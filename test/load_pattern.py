@@ -1,39 +1,168 @@
 #!/usr/bin/env python3
 
 """
-Script for loading an image into the pattern buffer via Etherbone.
+Script for loading images or video into the pattern buffer via Etherbone.
+
+Frames are converted to YCbCr 4:2:2 with numpy (using the coefficients
+from firmware/pattern.py) on a second thread, so the next frame is ready
+while the current one is being sent, and are paced to --fps.
+
+Video can be piped in as raw RGB frames at the output resolution, for
+example
+
+  ffmpeg -i test.mp4 -f rawvideo -pix_fmt rgb24 -s 1280x720 - | \\
+      ./test/load_pattern.py --raw-rgb - --fps 30 --loop
 """
 
-import shutil
-import subprocess
-import tempfile
+import itertools
+import queue
+import threading
 import time
 
 import numpy
-import progressbar
+import png
 
 from common import *
 
+import bulk
+
+sys.path.append(os.path.join(TOP_DIR, "firmware"))
+from pattern import RGB2YCBCR, color_bars_rgb
+
+
+def rgb_to_ycbcr422(rgb, out=None):
+    """Convert a (height, width, 3) RGB frame to UYVY words.
+
+    Each word holds two pixels, Cb Y0 Cr Y1 from the top byte down, as
+    packed by ycbcr_pack() in firmware/pattern.py.
+
+    >>> from pattern import rgb2ycbcr, ycbcr_pack
+    >>> rgb = numpy.array([[c, c] for c in color_bars_rgb], dtype=numpy.uint8)
+    >>> rgb_to_ycbcr422(rgb).tolist() == [ycbcr_pack(*rgb2ycbcr(*c)) for c in color_bars_rgb]
+    True
+    """
+    height, width, _ = rgb.shape
+    r, g, b = (rgb[..., i].astype(numpy.float64) for i in range(3))
+    y, cb, cr = (
+        numpy.clip(kr*r + kg*g + kb*b + o, 0, 255).astype(numpy.uint32)
+        for kr, kg, kb, o in RGB2YCBCR)
+
+    # Chroma is shared by each pair of pixels.
+    cb = (cb[:, 0::2] + cb[:, 1::2]) >> 1
+    cr = (cr[:, 0::2] + cr[:, 1::2]) >> 1
+    words = (cb << 24) | (y[:, 0::2] << 16) | (cr << 8) | y[:, 1::2]
+    if out is None:
+        return words.reshape(-1)
+    out[:] = words.reshape(-1)
+    return out
+
+
+def scale(rgb, width, height):
+    """Nearest neighbour scaling to width x height."""
+    rows = numpy.arange(height) * rgb.shape[0] // height
+    cols = numpy.arange(width) * rgb.shape[1] // width
+    return rgb[rows][:, cols]
+
+
+def png_frames(filenames, width, height):
+    for filename in filenames:
+        w, h, rows, info = png.Reader(filename=filename).asRGB8()
+        rgb = numpy.vstack([numpy.frombuffer(bytes(row), dtype=numpy.uint8) for row in rows])
+        yield scale(rgb.reshape(h, w, 3), width, height)
+
+
+def raw_rgb_frames(filename, width, height):
+    size = width*height*3
+    f = sys.stdin.buffer if filename == "-" else open(filename, "rb")
+    while True:
+        data = f.read(size)
+        if len(data) < size:
+            return
+        yield numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, width, 3)
+
+
+def pattern_frames(name, width, height):
+    bars = numpy.array(color_bars_rgb, dtype=numpy.uint8)
+    line = bars[numpy.arange(width) * len(bars) // width]
+    frame = numpy.broadcast_to(line, (height, width, 3))
+    if name == "colorbars":
+        yield frame
+    elif name == "moving":
+        # Scrolls a pixel pair a frame, so dropped frames show.
+        for i in itertools.count():
+            yield numpy.roll(frame, 2*i, axis=1)
+    else:
+        raise ValueError("Unknown pattern {}".format(name))
 
-def send_int32_data(wb, base, data, b=128):
-    l = len(data)
-    batches = l/b
-    print("Data is {} bytes (need {} batches)".format(l*4, batches))
-
-    bar = progressbar.ProgressBar(max_value=l).start()
-    for pos in range(0, l, b):
-        mem_loc = base+pos*4
-        wb.write(mem_loc, [int(x) for x in data[pos:pos+b]])
-        bar.update(pos)
 
-    bar.finish()
+def convert(frames, buffers, ready, stop):
+    """Fill free buffers with converted frames, None marks the end."""
+    try:
+        for rgb in frames:
+            words = buffers.get()
+            if stop.is_set():
+                return
+            rgb_to_ycbcr422(rgb, out=words)
+            ready.put(words)
+    finally:
+        ready.put(None)
+
+
+def send_frames(wb, base, frames, words, fps):
+    # Two buffers, one being sent while the other is filled.
+    buffers = queue.Queue()
+    for i in range(2):
+        buffers.put(numpy.empty(words, dtype=numpy.uint32))
+    ready = queue.Queue()
+    stop = threading.Event()
+    converter = threading.Thread(target=convert, args=(frames, buffers, ready, stop), daemon=True)
+    converter.start()
+
+    period = 1/fps if fps else 0
+    sent = late = 0
+    start = deadline = time.time()
+    try:
+        while True:
+            data = ready.get()
+            if data is None:
+                break
+            bulk.write(wb, base, data, verbose=False)
+            buffers.put(data)
+            sent += 1
+
+            deadline += period
+            delay = deadline - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            elif period:
+                late += 1
+                deadline = time.time()
+            if sent % 10 == 0:
+                print("Sent {} frames ({:.2f} fps, {} late)".format(
+                    sent, sent/(time.time()-start), late), flush=True)
+    finally:
+        stop.set()
+        buffers.put(None)
+    return sent, late
 
 
 def add_args(parser):
     parser.add_argument(
         "--file",
-        default="third_party/litevideo/litevideo/csc/test/lena.png",
-        help="File to send to the pattern buffer.")
+        action="append",
+        default=[],
+        help="PNG file to send to the pattern buffer (can be given more than once).")
+
+    parser.add_argument(
+        "--raw-rgb",
+        default=None,
+        help="File (or - for stdin) of raw 24-bit RGB frames at the output resolution.")
+
+    parser.add_argument(
+        "--pattern",
+        default=None,
+        choices=["colorbars", "moving"],
+        help="Send a generated pattern.")
 
     parser.add_argument(
         "--pattern-offset",
@@ -41,16 +170,30 @@ def add_args(parser):
         help="Manually set the pattern offset.")
 
     parser.add_argument(
-        "--delay",
-        default=30,
+        "--fps",
+        default=1,
         type=float,
-        help="Number of seconds between sending each frame of the input."
-        )
+        help="Frames per second to send (0 for as fast as possible).")
 
     parser.add_argument(
-        "--pattern",
+        "--frames",
         default=None,
-        help="Send a gstreamer pattern, use 'gst-inspect-1.0 videotestsrc' to see possible options.")
+        type=int,
+        help="Stop after sending this many frames.")
+
+    parser.add_argument(
+        "--loop",
+        action="store_true",
+        help="Send the input again when it runs out, for soak testing.")
+
+
+def get_pattern_offset():
+    # FRAMEBUFFER_BASE_PATTERN is the first frame buffer.
+    define = "#define FRAMEBUFFER_OFFSET"
+    for l in open(os.path.join(TOP_DIR, "firmware", "framebuffer.h")).readlines():
+        if l.startswith(define):
+            return int(l[len(define):].split()[0], 0)
+    assert False, "FRAMEBUFFER_OFFSET not found in firmware/framebuffer.h"
 
 
 def main():
@@ -59,17 +202,9 @@ def main():
     print()
 
     if args.pattern_offset is not None:
-        pattern_offset = args.pattern_offset
+        pattern_offset = int(args.pattern_offset, 0)
     else:
-        # Find pattern memory location
-        define = "#define PATTERN_FRAMEBUFFER_BASE "
-        pattern_offset = 0
-        for l in open("firmware/pattern.c").readlines():
-            if not l.startswith(define):
-                continue
-
-            pattern_offset = eval(l[len(define):-1])
-        assert pattern_offset != 0
+        pattern_offset = get_pattern_offset()
 
     pattern_mem = wb.mems.main_ram.base + pattern_offset
 
@@ -84,61 +219,33 @@ def main():
     print("-"*75)
     print()
 
-    if args.pattern:
-        src = "videotestsrc pattern={} num-buffers=5".format(args.pattern)
+    def source():
+        if args.raw_rgb:
+            return raw_rgb_frames(args.raw_rgb, width, height)
+        elif args.file:
+            return png_frames(args.file, width, height)
+        else:
+            return pattern_frames(args.pattern or "colorbars", width, height)
+
+    if args.loop:
+        assert args.raw_rgb != "-", "Can't loop over stdin"
+        frames = itertools.chain.from_iterable(source() for _ in itertools.count())
     else:
-        infile = os.path.realpath(os.path.expanduser(args.file))
-        assert os.path.exists(infile), "{} ({}) does not exist!".format(infile, args.file)
-        src = "filesrc location={} ! decodebin ! videoscale".format(infile)
+        frames = source()
+    if args.frames is not None:
+        frames = itertools.islice(frames, args.frames)
 
-    # Use gstreamer to convert input
-    tempdir = None
+    print("Sending frames at {} fps".format(args.fps or "full speed"))
+    print("-"*75)
     try:
-        tempdir = tempfile.mkdtemp(prefix='hdmi2usb-litex-load_pattern.')
-
-        assert os.listdir(tempdir) == []
-        print("Generating raw frames in {}".format(tempdir))
-        print("-"*75)
-
-        pipeline = """
-gst-launch-1.0 -v \
-    {src} ! \
-    videoconvert ! \
-    video/x-raw,format=UYVY,height={height},width={width},colorimetry=1:4:0:0 ! \
-    multifilesink location="{tempdir}/%05d.yuv422.raw" max-files={max}
-""".format(src=src,
-           width=width,
-           height=height,
-           tempdir=tempdir,
-           max=1024)
-        print(pipeline)
-        subprocess.check_call(pipeline, shell=True)
-        print("-"*75)
-
-        files = os.listdir(tempdir)
-        assert len(files) > 0, "gstreamer generated no files!"
-
-        print()
-        print("Input Information")
-        print("-"*75)
-        print(" Source: {}".format(src))
-        print(" Frames: {}".format(len(files)))
+        sent, late = send_frames(wb, pattern_mem, frames, width*height//2, args.fps)
+    except KeyboardInterrupt:
+        pass
+    else:
         print("-"*75)
-        print()
-
-        for i, fn in enumerate(files):
-            pn = os.path.join(tempdir, fn)
-            print("Sending {}".format(pn))
-            data = numpy.fromfile(open(pn, 'rb'), '>4I')
-            send_int32_data(wb, pattern_mem, data.flat)
-
-            if i != len(files)-1:
-                print("Sleeping for {} seconds".format(args.delay))
-                time.sleep(args.delay)
-
+        print("Sent {} frames, {} late".format(sent, late))
     finally:
-        if tempdir:
-            shutil.rmtree(tempdir)
+        wb.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,579 @@
+#!/usr/bin/env python3
+"""
+Capture the JPEG stream sent by the encoder over RTP/UDP.
+
+Datagrams are received in batches (recvmmsg on Linux) straight into a
+preallocated ring of buffers, while a second thread parses the RTP
+header, tracks lost packets from the sequence numbers and puts the JPEG
+frames back together as they arrive. Complete frames are written out by
+a third thread, and fps / throughput counters are printed every second.
+
+The RTP payload is RTP/JPEG (RFC 2435, see RTPJPEGPacketizer in
+gateware/streamer/rtp.py): the JFIF headers of each frame are rebuilt
+from the size, type and quantization tables of its first packet. With
+--raw the datagrams are a plain JPEG stream, split at the markers.
+"""
+
+import argparse
+import ctypes
+import errno
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+
+
+RTP_HEADER_LENGTH = 12
+RTP_VERSION = 2
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+
+# Standard Huffman tables (JPEG Annex K.3), as (class << 4 | id, counts, symbols).
+HUFFMAN_TABLES = [
+    (0x00, "00010501010101010100000000000000", "000102030405060708090a0b"),
+    (0x10, "0002010303020403050504040000017d",
+     "01020300041105122131410613516107227114328191a1082342b1c11552d1f0"
+     "2433627282090a161718191a25262728292a3435363738393a434445464748494a"
+     "535455565758595a636465666768696a737475767778797a838485868788898a92"
+     "939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5c6c7c8"
+     "c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9fa"),
+    (0x01, "00030101010101010101010000000000", "000102030405060708090a0b"),
+    (0x11, "00020102040403040705040400010277",
+     "00010203110405213106124151076171132232810814429191a1b1c109233352f0"
+     "156272d10a162434e125f11718191a262728292a35363738393a43444546474849"
+     "4a535455565758595a636465666768696a737475767778797a8283848586878889"
+     "8a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5c6"
+     "c7c8c9cad2d3d4d5d6d7d8d9dae2e3e4e5e6e7e8e9eaf2f3f4f5f6f7f8f9fa"),
+]
+
+
+def rtp_payload(data):
+    """Returns (marker, sequence number, timestamp, payload offset, payload end).
+
+    >>> rtp_payload(bytes([0x80, 0x9a, 0x12, 0x34, 0, 0, 0, 1, 0, 0, 0, 1]) + b"jpeg")
+    (True, 4660, 1, 12, 16)
+    """
+    b0, b1, seq, timestamp, ssrc = struct.unpack_from(">BBHII", data)
+    assert b0 >> 6 == RTP_VERSION, "Not an RTP packet (version {})".format(b0 >> 6)
+    start = RTP_HEADER_LENGTH + 4*(b0 & 0x0f)
+    end = len(data)
+    if b0 & 0x10:
+        # Header extension, length in words after its own header.
+        start += 4 + 4*struct.unpack_from(">H", data, start + 2)[0]
+    if b0 & 0x20:
+        # Padding, the last byte gives its length.
+        end -= data[-1]
+    return bool(b1 & 0x80), seq, timestamp, start, end
+
+
+def jpeg_payload(data, start, end):
+    """Parses the RTP/JPEG headers of a payload.
+
+    Returns (type, width, height, fragment offset, quantization tables,
+    scan data offset), the tables being None when the packet has none.
+
+    >>> jpeg_payload(bytes([0, 0, 0, 0, 0, 255, 40, 30, 0, 0, 0, 2, 1, 2, 0xaa]), 0, 15)
+    (0, 320, 240, 0, b'\\x01\\x02', 14)
+    >>> jpeg_payload(bytes([0, 0, 1, 0, 1, 255, 40, 30, 0xaa]), 0, 9)
+    (1, 320, 240, 256, None, 8)
+    """
+    _, offset_h, offset_l, jpeg_type, q, width, height = struct.unpack_from(">BBHBBBB", data, start)
+    offset = offset_h << 16 | offset_l
+    start += 8
+    if jpeg_type >= 64:
+        # Restart marker header.
+        start += 4
+    tables = None
+    if q >= 128 and offset == 0:
+        _, _, length = struct.unpack_from(">BBH", data, start)
+        tables = bytes(data[start+4:start+4+length])
+        start += 4 + length
+    assert start <= end, "Truncated RTP/JPEG headers"
+    return jpeg_type & 0x3f, 8*width, 8*height, offset, tables, start
+
+
+def jpeg_headers(jpeg_type, width, height, tables):
+    """The JFIF headers of a frame (RFC 2435 appendix A), up to its scan."""
+    def segment(marker, payload):
+        return bytes([0xff, marker]) + struct.pack(">H", len(payload) + 2) + payload
+
+    headers = JPEG_SOI
+    for i in range(len(tables)//64):
+        headers += segment(0xdb, bytes([i]) + tables[64*i:64*(i+1)])
+    luma_tq, chroma_tq = 0, 1 if len(tables) >= 128 else 0
+    headers += segment(0xc0, struct.pack(">BHHB", 8, height, width, 3) + bytes([
+        1, 0x21 if jpeg_type == 0 else 0x22, luma_tq,
+        2, 0x11, chroma_tq,
+        3, 0x11, chroma_tq]))
+    for table, counts, symbols in HUFFMAN_TABLES:
+        headers += segment(0xc4, bytes([table]) + bytes.fromhex(counts) + bytes.fromhex(symbols))
+    headers += segment(0xda, bytes([3, 1, 0x00, 2, 0x11, 3, 0x11, 0, 63, 0]))
+    return headers
+
+
+class FrameAssembler:
+    """Puts JPEG frames back together from RTP/JPEG payloads.
+
+    >>> a = FrameAssembler()
+    >>> a.feed(bytes([0, 0, 0, 0, 0, 255, 1, 1, 0, 0, 0, 0]) + b"sc", False, 1)
+    []
+    >>> frame, damaged = a.feed(bytes([0, 0, 0, 2, 0, 255, 1, 1]) + b"an", True, 1)[0]
+    >>> frame[-6:], damaged
+    (bytearray(b'scan\\xff\\xd9'), False)
+    >>> a.feed(bytes([0, 0, 0, 4, 0, 255, 1, 1]) + b"an", True, 2)
+    [(None, True)]
+
+    Losing the marker packet of a frame abandons it, damaged, when the
+    next frame starts, and the next frame is kept whole:
+
+    >>> a.feed(bytes([0, 0, 0, 0, 0, 255, 1, 1, 0, 0, 0, 0]) + b"sc", False, 3)
+    []
+    >>> [(frame[-4:], damaged) for frame, damaged in
+    ...  a.feed(bytes([0, 0, 0, 0, 0, 255, 1, 1, 0, 0, 0, 0]) + b"sc", False, 4, lost=1)]
+    [(bytearray(b'sc\\xff\\xd9'), True)]
+    >>> frame, damaged = a.feed(bytes([0, 0, 0, 2, 0, 255, 1, 1]) + b"an", True, 4)[0]
+    >>> frame[-6:], damaged
+    (bytearray(b'scan\\xff\\xd9'), False)
+    """
+
+    def __init__(self):
+        self.timestamp = None
+        self.headers = None
+        self.scan = bytearray()
+        self.damaged = False
+
+    def finish(self, damaged):
+        """The (frame, damaged) pair of the current frame, which is reset."""
+        frame = None
+        if self.headers is not None:
+            frame = bytearray(self.headers) + self.scan + JPEG_EOI
+        result = (frame, damaged or self.damaged or frame is None)
+        self.timestamp = None
+        self.headers = None
+        self.scan = bytearray()
+        self.damaged = False
+        return result
+
+    def feed(self, data, marker, timestamp, start=0, end=None, lost=0):
+        """Returns the (frame, damaged) pairs completed by data, frame None
+        when it can't be rebuilt.
+
+        lost is the number of packets missing just before this one.
+        """
+        end = len(data) if end is None else end
+        jpeg_type, width, height, offset, tables, start = jpeg_payload(data, start, end)
+        frames = []
+        if timestamp != self.timestamp:
+            # A new frame. Packets lost before it belonged to the last
+            # frame (or to the start of this one, which the offset
+            # shows), and the last frame never got its marker.
+            if self.timestamp is not None:
+                frames.append(self.finish(True))
+            self.timestamp = timestamp
+        elif lost:
+            self.damaged = True
+        if tables is not None:
+            self.headers = jpeg_headers(jpeg_type, width, height, tables)
+        if offset != len(self.scan):
+            self.damaged = True
+        self.scan += data[start:end]
+        if marker:
+            frames.append(self.finish(False))
+        return frames
+
+
+class SequenceTracker:
+    """Counts lost and late packets from the 16-bit RTP sequence numbers.
+
+    Packets behind the expected number are late when they were counted
+    as lost (within the last WINDOW numbers), duplicates otherwise.
+
+    >>> t = SequenceTracker()
+    >>> [t.update(s) for s in (65534, 65535, 0, 3, 2, 2, 0, 4)]
+    [0, 0, 0, 2, None, None, None, 0]
+    >>> t.lost, t.late, t.duplicates
+    (1, 1, 2)
+    """
+
+    WINDOW = 1024
+
+    def __init__(self):
+        self.expected = None
+        self.lost = 0
+        self.late = 0
+        self.duplicates = 0
+        # Numbers counted as lost, oldest first.
+        self.missing = {}
+
+    def update(self, seq):
+        """Returns the number of packets missing before this one, None
+        when it is late or a duplicate and should be ignored."""
+        if self.expected is None:
+            self.expected = (seq + 1) & 0xffff
+            return 0
+        gap = (seq - self.expected) & 0xffff
+        if gap >= 0x8000:
+            if self.missing.pop(seq, None) is None:
+                self.duplicates += 1
+            else:
+                self.late += 1
+                self.lost -= 1
+            return None
+        for s in range(self.expected, self.expected + min(gap, self.WINDOW)):
+            self.missing[s & 0xffff] = True
+        self.expected = (seq + 1) & 0xffff
+        self.lost += gap
+        # Forget the numbers which are too old to still arrive.
+        while self.missing:
+            s = next(iter(self.missing))
+            if (self.expected - s) & 0xffff <= self.WINDOW:
+                break
+            del self.missing[s]
+        return gap
+
+
+class FrameSplitter:
+    """Splits a JPEG byte stream into frames as it arrives.
+
+    >>> s = FrameSplitter()
+    >>> s.feed(b"tail\\xff\\xd9\\xff\\xd8one\\xff")
+    []
+    >>> s.feed(b"\\xd9\\xff\\xd8tw")
+    [(bytearray(b'\\xff\\xd8one\\xff\\xd9'), False)]
+    >>> s.lost()
+    >>> s.feed(b"o\\xff\\xd9")
+    [(bytearray(b'\\xff\\xd8two\\xff\\xd9'), True)]
+    """
+
+    def __init__(self):
+        self.frame = bytearray()
+        self.damaged = False
+
+    def lost(self):
+        self.damaged = True
+
+    def feed(self, data):
+        """Returns the (frame, damaged) pairs completed by data."""
+        frames = []
+        # An end marker can be split between two payloads.
+        search = max(len(self.frame) - 1, 0)
+        self.frame += data
+        while True:
+            end = self.frame.find(JPEG_EOI, search)
+            if end < 0:
+                break
+            frame = self.frame[:end+2]
+            del self.frame[:end+2]
+            search = 0
+            # Whatever came before the first start marker isn't a frame.
+            start = frame.find(JPEG_SOI)
+            if start >= 0:
+                frames.append((frame[start:], self.damaged))
+            self.damaged = False
+        return frames
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", msghdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+MSG_WAITFORONE = getattr(socket, "MSG_WAITFORONE", 0x10000)
+
+
+def get_recvmmsg():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+
+class Ring:
+    """Fixed size slots for datagrams, filled by one thread and drained by another."""
+
+    def __init__(self, slots, slot_size):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buf = bytearray(slots*slot_size)
+        self.view = memoryview(self.buf)
+        self.lengths = [0]*slots
+        self.head = 0
+        self.tail = 0
+        self.cond = threading.Condition()
+
+    def slot(self, i):
+        i %= self.slots
+        return self.view[i*self.slot_size:i*self.slot_size+self.lengths[i]]
+
+    def free(self):
+        """Number of slots which can be filled without wrapping."""
+        with self.cond:
+            used = self.head - self.tail
+        return min(self.slots - used, self.slots - self.head % self.slots)
+
+    def push(self, n):
+        with self.cond:
+            self.head += n
+            self.cond.notify_all()
+
+    def wait_data(self, timeout):
+        with self.cond:
+            if self.head == self.tail:
+                self.cond.wait(timeout)
+            return self.tail, self.head
+
+    def pop(self, n):
+        with self.cond:
+            self.tail += n
+            self.cond.notify_all()
+
+    def wait_space(self, timeout):
+        with self.cond:
+            if self.head - self.tail == self.slots:
+                self.cond.wait(timeout)
+
+
+class Receiver(threading.Thread):
+    daemon = True
+
+    def __init__(self, sock, ring, batch):
+        threading.Thread.__init__(self)
+        self.sock = sock
+        self.ring = ring
+        self.batch = batch
+        self.running = True
+        self.overruns = 0
+        self.recvmmsg = get_recvmmsg()
+
+        # One iovec per slot of the ring, pointing straight into it.
+        base = ctypes.addressof(ctypes.c_char.from_buffer(ring.buf))
+        self.iovecs = (iovec * ring.slots)()
+        self.msgs = (mmsghdr * ring.slots)()
+        for i in range(ring.slots):
+            self.iovecs[i].iov_base = base + i*ring.slot_size
+            self.iovecs[i].iov_len = ring.slot_size
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+
+    def receive(self, first, n):
+        """Fill up to n slots from first, returns how many were filled."""
+        if self.recvmmsg is not None:
+            # Blocks for the first datagram, then takes what is queued.
+            got = self.recvmmsg(
+                self.sock.fileno(), ctypes.byref(self.msgs[first]), n,
+                MSG_WAITFORONE, None)
+            if got < 0:
+                e = ctypes.get_errno()
+                if e in (errno.EAGAIN, errno.EINTR):
+                    return 0
+                raise OSError(e, os.strerror(e))
+            for i in range(got):
+                self.ring.lengths[first+i] = self.msgs[first+i].msg_len
+            return got
+
+        got = 0
+        flags = 0
+        while got < n:
+            i = first + got
+            try:
+                self.ring.lengths[i] = self.sock.recv_into(
+                    self.ring.view[i*self.ring.slot_size:(i+1)*self.ring.slot_size], 0, flags)
+            except BlockingIOError:
+                break
+            got += 1
+            flags = socket.MSG_DONTWAIT
+        return got
+
+    def run(self):
+        while self.running:
+            n = min(self.ring.free(), self.batch)
+            if n == 0:
+                self.overruns += 1
+                self.ring.wait_space(0.1)
+                continue
+            got = self.receive(self.ring.head % self.ring.slots, n)
+            if got:
+                self.ring.push(got)
+
+
+class Stats:
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.frames = 0
+        self.damaged = 0
+
+    def snapshot(self):
+        return (self.packets, self.bytes, self.frames, self.damaged)
+
+
+class Capture:
+    def __init__(self, port, bind_ip="", rtp=True, slots=4096, slot_size=2048, batch=64, rcvbuf=8*1024*1024):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.bind((bind_ip, port))
+        # Lets the receiver notice it has been stopped. Not settimeout(),
+        # which makes the socket non-blocking underneath recvmmsg.
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack("ll", 0, 100000))
+
+        self.rtp = rtp
+        self.ring = Ring(slots, slot_size)
+        self.receiver = Receiver(self.sock, self.ring, batch)
+        self.sequence = SequenceTracker()
+        self.splitter = FrameSplitter()
+        self.assembler = FrameAssembler()
+        self.stats = Stats()
+
+    def process(self, data):
+        self.stats.packets += 1
+        if self.rtp:
+            marker, seq, timestamp, start, end = rtp_payload(data)
+            lost = self.sequence.update(seq)
+            if lost is None:
+                return []
+            self.stats.bytes += end - start
+            frames = self.assembler.feed(data, marker, timestamp, start, end, lost)
+        else:
+            self.stats.bytes += len(data)
+            frames = self.splitter.feed(data)
+        for frame, damaged in frames:
+            self.stats.frames += 1
+            self.stats.damaged += damaged
+        return [(frame, damaged) for frame, damaged in frames if frame is not None]
+
+    def frames(self, timeout=0.1):
+        """Yields (frame, damaged) pairs, or None when nothing arrived for timeout."""
+        self.receiver.start()
+        try:
+            while True:
+                tail, head = self.ring.wait_data(timeout)
+                if tail == head:
+                    yield None
+                    continue
+                for i in range(tail, head):
+                    for frame in self.process(self.ring.slot(i)):
+                        yield frame
+                self.ring.pop(head - tail)
+        finally:
+            self.receiver.running = False
+
+    def close(self):
+        self.receiver.running = False
+        self.receiver.join()
+        self.sock.close()
+
+
+class Writer(threading.Thread):
+    daemon = True
+
+    def __init__(self, output_dir, filename):
+        threading.Thread.__init__(self)
+        self.output_dir = output_dir
+        self.filename = filename
+        self.queue = queue.Queue()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            n, frame = item
+            with open(os.path.join(self.output_dir, self.filename.format(n)), "wb") as f:
+                f.write(frame)
+
+
+def print_stats(capture, last, seconds):
+    packets, nbytes, frames, damaged = capture.stats.snapshot()
+    print("{:6.1f} fps {:8.2f} Mbit/s {:8.0f} packets/s  lost {} late {} damaged frames {} ring full {}".format(
+        (frames - last[2])/seconds,
+        (nbytes - last[1])*8/seconds/1e6,
+        (packets - last[0])/seconds,
+        capture.sequence.lost, capture.sequence.late,
+        damaged, capture.receiver.overruns), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", default=8000, type=int,
+                        help="UDP port the stream is sent to")
+    parser.add_argument("--bind-ip", default="",
+                        help="Local address to listen on")
+    parser.add_argument("--raw", action="store_true",
+                        help="Datagrams carry the JPEG stream without an RTP header")
+    parser.add_argument("--output-dir", default="captures",
+                        help="Directory for the captured frames")
+    parser.add_argument("--filename", default="capture_{:06d}.jpg",
+                        help="Frame file name, formatted with the frame number")
+    parser.add_argument("--keep-damaged", action="store_true",
+                        help="Also write frames which lost packets")
+    parser.add_argument("--frames", default=0, type=int,
+                        help="Stop after this many frames (0 to run until interrupted)")
+    parser.add_argument("--slots", default=4096, type=int,
+                        help="Datagrams the ring buffer holds")
+    parser.add_argument("--batch", default=64, type=int,
+                        help="Datagrams taken per receive call")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    capture = Capture(args.port, args.bind_ip, rtp=not args.raw, slots=args.slots, batch=args.batch)
+    writer = Writer(args.output_dir, args.filename)
+    writer.start()
+
+    print("Capturing on port {} into {}".format(args.port, args.output_dir))
+    written = 0
+    last, last_time = capture.stats.snapshot(), time.time()
+    try:
+        for item in capture.frames():
+            if item is not None:
+                frame, damaged = item
+                if not damaged or args.keep_damaged:
+                    writer.queue.put((written, frame))
+                    written += 1
+                    if args.frames and written >= args.frames:
+                        break
+            now = time.time()
+            if now - last_time >= 1:
+                print_stats(capture, last, now - last_time)
+                last, last_time = capture.stats.snapshot(), now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        capture.close()
+        writer.queue.put(None)
+        writer.join()
+    print("{} frames written, {} packets lost".format(written, capture.sequence.lost))
+
+
+if __name__ == "__main__":
+    main()
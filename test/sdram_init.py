@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+DDR3 bring-up over Etherbone for the a7ddrphy designs.
+
+Initializes the DRAM through the DFII with batched CSR writes, then does
+read leveling by checking every bitslip / delay combination with the
+BIST (or a host written pattern when the design has no BIST) and picks
+the middle of the widest working window.
+
+The setting found is cached per board (by info_dna_id) and reused, after
+a check, on the next run.
+"""
+
+import datetime
+import json
+import time
+
+import numpy
+
+from common import *
+
+import bist
+import bulk
+
+
+dfii_control_sel     = 0x01
+dfii_control_cke     = 0x02
+dfii_control_odt     = 0x04
+dfii_control_reset_n = 0x08
+
+dfii_command_cs     = 0x01
+dfii_command_we     = 0x02
+dfii_command_cas    = 0x04
+dfii_command_ras    = 0x08
+dfii_command_wrdata = 0x10
+dfii_command_rddata = 0x20
+
+dfii_command_mrs = dfii_command_ras|dfii_command_cas|dfii_command_we|dfii_command_cs
+dfii_command_zqcl = dfii_command_we|dfii_command_cs
+
+# Mode registers used so far, cl=7, bl=8.
+DDR3_MR0 = 0x930
+DDR3_MR1 = 0x6
+DDR3_MR2 = 0x408
+DDR3_MR3 = 0x0
+
+# Time between the init steps (reset needs 200us, cke 500us).
+DDR3_INIT_WAIT = 0.001
+
+# 7-series SERDES in DDR mode needs 3 pulses for 1 bitslip
+BITSLIP_PULSES = 3
+
+BITSLIPS = 4
+DELAYS = 32
+
+
+def dfii_command(b, regs, address, baddress, command):
+    b.write(regs.sdram_dfii_pi0_address, address)
+    b.write(regs.sdram_dfii_pi0_baddress, baddress)
+    b.write(regs.sdram_dfii_pi0_command, command)
+    b.write(regs.sdram_dfii_pi0_command_issue, 1)
+
+
+def ddr3_init(wb, mr0=DDR3_MR0, mr1=DDR3_MR1, mr2=DDR3_MR2, mr3=DDR3_MR3):
+    """Run the DDR3 init sequence, one CSR batch per step which needs a wait."""
+    regs = wb.regs
+
+    # release reset
+    with CSRBatch(wb) as b:
+        b.write(regs.sdram_dfii_control, 0)
+        b.write(regs.sdram_dfii_pi0_address, 0x0)
+        b.write(regs.sdram_dfii_pi0_baddress, 0)
+        b.write(regs.sdram_dfii_control, dfii_control_odt|dfii_control_reset_n)
+    time.sleep(DDR3_INIT_WAIT)
+
+    # bring cke high
+    with CSRBatch(wb) as b:
+        b.write(regs.sdram_dfii_control, dfii_control_cke|dfii_control_odt|dfii_control_reset_n)
+    time.sleep(DDR3_INIT_WAIT)
+
+    with CSRBatch(wb) as b:
+        # load mode registers 2, 3, 1 and 0
+        dfii_command(b, regs, mr2, 2, dfii_command_mrs)
+        dfii_command(b, regs, mr3, 3, dfii_command_mrs)
+        dfii_command(b, regs, mr1, 1, dfii_command_mrs)
+        dfii_command(b, regs, mr0, 0, dfii_command_mrs)
+        # zq calibration
+        dfii_command(b, regs, 0x400, 0, dfii_command_zqcl)
+    time.sleep(DDR3_INIT_WAIT)
+
+    # hardware control
+    with CSRBatch(wb) as b:
+        b.write(regs.sdram_dfii_control, dfii_control_sel)
+
+
+def set_read_leveling(wb, bitslip, delay, modules=2):
+    with CSRBatch(wb) as b:
+        for k in range(modules):
+            b.write(wb.regs.ddrphy_dly_sel, 1<<k)
+            b.write(wb.regs.ddrphy_rdly_dq_rst, 1)
+            for i in range(bitslip*BITSLIP_PULSES):
+                b.write(wb.regs.ddrphy_rdly_dq_bitslip, 1)
+            for i in range(delay):
+                b.write(wb.regs.ddrphy_rdly_dq_inc, 1)
+
+
+def seed_to_data(seed, random=True):
+    """
+    >>> seed_to_data(numpy.arange(3)).tolist()
+    [1013904223, 1015568748, 1017233273]
+    """
+    if random:
+        return ((1664525*numpy.asarray(seed, dtype=numpy.uint64) + 1013904223) & 0xffffffff).astype(numpy.uint32)
+    else:
+        return numpy.asarray(seed, dtype=numpy.uint32)
+
+
+def pattern_check(wb, length, offset=0):
+    """Write and read back a pattern from the host, returns the errors."""
+    base = wb.mems.main_ram.base + offset
+    data = seed_to_data(numpy.arange(length) + offset//4)
+    # Not bulk.write(), its acks would fail on the bad settings.
+    with CSRBatch(wb) as b:
+        for pos in range(0, length, bulk.MAX_RECORD_OPS):
+            b.write_words(base + 4*pos, data[pos:pos+bulk.MAX_RECORD_OPS].tolist(), idempotent=True)
+    return int(numpy.count_nonzero(bulk.read(wb, base, length, verbose=False) != data))
+
+
+def bist_check(wb, length, base=0, timeout=1.0, port_width=None):
+    """Run the BIST generator then checker over length bytes, returns the errors.
+
+    port_width is the data width of the BIST ports (bits), by default the
+    one the design gives (bist.get_port_width).
+    """
+    if port_width is None:
+        port_width = bist.get_port_width(wb)
+    words = length//(port_width//8)
+    return bist.run(wb, base, words, words, timeout).errors
+
+
+def get_check(wb, length):
+    if hasattr(wb.regs, "generator_start") and hasattr(wb.regs, "checker_start"):
+        return lambda: bist_check(wb, length)
+    return lambda: pattern_check(wb, length//4)
+
+
+def scan(wb, check, bitslips=BITSLIPS, delays=DELAYS, verbose=True):
+    """Error count of every bitslip / delay combination."""
+    grid = numpy.zeros((bitslips, delays), dtype=numpy.int64)
+    for bitslip in range(bitslips):
+        for delay in range(delays):
+            set_read_leveling(wb, bitslip, delay)
+            grid[bitslip, delay] = check()
+        if verbose:
+            print("bitslip={}: {}".format(bitslip, "".join(
+                "." if e == 0 else "x" for e in grid[bitslip])), flush=True)
+    return grid
+
+
+def best_setting(grid):
+    """The middle of the widest run of working delays, as (bitslip, delay).
+
+    >>> best_setting(numpy.array([[1, 0, 0, 1, 1], [1, 1, 0, 0, 0]]))
+    (1, 3)
+    """
+    best = None
+    for bitslip, errors in enumerate(grid):
+        start = None
+        for delay, e in enumerate(list(errors) + [1]):
+            if e == 0 and start is None:
+                start = delay
+            elif e != 0 and start is not None:
+                width = delay - start
+                if best is None or width > best[0]:
+                    best = (width, bitslip, start + (width-1)//2)
+                start = None
+    assert best is not None, "No working bitslip / delay found"
+    return best[1], best[2]
+
+
+def get_cache_filename(args, dna):
+    return os.path.join(TOP_DIR, get_testdir(args), "calibration", "sdram-{}.json".format(dna))
+
+
+def add_args(parser):
+    parser.add_argument("--check-size", default=128*1024, type=int,
+                        help="Bytes checked at each bitslip / delay")
+    parser.add_argument("--force", action="store_true",
+                        help="Scan again even if the board has a cached setting")
+    parser.add_argument("--no-init", action="store_true",
+                        help="Skip the DFII init sequence")
+
+
+def main():
+    args, wb = connect(__doc__, add_args=add_args)
+
+    start = time.time()
+    if not args.no_init:
+        ddr3_init(wb)
+    check = get_check(wb, args.check_size)
+
+    dna = get_dna(wb)
+    cache = get_cache_filename(args, dna)
+    if os.path.exists(cache) and not args.force:
+        setting = json.load(open(cache))
+        set_read_leveling(wb, setting["bitslip"], setting["delay"])
+        errors = check()
+        print("Cached bitslip={} delay={} from {}: {} errors".format(
+            setting["bitslip"], setting["delay"], cache, errors))
+        if errors == 0:
+            print("Done in {:.1f}s".format(time.time() - start))
+            wb.close()
+            return
+
+    grid = scan(wb, check)
+    bitslip, delay = best_setting(grid)
+    set_read_leveling(wb, bitslip, delay)
+    errors = check()
+    print("bitslip={} delay={}: {} errors".format(bitslip, delay, errors))
+    assert errors == 0, "Best setting doesn't work"
+
+    os.makedirs(os.path.dirname(cache), exist_ok=True)
+    with open(cache, "w") as f:
+        json.dump({
+            "dna": dna,
+            "date": datetime.datetime.now().isoformat(),
+            "bitslip": bitslip,
+            "delay": delay,
+            "errors": grid.tolist(),
+        }, f, indent=2)
+    print("Cached in {}".format(cache))
+    print("Done in {:.1f}s".format(time.time() - start))
+
+    wb.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,115 +1,149 @@
 #!/usr/bin/env python3
+"""
+LiteX Etherbone Memtest BIST
 
+Writes and checks the whole of main_ram with the LiteDRAM BIST, a chunk
+at a time with the checker of one chunk running alongside the generator
+of the next, and reports the bandwidth reached.
+
+When there are errors the error log of the checker (if the design has a
+LiteDRAMBISTErrorLog) and the LiteScope capture of the checker signals
+(LiteDRAMBISTCheckerScope) are pulled and the errors in them are listed.
+
+Each run is added to memtest.jsonl in the test directory, so the numbers
+of a board can be followed over time.
+"""
+
+import datetime
+import json
 import time
 from collections import namedtuple
 
-from litescope.software.driver.analyzer import LiteScopeAnalyzerDriver
-
 from common import *
 
+import bist
+
 MemError = namedtuple("MemError", ("address", "expected", "actual"))
 
 
+def get_analyzer(args, wb):
+    csv = os.path.join(TOP_DIR, get_testdir(args), 'analyzer.csv')
+    if not os.path.exists(csv):
+        return None
+    from litescope.software.driver.analyzer import LiteScopeAnalyzerDriver
+    analyzer = LiteScopeAnalyzerDriver(wb.regs, "analyzer", config_csv=csv, debug=True)
+    analyzer.configure_trigger(cond={'data_error': 1})
+    analyzer.configure_subsampler(1)
+    analyzer.run(offset=16, length=1024)
+    return analyzer
+
+
+def analyzer_errors(analyzer, filename):
+    while not analyzer.done():
+        time.sleep(bist.POLL)
+    analyzer.upload()
+    analyzer.save(filename)
+
+    data = {v.name: v for v in analyzer.dump().variables}
+    errors = {}
+    for i in range(0, len(data['clk'].values)):
+        if data['data_error'].values[i] != 1:
+            continue
+        address = hex(data['data_address'].values[i])
+        errors[address] = MemError(
+            address,
+            hex(data['data_expected'].values[i]),
+            hex(data['data_actual'].values[i]))
+    return errors
+
+
+def add_args(parser):
+    parser.add_argument("--port-width", default=None, type=int,
+                        help="Data width of the BIST DRAM ports, in bits (default: from the design)")
+    parser.add_argument("--chunk", default=16*1024*1024, type=int,
+                        help="Bytes written / checked by each BIST run")
+    parser.add_argument("--offset", default=0, type=lambda x: int(x, 0),
+                        help="Start of the test in main_ram (bytes)")
+    parser.add_argument("--size", default=None, type=lambda x: int(x, 0),
+                        help="Bytes to test (default: the rest of main_ram)")
+    parser.add_argument("--timeout", default=10, type=float,
+                        help="Seconds to wait for a BIST run")
+
+
 def main():
-    args, wb = connect("LiteX Etherbone Memtest BIST", target='memtest')
+    args, wb = connect(__doc__, add_args=add_args, target='memtest')
     print_memmap(wb)
     print()
 
     main_ram = wb.mems.main_ram
     print("DDR at 0x{:x} -- {} Megabytes".format(main_ram.base, int(main_ram.size/(1024*1024))))
     print()
-    # init
-    print("Reset")
-    wb.regs.generator_reset.write(1)
-    wb.regs.checker_reset.write(1)
 
-    wb.regs.generator_reset.write(0)
-    wb.regs.checker_reset.write(0)
+    port_width = args.port_width or bist.get_port_width(wb)
+    word_bytes = port_width//8
+    size = args.size if args.size is not None else main_ram.size - args.offset
+    assert args.offset % word_bytes == 0 and size % word_bytes == 0, (
+        "Offset and size must be whole {} byte words".format(word_bytes))
+    assert args.offset + size <= main_ram.size, "Test goes past the end of main_ram"
+    chunk = max(args.chunk//word_bytes, 1)
 
-    assert not wb.regs.checker_scope_error.read()
-    print()
+    analyzer = get_analyzer(args, wb)
+    print("Analyzer: {}".format(["not armed", "armed on data_error"][analyzer is not None]))
 
-    analyzer = LiteScopeAnalyzerDriver(wb.regs, "analyzer", config_csv='{}/analyzer.csv'.format(make_testdir(args)), debug=True)
-    print("Init analyzer")
-    #analyzer.configure_trigger(cond={'checker_core_data_error': 1})
-    analyzer.configure_trigger(cond={'data_error': 1})
-    analyzer.configure_trigger(cond={})
-    analyzer.configure_subsampler(1)
-    analyzer.run(offset=16, length=1024)
-    assert not analyzer.done()
-    print()
+    error_log = hasattr(wb.regs, "checker_errors_reset")
+    if error_log:
+        wb.regs.checker_errors_reset.write(1)
 
-    base = int(512e3)
-    #length = int((main_ram.size-base)*8/16) # 64e6 == 64 megabytes
-    #length = int(2e6)
-    length = int(1)
-
-    # write
-    print("Write")
-    write_and_check(wb.regs.generator_base, base)
-    write_and_check(wb.regs.generator_length, length)
-
-    assert not wb.regs.generator_done.read()
-    wb.regs.generator_start.write(1)
-    print("Waiting", end=' ')
-    while wb.regs.generator_done.read() == 0:
-        print(".", end='', flush=True)
-        time.sleep(0.1)
-    assert wb.regs.generator_done.read() == 1
+    def progress(result):
+        print("\r{:6.1f}% checked, {} errors".format(
+            100*result.words*word_bytes/size, result.errors), end='', flush=True)
+
+    print("Testing {} Megabytes at 0x{:x}".format(size//(1024*1024), main_ram.base + args.offset))
+    result = bist.run(wb, args.offset//word_bytes, size//word_bytes, chunk,
+                      args.timeout, progress)
     print()
 
-    # read
-    assert wb.regs.checker_err_count.read() == 0
-
-    print("Read")
-    write_and_check(wb.regs.checker_base, base)
-    write_and_check(wb.regs.checker_length, length)
-
-    assert not wb.regs.checker_done.read()
-    assert not analyzer.done()
-    wb.regs.checker_start.write(1)
-    print("Waiting")
-    while wb.regs.checker_done.read() == 0:
-        print("  Errors:", wb.regs.checker_err_count.read())
-        time.sleep(0.1)
-    assert wb.regs.checker_done.read() == 1
-    print("Final errors:", wb.regs.checker_err_count.read())
-
-    errors = wb.regs.checker_err_count.read()
-
-    if errors != 0:
-        # Check litescope
-        assert analyzer.done()
-        analyzer.upload()
-        analyzer.save('sim.vcd')
-
-        data = {v.name: v for v in analyzer.dump().variables}
-
-        okay = set()
-        errors = {}
-        for i in range(0, len(data['clk'].values)):
-            address = hex(data['data_address'].values[i])
-
-            if data['data_error'].values[i] != 1:
-                okay.add(address)
-                continue
-
-            expected = data['data_expected'].values[i]
-            actual = data['data_actual'].values[i]
-
-            r = MemError(address, hex(expected), hex(actual))
-            if address in errors:
-                assert errors[address] == r
-            else:
-                errors[address] = r
-
-        import pprint
-        print(len(errors))
-        pprint.pprint(errors)
-
-        from IPython import embed
-        embed()
-        #print("Error @ {} - {:x} != {:x}".format(addr, expect, actual))
+    clk_freq = getattr(wb.constants, "config_clock_frequency", None)
+    bandwidth = result.bandwidth(word_bytes, clk_freq)
+    print()
+    print("Bandwidth")
+    print("-"*20)
+    for name, mbps in sorted(bandwidth.items()):
+        print("{:>10}: {:8.1f} MB/s".format(name, mbps))
+    print("    Errors: {}".format(result.errors))
+    print("      Time: {:.1f}s".format(result.seconds))
+    for base, length, errors in result.bad_chunks:
+        print("  0x{:08x}-0x{:08x}: {} errors".format(
+            main_ram.base + base*word_bytes, main_ram.base + (base+length)*word_bytes, errors))
+
+    if result.errors and error_log:
+        log = bist.read_error_log(wb)
+        print()
+        print("Error log ({} errors, {} not logged)".format(log["errors"], log["overflow"]))
+        print("-"*20)
+        print("  Banks: {}".format(" ".join(str(e) for e in log["banks"])))
+        print("     DQ: {}".format(" ".join(str(e) for e in log["dq"])))
+        for address, mask in log["entries"]:
+            print("  0x{:08x} xor 0x{:x}".format(main_ram.base + address*word_bytes, mask))
+
+    if result.errors and analyzer is not None:
+        filename = os.path.join(TOP_DIR, get_testdir(args), "memtest.vcd")
+        errors = analyzer_errors(analyzer, filename)
+        print()
+        print("Captured {} errors in {}".format(len(errors), filename))
+        for e in sorted(errors.values()):
+            print("  {} expected {} got {}".format(*e))
+
+    with open(os.path.join(TOP_DIR, get_testdir(args), "memtest.jsonl"), "a") as f:
+        f.write(json.dumps({
+            "dna": get_dna(wb),
+            "git": get_git(wb),
+            "date": datetime.datetime.now().isoformat(),
+            "size": size,
+            "errors": result.errors,
+            "seconds": result.seconds,
+            "bandwidth": bandwidth,
+        }) + "\n")
 
     print("Done!")
 